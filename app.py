@@ -1,7 +1,8 @@
+import pandas as pd
 import streamlit as st
 from src.verify_df import verify_amounts
-from src.parse_pdf import parse_pdf, process_csv_string, is_journal_voucher
-from src.tally_connector import get_tally_company, match_masters
+from src.parse_pdf import stream_parse_pdf, process_csv_string, is_journal_voucher
+from src.tally_connector import get_tally_company, match_masters, offline_company
 from src.tally.create_masters import create_masters
 from src.tally.create_vouchers import create_vouchers
 
@@ -29,9 +30,17 @@ with status_placeholder:
         st.success(f"Connected to Tally Company: '{company_name}'")
 
     except Exception:
-        st.error(
-            "Ensure Tally is running on your system and the correct company is selected. Then click the button below to connect."
-        )
+        # ? Masters can still be matched against an XML export of the company
+        company_name = offline_company()
+        if company_name is None:
+            st.error(
+                "Ensure Tally is running on your system and the correct company is selected. Then click the button below to connect."
+            )
+        else:
+            st.warning(
+                "Tally is not reachable, matching against the exported masters of "
+                f"'{company_name}'"
+            )
 
 if col2.button("Reconnect", icon=":material/refresh:", use_container_width=True):
     status_placeholder.empty()
@@ -57,13 +66,35 @@ if company_name is not None and (uploaded_file is not None or msg_content is not
                         process_csv_string(msg_content)
                     )
                 elif uploaded_file:
-                    st.session_state.common_df, st.session_state.items_df = parse_pdf(
-                        company_name, uploaded_file
-                    )
+                    # ? Show rows as the LLM writes them
+                    common_placeholder = st.empty()
+                    items_placeholder = st.empty()
+                    items = []
+                    for event, data in stream_parse_pdf(company_name, uploaded_file):
+                        if event == "common":
+                            common_placeholder.dataframe(
+                                pd.DataFrame([data]), hide_index=True
+                            )
+                        elif event == "item":
+                            items.append(data)
+                            items_placeholder.dataframe(pd.DataFrame(items))
+                        elif event == "done":
+                            common_df, items_df, cache_hit = data
+                    common_placeholder.empty()
+                    items_placeholder.empty()
+
+                    st.session_state.common_df = common_df
+                    st.session_state.items_df = items_df
+                    if cache_hit:
+                        st.write("♻️ Loaded from cache")
 
                 st.write("🔍 Matching Tally Masters")
                 # ? Match units and other fields, updates in place
-                match_masters(st.session_state.common_df, st.session_state.items_df)
+                match_masters(
+                    st.session_state.common_df,
+                    st.session_state.items_df,
+                    company_name,
+                )
 
                 status.update(
                     label="✅ Invoice Parsed Successfully!",
@@ -92,7 +123,14 @@ if company_name is not None and (uploaded_file is not None or msg_content is not
         st.data_editor(
             st.session_state.items_df,
             num_rows="dynamic",
-            disabled=("Quantity Unit", "Product Name", "Account Name"),
+            disabled=(
+                "Quantity Unit",
+                "Product Name",
+                "Account Name",
+                "[D] Stock Item Candidates",
+                "[D] Units Candidates",
+                "[D] Account Name Candidates",
+            ),
             on_change=lambda data: st.session_state.items_df.update(data),
         )
 
@@ -126,9 +164,22 @@ if company_name is not None and (uploaded_file is not None or msg_content is not
             with st.status("Loading...", expanded=True) as status:
                 try:
                     st.write("📤 Creating Masters")
-                    create_masters(
-                        st.session_state.common_df, st.session_state.items_df
+                    master_results = create_masters(
+                        st.session_state.common_df,
+                        st.session_state.items_df,
+                        company_name,
                     )
+                    for result in master_results:
+                        if result.status == "error":
+                            st.write(
+                                f"⚠️ Could not create {result.master_type} "
+                                f"'{result.name}': {result.error}"
+                            )
+                        elif result.status == "ignored":
+                            st.write(
+                                f"⚠️ Tally ignored {result.master_type} "
+                                f"'{result.name}'"
+                            )
 
                     st.write("📤 Creating Voucher")
                     create_vouchers(
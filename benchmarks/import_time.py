@@ -0,0 +1,114 @@
+"""
+Check that importing the server stays fast and doesn't load heavy dependencies
+at import time.
+
+    python -m benchmarks.import_time --budget 2
+
+Imports each module in a fresh interpreter and fails (exit code 1) when the
+best of --runs imports takes longer than the budget, or when it loads one of
+DEFERRED_MODULES, which should only load when a request first needs them.
+The slowest imports are listed, from python -X importtime.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+DEFAULT_MODULES = ("server",)
+# ? Each of these takes seconds to import (or starts the CLR), they are loaded
+# ? on first use instead
+DEFERRED_MODULES = (
+    "torch",
+    "doctr",
+    "sentence_transformers",
+    "transformers",
+    "langchain_openai",
+    "langchain_core",
+    "openai",
+    "tiktoken",
+    "pythonnet",
+    "clr",
+)
+IMPORT_TIME_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", 2.0))
+
+IMPORT_SCRIPT = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+loaded = sorted({name.split(".")[0] for name in sys.modules})
+print(json.dumps({"seconds": elapsed, "loaded": loaded}))
+"""
+
+
+def import_once(module: str, importtime: bool = False) -> tuple[dict, str]:
+    """Import `module` in a new interpreter, returns its report and stderr"""
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    result = subprocess.run(
+        [*command, "-c", IMPORT_SCRIPT, module],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log: str, count: int) -> list[tuple[int, str]]:
+    """Top level imports by cumulative microseconds, from -X importtime output"""
+    imports = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # ? Nested imports are indented under the import that triggered them
+        if not cumulative.strip().isdigit() or name.startswith("   "):
+            continue
+        imports.append((int(cumulative), name.strip()))
+
+    return sorted(imports, reverse=True)[:count]
+
+
+def check_module(module: str, budget: float, runs: int, top: int) -> list[str]:
+    """Problems found importing `module`, empty if it is within budget"""
+    reports = [import_once(module)[0] for _ in range(runs)]
+    seconds = min(report["seconds"] for report in reports)
+    deferred = sorted(set(DEFERRED_MODULES) & set(reports[0]["loaded"]))
+
+    print(f"{module}: {seconds:.2f}s (budget {budget:.2f}s)")
+    _, importtime_log = import_once(module, importtime=True)
+    for cumulative, name in slowest_imports(importtime_log, top):
+        print(f"  {cumulative / 1e6:6.2f}s  {name}")
+
+    problems = []
+    if seconds > budget:
+        problems.append(f"{module} took {seconds:.2f}s to import, over {budget:.2f}s")
+    if deferred:
+        problems.append(f"{module} imports {', '.join(deferred)} at import time")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--budget", type=float, default=IMPORT_TIME_BUDGET)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports shown")
+    args = parser.parse_args()
+
+    problems = []
+    for module in args.modules:
+        problems.extend(check_module(module, args.budget, args.runs, args.top))
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if problems:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Time each stage of the invoice pipeline over the invoices/ corpus and write the
+results as JSON, to compare commits.
+
+    python -m benchmarks.stages --out bench.json
+
+Runs offline: the LLM is replaced by the recorded reply in examples/sales.txt
+and Tally by a master snapshot, read from --masters (a Tally XML export) or
+generated. Text extraction, OCR and embedding matching use the real models.
+Each stage reports wall times over --repeat runs and the peak memory traced
+by tracemalloc during one extra run.
+"""
+
+import argparse
+import json
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Optional
+
+import src.parse_pdf as parse_pdf_module
+from src.document_buffer import DocumentBuffer
+from src.model_registry import warm_up_models
+from src.parse_pdf import (
+    extract_text_from_pdf,
+    extract_text_from_pdf_ocr,
+    parse_invoice_text,
+    process_csv_string,
+)
+from src.tally.create_masters import (
+    create_party_account,
+    create_stock_items,
+    create_units,
+)
+from src.tally.create_vouchers import build_voucher
+from src.tally.master_writer import MasterWriter, tally_xml
+from src.tally.parse_tally_xml import MasterRecord
+from src.tally_connector import (
+    MasterSnapshot,
+    load_offline_snapshot,
+    master_cache,
+    match_masters,
+)
+from src.verify_df import stack_invoices, verify_amounts, verify_invoices
+
+COMPANY_NAME = "Benchmark Company"
+SCAN_EXTENSIONS = (".jpg", ".jpeg", ".png")
+WORDS = (
+    "steel wooden table chair cabinet sofa shelf bolt panel glass frame desk "
+    "traders enterprises furniture industries agencies store supply india"
+).split()
+
+
+class RecordedReply:
+    def __init__(self, content: str):
+        self.content = content
+        self.response_metadata = {"fixture": True}
+
+    def pretty_print(self):
+        pass
+
+
+class RecordedChatModel:
+    """Stands in for chat_model(), replying with a recorded completion"""
+
+    reply = ""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def invoke(self, prompt):
+        return RecordedReply(self.reply)
+
+    def batch(self, prompts, config=None):
+        return [RecordedReply(self.reply) for _ in prompts]
+
+    def stream(self, prompt):
+        # ? Line by line, roughly how the real model streams rows
+        for line in self.reply.splitlines(keepends=True):
+            yield RecordedReply(line)
+
+
+def synthetic_snapshot(company_name: str, count: int) -> MasterSnapshot:
+    """Ledgers, stock items and units with plausible names, none from the fixture"""
+    rng = random.Random(0)
+
+    def name(i: int) -> str:
+        return f"{' '.join(rng.sample(WORDS, 3)).title()} {i}"
+
+    snapshot = MasterSnapshot(company_name, None)
+    snapshot.put("ledger", [MasterRecord("LEDGER", name(i)) for i in range(count)])
+    snapshot.put(
+        "stock_item", [MasterRecord("STOCKITEM", name(i)) for i in range(count)]
+    )
+    snapshot.put(
+        "unit", [MasterRecord("UNIT", unit) for unit in ("Nos", "Kgs", "Box", "Mtr")]
+    )
+    return snapshot
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # ? Separate run, tracing slows allocation-heavy stages down
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "runs": repeat,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.fmean(times),
+        "peak_traced_bytes": peak,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def build_stages(args) -> dict[str, Callable[[], object]]:
+    reply = Path(args.llm_fixture).read_text()
+    RecordedChatModel.reply = reply
+    parse_pdf_module.chat_model = RecordedChatModel
+
+    if args.masters:
+        snapshot = load_offline_snapshot(COMPANY_NAME, args.masters)
+    else:
+        snapshot = synthetic_snapshot(COMPANY_NAME, args.master_count)
+    master_cache.ttl = float("inf")
+    master_cache.seed(snapshot)
+
+    corpus = sorted(Path(args.invoices).iterdir())
+    pdfs = [path for path in corpus if path.suffix.lower() == ".pdf"]
+    scans = [path for path in corpus if path.suffix.lower() in SCAN_EXTENSIONS]
+
+    common_df, items_df = process_csv_string(reply)
+    # ? Prompt input for the LLM stage, the fixture reply doesn't depend on it
+    with DocumentBuffer.from_path(str(pdfs[0])) as document:
+        text = extract_text_from_pdf(document)
+
+    def extract_pdfs():
+        for path in pdfs:
+            with DocumentBuffer.from_path(str(path)) as document:
+                extract_text_from_pdf(document)
+
+    def ocr_scans():
+        for path in scans:
+            with DocumentBuffer.from_path(str(path)) as document:
+                extract_text_from_pdf_ocr(document)
+
+    def matched():
+        common, items = common_df.copy(), items_df.copy()
+        match_masters(common, items, COMPANY_NAME)
+        return common, items
+
+    matched_common_df, matched_items_df = matched()
+    stacked = stack_invoices([(common_df, items_df)] * args.stack)
+
+    def build_masters():
+        common, items = matched_common_df.copy(), matched_items_df.copy()
+        writer = MasterWriter(COMPANY_NAME)
+        create_party_account(common, snapshot, writer)
+        create_units(items, snapshot, writer)
+        create_stock_items(items, snapshot, writer)
+        # ? What would be sent to Tally, without sending it
+        for _, master in writer.collected():
+            tally_xml(master)
+
+    def build_vouchers():
+        tally_xml(build_voucher(matched_common_df, matched_items_df))
+
+    return {
+        "extract_text": extract_pdfs,
+        "ocr": ocr_scans,
+        "llm_fixture_parse": lambda: parse_invoice_text(COMPANY_NAME, text),
+        "process_csv_string": lambda: process_csv_string(reply),
+        "match_masters": matched,
+        "verify_amounts": lambda: verify_amounts(common_df, items_df),
+        "verify_stacked": lambda: verify_invoices(*stacked),
+        "build_masters": build_masters,
+        "build_vouchers": build_vouchers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--invoices", default="invoices")
+    parser.add_argument("--llm-fixture", default="examples/sales.txt")
+    parser.add_argument("--masters", help="Tally XML export to match against")
+    parser.add_argument("--master-count", type=int, default=2000)
+    parser.add_argument("--stack", type=int, default=1000, help="invoices stacked")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stages", help="comma separated subset of stages to run")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    warm_up_models()
+    model_load_s = time.perf_counter() - start
+
+    stages = build_stages(args)
+    selected = args.stages.split(",") if args.stages else list(stages)
+
+    results = {}
+    for name in selected:
+        print(f"Running {name}", file=sys.stderr)
+        try:
+            results[name] = measure(stages[name], args.repeat)
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "model_load_s": model_load_s,
+        # ? KiB on Linux, bytes on macOS
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        Path(args.out).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
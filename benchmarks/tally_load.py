@@ -0,0 +1,163 @@
+"""
+Replay the invoices/ corpus through the Tally export path and report throughput
+and latency.
+
+    python -m benchmarks.tally_simulator --masters export.xml &
+    TALLY_PORT=9000 python -m benchmarks.tally_load --company "Simulated Company"
+
+Invoices are parsed first through the result cache (a cold cache calls the
+LLM) and that time is not measured. Each timed run matches masters, creates
+the missing ones and posts the voucher, one invoice per request as the app
+does, or with --batch through export_vouchers.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from src.document_buffer import DocumentBuffer
+from src.parse_pdf import parse_pdf_cached
+from src.tally.create_masters import create_masters
+from src.tally.create_vouchers import (
+    ExportLog,
+    Invoice,
+    create_vouchers,
+    export_vouchers,
+)
+from src.tally.loadclr import TALLY_PORT, TALLY_URL
+from src.tally_connector import match_masters
+
+DOCUMENT_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png")
+
+
+def percentile(values: list[float], share: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(share * len(ordered)) - 1))
+    return ordered[index]
+
+
+def simulator_stats() -> Optional[dict]:
+    """Request counters of the simulator, None when talking to a real Tally"""
+    try:
+        url = f"{TALLY_URL}:{TALLY_PORT}/__stats"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return json.load(response)
+    except Exception:
+        return None
+
+
+def load_invoices(company_name: str, folder: str) -> list[Invoice]:
+    invoices = []
+    for filename in sorted(os.listdir(folder)):
+        if not filename.lower().endswith(DOCUMENT_EXTENSIONS):
+            continue
+        with DocumentBuffer.from_path(os.path.join(folder, filename)) as document:
+            try:
+                common_df, items_df, cache_hit = parse_pdf_cached(
+                    company_name, document
+                )
+            except Exception as e:
+                print(f"Skipping {filename}: {e}")
+                continue
+        print(f"Parsed {filename}{' (cached)' if cache_hit else ''}")
+        invoices.append(Invoice(filename, common_df, items_df))
+
+    return invoices
+
+
+def prepare(company_name: str, invoice: Invoice) -> Invoice:
+    common_df, items_df = invoice.common_df.copy(), invoice.items_df.copy()
+    match_masters(common_df, items_df, company_name)
+    create_masters(common_df, items_df, company_name)
+    return Invoice(invoice.source, common_df, items_df)
+
+
+def run_single(company_name: str, invoices: list[Invoice], concurrency: int):
+    """One invoice at a time per worker, the way the Streamlit app exports"""
+
+    def export(invoice: Invoice) -> float:
+        start = time.perf_counter()
+        prepared = prepare(company_name, invoice)
+        create_vouchers(prepared.common_df, prepared.items_df)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(export, invoices))
+
+
+def run_batch(company_name: str, invoices: list[Invoice], chunk_size: int):
+    """
+    Masters per invoice, then the vouchers through export_vouchers, one chunk of
+    `chunk_size` invoices at a time. Returns one latency per chunk.
+    """
+    # ? A fresh export log, otherwise a second run skips every voucher
+    export_log = ExportLog(tempfile.mkdtemp(prefix="exports-"))
+
+    latencies = []
+    for offset in range(0, len(invoices), chunk_size):
+        start = time.perf_counter()
+        chunk = invoices[offset : offset + chunk_size]
+        prepared = [prepare(company_name, invoice) for invoice in chunk]
+        results = export_vouchers(company_name, prepared, chunk_size, export_log)
+        latencies.append(time.perf_counter() - start)
+
+        for result in results:
+            if result.status == "error":
+                print(f"{result.source}: {result.error}")
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--company", required=True)
+    parser.add_argument("--invoices", default="invoices")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--batch", type=int, metavar="CHUNK", help="export vouchers in chunks of CHUNK"
+    )
+    args = parser.parse_args()
+
+    invoices = load_invoices(args.company, args.invoices)
+    if not invoices:
+        raise SystemExit(f"No invoices parsed from {args.invoices}")
+
+    latencies: list[float] = []
+    stats_before = simulator_stats()
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        if args.batch:
+            latencies.extend(run_batch(args.company, invoices, args.batch))
+        else:
+            latencies.extend(run_single(args.company, invoices, args.concurrency))
+    elapsed = time.perf_counter() - start
+    stats_after = simulator_stats()
+
+    exported = len(invoices) * args.rounds
+    # ? With --batch every invoice of a chunk waits for the whole chunk
+    unit = f"chunk of {args.batch}" if args.batch else "invoice"
+    print(f"\n{exported} invoices in {elapsed:.2f}s")
+    print(f"Throughput: {exported / elapsed:.2f} invoices/s")
+    for label, share in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        latency = percentile(latencies, share) * 1000
+        print(f"Latency per {unit} {label}: {latency:.0f} ms")
+    print(f"Latency per {unit} max: {max(latencies) * 1000:.0f} ms")
+
+    if stats_before is not None and stats_after is not None:
+        requests = stats_after["requests"] - stats_before["requests"]
+        imports = stats_after["imports"] - stats_before["imports"]
+        print(
+            f"Tally requests: {requests} ({requests / elapsed:.1f}/s), "
+            f"imports: {imports}"
+        )
+
+
+if __name__ == "__main__":
+    main()
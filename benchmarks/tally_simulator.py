@@ -0,0 +1,314 @@
+"""
+Local stand-in for Tally's XML-over-HTTP server, for load testing the export
+path without a live Tally.
+
+    python -m benchmarks.tally_simulator --masters export.xml --latency 20
+
+Point the app at it with TALLY_URL=http://localhost TALLY_PORT=9000. It serves
+ledgers, stock items and units seeded from a Tally XML export, accepts master
+and voucher imports (checking that the masters they reference exist), and
+answers the AlterID report. GET /__stats returns request counts as JSON.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from src.tally.parse_tally_xml import MasterRecord, iter_tally_masters
+
+# ? Collection TYPE names in requests -> master tags in Tally's XML
+COLLECTION_TYPES = {"ledger": "LEDGER", "stockitem": "STOCKITEM", "unit": "UNIT"}
+RUNNING_RESPONSE = "<RESPONSE>TallyPrime Server is Running</RESPONSE>"
+
+
+def record_element(record: MasterRecord):
+    element = etree.Element(record.kind, NAME=record.name)
+    etree.SubElement(element, "NAME").text = record.name
+    for tag, value in (
+        ("PARENT", record.parent),
+        ("PARTYGSTIN", record.gstin),
+        ("BASEUNITS", record.base_unit),
+    ):
+        if value is not None:
+            etree.SubElement(element, tag).text = value
+    if record.hsn_code is not None:
+        hsn_details = etree.SubElement(element, "HSNDETAILS.LIST")
+        etree.SubElement(hsn_details, "HSNCODE").text = record.hsn_code
+
+    return element
+
+
+def element_name(element) -> Optional[str]:
+    name = element.get("NAME") or element.findtext("NAME.LIST/NAME")
+    if not name:
+        name = element.findtext("NAME")
+    return name.strip() if name else None
+
+
+def envelope(data: str) -> str:
+    return (
+        "<ENVELOPE><HEADER><VERSION>1</VERSION><STATUS>1</STATUS></HEADER>"
+        f"<BODY><DESC></DESC><DATA>{data}</DATA></BODY></ENVELOPE>"
+    )
+
+
+class SimulatedTally:
+    """Masters and vouchers of one company, and the import rules Tally applies"""
+
+    def __init__(self, company_name: str):
+        self.company_name = company_name
+        self.alter_id = 0
+        self.voucher_id = 0
+        # ? tag -> name -> (alter id, element)
+        self.masters: Dict[str, Dict[str, tuple]] = {
+            tag: {} for tag in COLLECTION_TYPES.values()
+        }
+        # ? REMOTEID (or a generated one) -> element
+        self.vouchers: Dict[str, object] = {}
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "exports": 0,
+            "imports": 0,
+            "imported_objects": 0,
+            "created": 0,
+            "altered": 0,
+            "errors": 0,
+        }
+        self._lock = threading.Lock()
+
+    def seed(self, xml_file: str):
+        count = 0
+        for record in iter_tally_masters(xml_file, self.masters):
+            self.alter_id += 1
+            self.masters[record.kind][record.name] = (
+                self.alter_id,
+                record_element(record),
+            )
+            count += 1
+        print(f"Seeded {count} masters from {xml_file}")
+
+    def count(self, **counts: int):
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def export_collection(self, request: str) -> str:
+        if "AlterIdsReport" in request or "MastersLastId" in request:
+            # ? Both spellings, the client deserialises whichever it expects
+            return envelope(
+                f"<MASTERSLASTID>{self.alter_id}</MASTERSLASTID>"
+                f"<VOUCHERSLASTID>{self.voucher_id}</VOUCHERSLASTID>"
+                f"<MastersLastId>{self.alter_id}</MastersLastId>"
+                f"<VouchersLastId>{self.voucher_id}</VouchersLastId>"
+            )
+
+        types = re.findall(r"<TYPE>([^<]+)</TYPE>", request)
+        types = [collection_type.strip().lower() for collection_type in types]
+        if "company" in types:
+            name = escape(self.company_name)
+            return envelope(
+                f'<COLLECTION><COMPANY NAME="{name}"><NAME>{name}</NAME></COMPANY>'
+                "</COLLECTION>"
+            )
+
+        tag = next((COLLECTION_TYPES[t] for t in types if t in COLLECTION_TYPES), None)
+        if tag is None:
+            return envelope("<COLLECTION></COLLECTION>")
+
+        # ? The filter formula arrives escaped inside the TDL
+        alter_filter = re.search(r"\$AlterID\s*(?:>|&gt;)\s*(\d+)", request)
+        min_alter_id = int(alter_filter.group(1)) if alter_filter else -1
+
+        with self._lock:
+            elements = [
+                etree.tostring(element, encoding="unicode")
+                for alter_id, element in self.masters[tag].values()
+                if alter_id > min_alter_id
+            ]
+        return envelope(f"<COLLECTION>{''.join(elements)}</COLLECTION>")
+
+    def _missing_masters(self, element) -> list[str]:
+        missing = []
+        for tag, path in (
+            ("LEDGER", ".//LEDGERNAME"),
+            ("STOCKITEM", ".//STOCKITEMNAME"),
+            ("UNIT", "BASEUNITS"),
+        ):
+            for reference in element.iterfind(path):
+                name = (reference.text or "").strip()
+                if name and name not in self.masters[tag]:
+                    missing.append(f"{tag.capitalize()} '{name}' does not exist!")
+        return missing
+
+    def import_data(self, root) -> str:
+        created = altered = errors = 0
+        line_errors = []
+
+        with self._lock:
+            for message in root.iter("TALLYMESSAGE"):
+                for element in message:
+                    if not isinstance(element.tag, str):
+                        continue
+
+                    missing = self._missing_masters(element)
+                    if missing:
+                        errors += 1
+                        line_errors.extend(missing)
+                        continue
+
+                    if element.tag == "VOUCHER":
+                        self.voucher_id += 1
+                        key = element.get("REMOTEID") or f"vch-{self.voucher_id}"
+                        is_new = key not in self.vouchers
+                        self.vouchers[key] = element
+                    elif element.tag in self.masters:
+                        name = element_name(element)
+                        if name is None:
+                            errors += 1
+                            line_errors.append(f"{element.tag} without a name")
+                            continue
+                        self.alter_id += 1
+                        is_new = name not in self.masters[element.tag]
+                        self.masters[element.tag][name] = (self.alter_id, element)
+                    else:
+                        # ? Other masters (groups, godowns...) are accepted as is
+                        self.alter_id += 1
+                        is_new = True
+
+                    created += is_new
+                    altered += not is_new
+
+        self.count(
+            imported_objects=created + altered + errors,
+            created=created,
+            altered=altered,
+            errors=errors,
+        )
+        result = "".join(f"<LINEERROR>{escape(e)}</LINEERROR>" for e in line_errors)
+        return envelope(
+            f"<IMPORTRESULT><CREATED>{created}</CREATED><ALTERED>{altered}</ALTERED>"
+            f"<DELETED>0</DELETED><LASTVCHID>{self.voucher_id}</LASTVCHID>"
+            f"<LASTMID>{self.alter_id}</LASTMID>"
+            "<COMBINED>0</COMBINED><IGNORED>0</IGNORED>"
+            f"<ERRORS>{errors}</ERRORS><CANCELLED>0</CANCELLED>{result}"
+            "</IMPORTRESULT>"
+        )
+
+
+class LatencyModel:
+    """Per-request delay, plus a cost per imported object like Tally's import"""
+
+    def __init__(self, latency_ms: float, per_object_ms: float, jitter: float):
+        self.latency = latency_ms / 1000
+        self.per_object = per_object_ms / 1000
+        self.jitter = jitter
+
+    def sleep(self, objects: int = 0):
+        delay = self.latency + self.per_object * objects
+        if delay > 0:
+            time.sleep(delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+def make_handler(tally: SimulatedTally, latency: LatencyModel, serial: bool):
+    # ? Tally handles one request at a time, so requests queue behind each other
+    request_lock = threading.Lock() if serial else None
+
+    class TallyRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, body: str, content_type: str = "text/xml; charset=utf-8"):
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/__stats":
+                with tally._lock:
+                    stats = dict(tally.stats)
+                stats["masters_alter_id"] = tally.alter_id
+                stats["vouchers"] = len(tally.vouchers)
+                self.reply(json.dumps(stats), "application/json")
+            else:
+                self.reply(RUNNING_RESPONSE)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            tally.count(requests=1)
+
+            if request_lock is not None:
+                request_lock.acquire()
+            try:
+                self.reply(self.handle_request(body))
+            finally:
+                if request_lock is not None:
+                    request_lock.release()
+
+        def handle_request(self, body: bytes) -> str:
+            if not body.strip():
+                latency.sleep()
+                return RUNNING_RESPONSE
+
+            parser = etree.XMLParser(recover=True, huge_tree=True)
+            root = etree.fromstring(body, parser)
+            request_type = (root.findtext("HEADER/TALLYREQUEST") or "").strip().lower()
+
+            if request_type == "import":
+                tally.count(imports=1)
+                latency.sleep(sum(len(m) for m in root.iter("TALLYMESSAGE")))
+                return tally.import_data(root)
+
+            tally.count(exports=1)
+            latency.sleep()
+            return tally.export_collection(body.decode("utf-8", "replace"))
+
+    return TallyRequestHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--company", default="Simulated Company")
+    parser.add_argument("--masters", help="Tally XML export to seed masters from")
+    parser.add_argument("--latency", type=float, default=10, help="ms per request")
+    parser.add_argument(
+        "--per-object", type=float, default=2, help="ms per imported master/voucher"
+    )
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        help="serve requests in parallel instead of one at a time like Tally",
+    )
+    args = parser.parse_args()
+
+    tally = SimulatedTally(args.company)
+    if args.masters:
+        tally.seed(args.masters)
+
+    latency = LatencyModel(args.latency, args.per_object, args.jitter)
+    handler = make_handler(tally, latency, serial=not args.concurrent)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    print(f"Simulating Tally for '{args.company}' on port {args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,71 @@
 """gunicorn WSGI server configuration."""
 
+import gc
+import os
 from multiprocessing import cpu_count
 
 bind = "unix:./gunicorn.sock"
-workers = cpu_count() * 2 + 1
+workers = int(os.environ.get("GUNICORN_WORKERS", cpu_count() * 2 + 1))
 accesslog = "/var/log/gunicorn/entryzen/access.log"
 errorlog = "/var/log/gunicorn/entryzen/error.log"
 
 loglevel = "info"
 capture_output = True
 
-# max_requests = 1000
-# worker_class = "gevent"
+# ? Import the app and load the OCR/embedding models once in the master, workers
+# ? then share those pages copy-on-write instead of each loading their own copy
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# ? Recycle workers to bound leaks; with preload_app the replacement is forked
+# ? from the warm master, so it starts with the models already loaded
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 500))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 50))
+
+# ? Threaded workers keep answering the arbiter's heartbeat while a thread is
+# ? busy, so long /upload-batch, /upload-stream (SSE) and chunked parses aren't
+# ? killed as hung; each thread serves one request
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# ? Seconds of silence before a worker is killed, and of grace on reload; size it
+# ? for the longest parse (a many-page invoice split into LLM chunks)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 600))
+graceful_timeout = timeout
+
+
+def when_ready(server):
+    from src.memory import MASTER_PID_ENV
+    from src.metrics import metrics
+
+    # ? Inherited by the workers, which report memory per master (/debug/memory)
+    os.environ[MASTER_PID_ENV] = str(os.getpid())
+    from src.model_registry import uses_cuda, warm_up_models
+
+    # ? Counts from a previous run would be added to this one's
+    metrics.clear()
+
+    # ? CUDA contexts don't survive fork, GPU workers warm up on their own
+    if preload_app and not uses_cuda():
+        warm_up_models(start_reaper=False)
+        # ? Keep the loaded objects out of GC passes, which would otherwise
+        # ? touch (and so copy) the shared pages in every worker
+        gc.freeze()
+        server.log.info("Models loaded in master pid %s", os.getpid())
+
+
+def post_worker_init(worker):
+    # ? Load models before the worker accepts requests (a no-op when preloaded).
+    # ? Workers forked from the warmed master inherit its keep_loaded registry,
+    # ? so only workers that load their own models start the idle reaper
+    from src.model_registry import warm_up_models
+
+    warm_up_models()
+
+
+def worker_exit(server, worker):
+    from src.memory import process_memory
+    from src.metrics import metrics
+
+    memory = process_memory(worker.pid)
+    server.log.info("Worker %s exiting, memory: %s", worker.pid, memory)
+    # ? Keep the worker's counts without keeping a file per recycled worker
+    metrics.retire(worker.pid)
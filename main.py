@@ -1,13 +1,22 @@
 import gradio as gr
-from src.parse_pdf import parse_pdf
+from src.parse_pdf import parse_pdf_cached
+
+
+def parse_invoice(pdf_file: str, company_name: str):
+    common_df, items_df, cache_hit = parse_pdf_cached(company_name, pdf_file)
+    return common_df, items_df, "Loaded from cache" if cache_hit else "Parsed"
 
 
 iface = gr.Interface(
-    fn=parse_pdf,
-    inputs=gr.File(label="Upload Invoice PDF"),
+    fn=parse_invoice,
+    inputs=[
+        gr.File(label="Upload Invoice PDF", type="filepath"),
+        gr.Textbox(label="Company Name"),
+    ],
     outputs=[
         gr.Dataframe(label="Invoice Details"),
         gr.Dataframe(label="Invoice Items"),
+        gr.Textbox(label="Cache"),
     ],
     title="Invoice Processor",
     description="Upload a PDF invoice to extract common data and item details.",
@@ -1,48 +1,273 @@
-from flask import Flask, request, jsonify
+import os
+from flask import Flask, Response, request, jsonify, stream_with_context, url_for
 from flask_cors import CORS
-from src.parse_pdf import parse_pdf
-from io import BytesIO
+from src.parse_pdf import parse_pdf_cached, stream_parse_pdf
+from src.batch import (
+    BATCH_LLM_CONCURRENCY,
+    BatchResult,
+    parse_batch,
+    read_batch_documents,
+)
+from src.document_buffer import DocumentBuffer
+from src.jobs import QueueFull, job_queue
+from src.memory import gunicorn_master_pid, worker_memory_report
+from src.metrics import metrics
+from src.response_format import (
+    ARROW_STREAM_MIME,
+    JSON_MIME,
+    RESPONSE_MIMES,
+    arrow_ipc,
+    dumps,
+    parse_orient,
+    result_json,
+)
+
+# ? Serve /debug/* routes, which expose process details
+DEBUG_ENDPOINTS = os.environ.get("DEBUG_ENDPOINTS") == "1"
 
 app = Flask(__name__)
+# ? Keep columns in the order the invoice lists them
+app.json.sort_keys = False
 CORS(app)
 
 
+class UploadError(Exception):
+    pass
+
+
+def read_upload() -> tuple[DocumentBuffer, str]:
+    # Check if file is present in request
+    if "file" not in request.files:
+        raise UploadError("No file provided")
+
+    file = request.files["file"]
+
+    # Check if file has a name
+    if file.filename == "":
+        raise UploadError("No file selected")
+
+    # Get company name from request
+    company_name = request.form.get("company_name")
+    if not company_name:
+        raise UploadError("No company_name data provided")
+
+    # ? Read the upload once, large files are spilled to disk
+    return DocumentBuffer.from_stream(file.stream, file.filename), company_name
+
+
+def read_orient() -> str:
+    """`?orient=columns|records` of the JSON response"""
+    try:
+        return parse_orient(request.args.get("orient"))
+    except ValueError as e:
+        raise UploadError(str(e))
+
+
+def wants_arrow() -> bool:
+    """Whether the Accept header prefers an Arrow IPC stream over JSON"""
+    best = request.accept_mimetypes.best_match(RESPONSE_MIMES, default=JSON_MIME)
+    return best == ARROW_STREAM_MIME
+
+
+def arrow_response(results: list[BatchResult]) -> Response:
+    return Response(
+        arrow_ipc(results), mimetype=ARROW_STREAM_MIME, headers={"Vary": "Accept"}
+    )
+
+
+def parse_document(
+    company_name: str, document: DocumentBuffer, orient: str = "columns"
+) -> dict:
+    with metrics.span("parse_document"):
+        return result_json(*parse_pdf_cached(company_name, document), orient)
+
+
 @app.route("/upload", methods=["POST"])
 def upload():
+    """
+    Parse one invoice. Returns JSON (`?orient=columns` or `records` for the
+    line items), or an Arrow IPC stream when the Accept header asks for
+    application/vnd.apache.arrow.stream.
+    """
+    try:
+        orient = read_orient()
+        document, company_name = read_upload()
+        with document:
+            if wants_arrow():
+                with metrics.span("parse_document"):
+                    common_df, items_df, cache_hit = parse_pdf_cached(
+                        company_name, document
+                    )
+                    result = BatchResult(
+                        0, document.name, common_df, items_df, cache_hit
+                    )
+                    return arrow_response([result])
+
+            response_data = parse_document(company_name, document, orient)
+
+        return jsonify(response_data), 200, {"Vary": "Accept"}
+
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+
+@app.route("/upload-stream", methods=["POST"])
+def upload_stream():
+    """
+    /upload as Server-Sent Events: a `common` event with the header fields, one
+    `item` event per line item as the LLM writes it, then `done` with the same
+    payload as /upload (or `error`).
+    """
     try:
-        # Check if file is present in request
-        if "file" not in request.files:
-            return jsonify({"error": "No file provided"}), 400
+        orient = read_orient()
+        document, company_name = read_upload()
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 400
 
-        file = request.files["file"]
+    def generate():
+        try:
+            for event, data in stream_parse_pdf(company_name, document):
+                if event == "done":
+                    data = result_json(*data, orient)
+                yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
 
-        # Check if file has a name
-        if file.filename == "":
-            return jsonify({"error": "No file selected"}), 400
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # ? Runs after the stream closes, also when the client left before it started
+    response.call_on_close(document.close)
+    return response
 
-        # Convert FileStorage to BytesIO
-        pdf_bytes = BytesIO(file.read())
-        pdf_bytes.name = file.filename  # Add filename attribute to BytesIO object
 
-        # Get company name from request
-        company_name = request.form.get("company_name")
-        if not company_name:
-            return jsonify({"error": "No company_name data provided"}), 400
+@app.route("/upload-batch", methods=["POST"])
+def upload_batch():
+    """
+    Parse many PDFs (or zip archives of them) and stream one JSON line per
+    document as it finishes, in completion order. With an Accept header asking
+    for application/vnd.apache.arrow.stream, all results are returned at once
+    as one Arrow IPC stream instead.
+    """
+    try:
+        orient = read_orient()
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 400
 
-        # Call parse_pdf function with BytesIO object
-        primary_series, secondary_df = parse_pdf(company_name, pdf_bytes)
+    files = [file for file in request.files.getlist("files") if file.filename]
+    if not files:
+        return jsonify({"error": "No files provided"}), 400
 
-        # Convert to JSON format
-        response_data = {
-            "primary": primary_series.to_json(),
-            "secondary": secondary_df.to_json(),
-        }
+    company_name = request.form.get("company_name")
+    if not company_name:
+        return jsonify({"error": "No company_name data provided"}), 400
 
-        return jsonify(response_data), 200
+    llm_concurrency = min(
+        request.form.get("llm_concurrency", BATCH_LLM_CONCURRENCY, type=int),
+        BATCH_LLM_CONCURRENCY,
+    )
 
+    try:
+        documents = read_batch_documents((file.filename, file.stream) for file in files)
+    except Exception as e:
+        return jsonify({"error": f"Could not read upload: {e}"}), 400
+
+    def close_documents():
+        for document in documents:
+            document.close()
+
+    results = parse_batch(company_name, documents, max(llm_concurrency, 1))
+    if wants_arrow():
+        try:
+            return arrow_response(list(results))
+        finally:
+            close_documents()
+
+    def generate():
+        for result in results:
+            line = {"index": result.index, "filename": result.filename}
+            if result.error is not None:
+                line["error"] = result.error
+            else:
+                line.update(
+                    result_json(
+                        result.common_df, result.items_df, result.cache_hit, orient
+                    )
+                )
+            yield dumps(line) + "\n"
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Vary": "Accept"},
+    )
+    # ? Runs after parse_batch is closed, also when the client left before the
+    # ? first line and the generator never started
+    response.call_on_close(close_documents)
+    return response
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    try:
+        orient = read_orient()
+        document, company_name = read_upload()
+        try:
+            job_id = job_queue.submit(
+                parse_document, company_name, document, orient, cleanup=document.close
+            )
+        except QueueFull as e:
+            document.close()
+            return jsonify({"error": str(e)}), 429, {"Retry-After": "30"}
+
+        status_url = url_for("get_job", job_id=job_id)
+        return jsonify({"job_id": job_id, "status_url": status_url}), 202
+
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+
+    return jsonify(job), 200
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id: str):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+
+    return jsonify(job), 200
+
+
+@app.route("/debug/memory", methods=["GET"])
+def memory_report():
+    master_pid = gunicorn_master_pid()
+    if not DEBUG_ENDPOINTS or master_pid is None:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(worker_memory_report(master_pid)), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_report():
+    """Stage latencies and counters of every worker, in Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=7860)
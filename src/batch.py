@@ -0,0 +1,178 @@
+import os
+import queue
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import BinaryIO, Iterable, Iterator, NamedTuple, Optional
+
+import pandas as pd
+
+from .document_buffer import DocumentBuffer
+from .parse_pdf import (
+    cache_result,
+    extract_invoice_pages,
+    get_cached_result,
+    parse_invoice_pages,
+)
+
+# ? Threads for text extraction and OCR shared by every batch of a process, torch
+# ? releases the GIL while OCRing; gunicorn already runs ~2 workers per core
+BATCH_CPU_WORKERS = int(os.environ.get("BATCH_CPU_WORKERS", 2))
+# ? LLM requests in flight at once for one batch
+BATCH_LLM_CONCURRENCY = int(os.environ.get("BATCH_LLM_CONCURRENCY", 8))
+
+DOCUMENT_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png")
+
+# ? Limits on uploaded zip archives, checked against their directory before
+# ? anything is extracted (zipfile never inflates past a member's file_size)
+ZIP_MAX_MEMBERS = int(os.environ.get("ZIP_MAX_MEMBERS", 1000))
+ZIP_MAX_UNCOMPRESSED_BYTES = int(
+    os.environ.get("ZIP_MAX_UNCOMPRESSED_BYTES", 1024 * 1024 * 1024)
+)
+ZIP_MAX_COMPRESSION_RATIO = float(os.environ.get("ZIP_MAX_COMPRESSION_RATIO", 100))
+
+
+_cpu_pool: Optional[ThreadPoolExecutor] = None
+_cpu_pool_pid: Optional[int] = None
+_cpu_pool_lock = threading.Lock()
+
+
+def cpu_pool() -> ThreadPoolExecutor:
+    """The process's pool for the CPU stage of every batch, made on first use"""
+    global _cpu_pool, _cpu_pool_pid
+    with _cpu_pool_lock:
+        # ? Threads don't survive fork, a forked worker makes its own pool
+        if _cpu_pool is None or _cpu_pool_pid != os.getpid():
+            _cpu_pool = ThreadPoolExecutor(
+                BATCH_CPU_WORKERS, thread_name_prefix="batch-cpu"
+            )
+            _cpu_pool_pid = os.getpid()
+        return _cpu_pool
+
+
+class BatchResult(NamedTuple):
+    index: int
+    filename: str
+    common_df: Optional[pd.DataFrame] = None
+    items_df: Optional[pd.DataFrame] = None
+    cache_hit: bool = False
+    error: Optional[str] = None
+
+
+def archive_documents(archive: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """Document members of `archive`, refusing archives that inflate too far"""
+    members = archive.infolist()
+    if len(members) > ZIP_MAX_MEMBERS:
+        raise ValueError(f"zip has {len(members)} members, over {ZIP_MAX_MEMBERS}")
+
+    documents = [
+        member
+        for member in members
+        if not member.is_dir() and member.filename.lower().endswith(DOCUMENT_EXTENSIONS)
+    ]
+    for member in documents:
+        ratio = member.file_size / max(member.compress_size, 1)
+        if ratio > ZIP_MAX_COMPRESSION_RATIO:
+            raise ValueError(
+                f"zip member {member.filename} is compressed {ratio:.0f}:1, "
+                f"over {ZIP_MAX_COMPRESSION_RATIO:.0f}:1"
+            )
+
+    total = sum(member.file_size for member in documents)
+    if total > ZIP_MAX_UNCOMPRESSED_BYTES:
+        raise ValueError(
+            f"zip inflates to {total} bytes, over {ZIP_MAX_UNCOMPRESSED_BYTES}"
+        )
+
+    return documents
+
+
+def read_batch_documents(files: Iterable[tuple[str, BinaryIO]]) -> list[DocumentBuffer]:
+    """Buffer every uploaded document, expanding zip archives into their members"""
+    documents = []
+    try:
+        for filename, stream in files:
+            if not filename.lower().endswith(".zip"):
+                documents.append(DocumentBuffer.from_stream(stream, filename))
+                continue
+
+            with zipfile.ZipFile(stream) as archive:
+                for member in archive_documents(archive):
+                    with archive.open(member) as member_stream:
+                        documents.append(
+                            DocumentBuffer.from_stream(member_stream, member.filename)
+                        )
+    except BaseException:
+        # ? Don't leave the spilled temp files of the documents read so far
+        for document in documents:
+            document.close()
+        raise
+
+    return documents
+
+
+def parse_batch(
+    company_name: str,
+    documents: list[DocumentBuffer],
+    llm_concurrency: int = BATCH_LLM_CONCURRENCY,
+) -> Iterator[BatchResult]:
+    """
+    Parse many documents with overlapping stages and yield each result as soon
+    as its document finishes, in completion order. Cache lookups, text extraction
+    and OCR run on the process's CPU pool; every extracted text is handed straight
+    to an I/O pool. Up to `llm_concurrency` LLM calls are in flight for the whole
+    batch, page chunks of long invoices included.
+    The caller owns `documents` and closes them once the generator is closed;
+    each buffer is already released early, as soon as its text is extracted.
+    """
+    results: queue.Queue[BatchResult] = queue.Queue()
+    io_pool = ThreadPoolExecutor(llm_concurrency, thread_name_prefix="batch-llm")
+    llm_slots = threading.BoundedSemaphore(llm_concurrency)
+
+    def fail(index: int, document: DocumentBuffer, error: BaseException):
+        print(f"Error parsing {document.name}: {error}")
+        results.put(BatchResult(index, document.name, error=str(error)))
+
+    def llm_stage(index: int, document: DocumentBuffer, key: str, pages: list[str]):
+        try:
+            common_df, items_df = parse_invoice_pages(company_name, pages, llm_slots)
+            common_df["filename"] = document.name
+            cache_result(key, common_df, items_df)
+            results.put(BatchResult(index, document.name, common_df, items_df))
+        except Exception as e:
+            fail(index, document, e)
+
+    def cpu_stage(index: int, document: DocumentBuffer):
+        try:
+            key, cached = get_cached_result(company_name, document)
+            if cached is not None:
+                common_df, items_df = cached
+                common_df["filename"] = document.name
+                results.put(
+                    BatchResult(index, document.name, common_df, items_df, True)
+                )
+                return
+
+            pages = extract_invoice_pages(document)
+            io_pool.submit(llm_stage, index, document, key, pages)
+        except Exception as e:
+            fail(index, document, e)
+        finally:
+            # ? The LLM stage only needs the text, so the buffer is done here
+            document.close()
+
+    cpu_futures = [
+        cpu_pool().submit(cpu_stage, index, document)
+        for index, document in enumerate(documents)
+    ]
+
+    try:
+        for _ in documents:
+            yield results.get()
+    finally:
+        # ? Client went away: drop the queued work, in-flight calls run to completion
+        for future in cpu_futures:
+            future.cancel()
+        io_pool.shutdown(wait=False, cancel_futures=True)
+        # ? Extractions still reading a buffer finish before the caller closes it
+        wait(cpu_futures)
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Optional
+
+# ? Also drop pages that are near (not exact) duplicates of a kept page, off by
+# ? default since a continuation page can differ from another by a few amounts
+DROP_NEAR_DUPLICATE_PAGES = os.environ.get("DROP_NEAR_DUPLICATE_PAGES") == "1"
+# ? Pages whose word shingles overlap at least this much with a kept page are dropped
+NEAR_DUPLICATE_THRESHOLD = 0.9
+SHINGLE_SIZE = 5
+# ? Lines repeated in the top/bottom region of at least this share of pages are
+# ? treated as headers/footers and only kept on the first page they appear on
+BOILERPLATE_MIN_SHARE = 0.5
+BOILERPLATE_REGION = 15
+# ? The only lines with numbers that count as boilerplate, e.g. "Page 2 of 3"
+PAGE_NUMBER = re.compile(r"page\s*\d+\s*(of|/)\s*\d+", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1)
+def _token_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _token_encoding()
+    if encoding is None:
+        # ? Rough estimate for English text when tiktoken is unavailable
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def normalize_whitespace(page: str) -> str:
+    """Collapse runs of spaces and blank lines, pymupdf emits plenty of both"""
+    lines = (" ".join(line.split()) for line in page.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _shingles(page: str) -> set[int]:
+    words = page.lower().split()
+    if len(words) < SHINGLE_SIZE:
+        return {hash(" ".join(words))}
+    return {
+        hash(" ".join(words[i : i + SHINGLE_SIZE]))
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def drop_duplicate_pages(
+    pages: list[str], near_duplicates: bool = DROP_NEAR_DUPLICATE_PAGES
+) -> list[str]:
+    """Drop repeated pages, and with `near_duplicates` pages nearly the same"""
+    kept: list[str] = []
+    kept_digests: set[str] = set()
+    kept_shingles: list[set[int]] = []
+
+    for page in pages:
+        digest = hashlib.sha1(page.encode()).hexdigest()
+        if digest in kept_digests:
+            continue
+
+        shingles = _shingles(page) if near_duplicates else set()
+        if near_duplicates and any(
+            len(shingles & other) / len(shingles | other) >= NEAR_DUPLICATE_THRESHOLD
+            for other in kept_shingles
+        ):
+            continue
+
+        kept.append(page)
+        kept_digests.add(digest)
+        kept_shingles.append(shingles)
+
+    return kept
+
+
+def _boilerplate_key(line: str) -> Optional[str]:
+    # ? "Page 1 of 3" and "Page 2 of 3" are the same footer
+    if PAGE_NUMBER.fullmatch(line):
+        return "page # of #"
+    # ? Amounts, quantities and item codes are content even when they repeat,
+    # ? e.g. a subtotal at the bottom of every page; so are one-word cells
+    if re.search(r"\d", line) or len(line.split()) < 2:
+        return None
+    return line
+
+
+def strip_boilerplate(pages: list[str]) -> list[str]:
+    """
+    Remove header and footer lines repeated across pages from every page but the
+    first. Only contiguous runs at the top and bottom of a page are stripped, and
+    only lines repeated exactly and without numbers (page numbers aside), so
+    repeated cells inside item tables are left alone.
+    """
+    if len(pages) < 2:
+        return pages
+
+    page_lines = [page.split("\n") for page in pages]
+    top, bottom = Counter(), Counter()
+    for lines in page_lines:
+        top.update({_boilerplate_key(line) for line in lines[:BOILERPLATE_REGION]})
+        bottom.update({_boilerplate_key(line) for line in lines[-BOILERPLATE_REGION:]})
+
+    min_pages = max(2, BOILERPLATE_MIN_SHARE * len(pages))
+    headers = {key for key, count in top.items() if key and count >= min_pages}
+    footers = {key for key, count in bottom.items() if key and count >= min_pages}
+
+    stripped = [pages[0]]
+    for lines in page_lines[1:]:
+        start, end = 0, len(lines)
+        while start < end and _boilerplate_key(lines[start]) in headers:
+            start += 1
+        while end > start and _boilerplate_key(lines[end - 1]) in footers:
+            end -= 1
+        stripped.append("\n".join(lines[start:end]))
+
+    return stripped
+
+
+def compact_pages(
+    pages: list[str], near_duplicates: bool = DROP_NEAR_DUPLICATE_PAGES
+) -> list[str]:
+    """Shrink extracted pages before they go into the prompt"""
+    pages = [normalize_whitespace(page) for page in pages]
+    pages = drop_duplicate_pages([page for page in pages if page], near_duplicates)
+    pages = strip_boilerplate(pages)
+
+    return [page for page in pages if page]
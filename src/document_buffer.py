@@ -0,0 +1,127 @@
+import io
+import mmap
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
+
+import pymupdf
+
+# ? Uploads larger than this are spilled to a temp file and memory-mapped
+SPILL_THRESHOLD = int(os.environ.get("DOCUMENT_SPILL_THRESHOLD", 8 * 1024 * 1024))
+
+
+class DocumentBuffer:
+    """
+    Immutable bytes of one uploaded document, read from the client exactly once.
+
+    Small documents are held as a single `bytes` object, large ones live in a
+    temp file that is memory-mapped on demand. Consumers get read-only views
+    (`view()`) or a pymupdf document (`open_pdf()`), never a copy.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        data: Optional[bytes] = None,
+        path: Optional[str] = None,
+        owns_path: bool = False,
+    ):
+        self.name = name
+        self._data = data
+        self._path = path
+        self._owns_path = owns_path
+        self._mmap: Optional[mmap.mmap] = None
+
+    @classmethod
+    def from_stream(
+        cls, stream: BinaryIO, name: str, spill_threshold: int = SPILL_THRESHOLD
+    ) -> "DocumentBuffer":
+        head = stream.read(spill_threshold + 1)
+        if len(head) <= spill_threshold:
+            return cls(name, data=head)
+
+        suffix = os.path.splitext(name)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            f.write(head)
+            del head
+            shutil.copyfileobj(stream, f)
+
+        return cls(name, path=f.name, owns_path=True)
+
+    @classmethod
+    def from_path(cls, path: str) -> "DocumentBuffer":
+        return cls(os.path.basename(path), path=path)
+
+    @classmethod
+    def wrap(cls, document: "DocumentBuffer | io.BytesIO | str") -> "DocumentBuffer":
+        if isinstance(document, DocumentBuffer):
+            return document
+        if isinstance(document, str):
+            return cls.from_path(document)
+
+        name = getattr(document, "name", None) or "document.pdf"
+        if isinstance(document, io.BytesIO):
+            return cls(name, data=document.getvalue())
+
+        document.seek(0)
+        return cls.from_stream(document, name)
+
+    @classmethod
+    @contextmanager
+    def wrapped(
+        cls, document: "DocumentBuffer | io.BytesIO | str"
+    ) -> Iterator["DocumentBuffer"]:
+        """`wrap` for the duration of a block, closing the buffer if it made one"""
+        buffer = cls.wrap(document)
+        try:
+            yield buffer
+        finally:
+            # ? A buffer passed in belongs to the caller, who closes it
+            if buffer is not document:
+                buffer.close()
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path
+
+    @property
+    def size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        return os.path.getsize(self._path)
+
+    def view(self) -> memoryview:
+        if self._data is not None:
+            return memoryview(self._data)
+
+        if self._mmap is None:
+            if self.size == 0:
+                return memoryview(b"")
+            with open(self._path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return memoryview(self._mmap)
+
+    def open_pdf(self) -> pymupdf.Document:
+        if self._path is not None:
+            # ? pymupdf reads the file itself, nothing is copied into Python
+            return pymupdf.open(self._path)
+
+        return pymupdf.open(stream=self._data)
+
+    def close(self):
+        if self._mmap is not None:
+            # ? Raises BufferError while a view() is still held by a consumer
+            self._mmap.close()
+            self._mmap = None
+        if self._owns_path and self._path is not None:
+            os.unlink(self._path)
+            self._path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,187 @@
+import fcntl
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+EMBEDDINGS_DIR = os.environ.get("EMBEDDINGS_DIR", ".cache/embeddings")
+FORMAT_VERSION = 2  # ? v2: vectors are L2-normalised
+
+# ? Rewrite the vectors file once this fraction of its rows belong to deleted names
+COMPACT_RATIO = 0.25
+
+_thread_locks: Dict[Path, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _slug(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value).strip("_") or "_"
+
+
+@contextmanager
+def _store_lock(path: Path):
+    """Serialise writers across threads (in-process lock) and processes (lock file)."""
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+
+    # ? The kernel drops the flock when its holder dies, so no lock goes stale
+    with thread_lock, open(path / ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """
+    On-disk embeddings of Tally master names for one (company, model, master type).
+
+    `vectors.f32` is an append-only float32 matrix that is memory-mapped for reads,
+    `index.json` maps each name to its row. Only names missing from the index are
+    encoded; rows of deleted names are dropped from the index and reclaimed when
+    the file is compacted.
+    """
+
+    def __init__(
+        self,
+        company_name: str,
+        model_name: str,
+        master_type: str,
+        root: str | Path = EMBEDDINGS_DIR,
+    ):
+        self.model_name = model_name
+        self.path = (
+            Path(root) / _slug(company_name) / _slug(model_name) / _slug(master_type)
+        )
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.path / "index.json"
+        self.vectors_file = self.path / "vectors.f32"
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = None
+
+        if (
+            index is None
+            or index.get("version") != FORMAT_VERSION
+            or index.get("model") != self.model_name
+        ):
+            return {
+                "version": FORMAT_VERSION,
+                "model": self.model_name,
+                "dim": 0,
+                "count": 0,
+                "rows": {},
+            }
+        return index
+
+    def _write_index(self, index: dict):
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    def _open_vectors(self, index: dict) -> np.ndarray:
+        if index["count"] == 0:
+            return np.empty((0, index["dim"]), dtype=np.float32)
+
+        return np.memmap(
+            self.vectors_file,
+            dtype=np.float32,
+            mode="r",
+            shape=(index["count"], index["dim"]),
+        )
+
+    def _compact(self, index: dict):
+        vectors = self._open_vectors(index)
+        names = list(index["rows"])
+        kept = np.asarray(vectors[[index["rows"][name] for name in names]])
+
+        tmp_file = self.vectors_file.with_suffix(".tmp")
+        kept.tofile(tmp_file)
+        del vectors
+        os.replace(tmp_file, self.vectors_file)
+
+        index["rows"] = {name: row for row, name in enumerate(names)}
+        index["count"] = len(names)
+
+    def sync(
+        self, names: List[str], encode: Callable[[List[str]], np.ndarray]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Bring the store in line with `names` and return `(vectors, rows)`, where
+        `vectors[rows[i]]` is the embedding of `names[i]`. `vectors` is memory-mapped.
+
+        Missing names are encoded without holding the store lock, which is only
+        taken to read the index and to append the new rows.
+        """
+        wanted = list(dict.fromkeys(names))
+        encoded: Dict[str, np.ndarray] = {}
+
+        while True:
+            with _store_lock(self.path):
+                index = self._read_index()
+                missing = [
+                    name
+                    for name in wanted
+                    if name not in index["rows"] and name not in encoded
+                ]
+                if not missing:
+                    return self._apply(index, wanted, names, encoded)
+
+            # ? Another process may add some of them meanwhile, they're skipped then
+            vectors = np.ascontiguousarray(encode(missing), dtype=np.float32)
+            encoded.update(zip(missing, vectors))
+
+    def _apply(
+        self,
+        index: dict,
+        wanted: List[str],
+        names: List[str],
+        encoded: Dict[str, np.ndarray],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Append the encoded names still missing and drop unwanted ones, locked"""
+        rows: Dict[str, int] = index["rows"]
+
+        wanted_set = set(wanted)
+        removed = [name for name in rows if name not in wanted_set]
+        added = [name for name in wanted if name not in rows]
+
+        for name in removed:
+            del rows[name]
+
+        if added:
+            embeddings = np.stack([encoded[name] for name in added])
+            if index["count"] == 0:
+                index["dim"] = embeddings.shape[1]
+
+            with open(self.vectors_file, "ab") as f:
+                # ? Drop rows appended by a writer that died before saving the index
+                f.truncate(index["count"] * index["dim"] * 4)
+                embeddings.tofile(f)
+            for offset, name in enumerate(added):
+                rows[name] = index["count"] + offset
+            index["count"] += len(added)
+
+        if index["count"] - len(rows) > COMPACT_RATIO * index["count"]:
+            self._compact(index)
+
+        if added or removed:
+            self._write_index(index)
+            print(
+                f"Embedding store {self.path}: +{len(added)} -{len(removed)}, "
+                f"{len(index['rows'])} names"
+            )
+
+        vectors = self._open_vectors(index)
+        row_ids = np.array([index["rows"][name] for name in names], dtype=np.int64)
+        return vectors, row_ids
@@ -1,65 +1,348 @@
-from typing import List, Optional
-from sentence_transformers import SentenceTransformer
-import torch
+import logging
+import os
+import re
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+import numpy as np
 import pandas as pd
 
+from .embedding_store import EmbeddingStore
+from .metrics import metrics
+from .model_registry import get_embedding_model
 
-def find_closest_matches(
-    sentences: List[str] | pd.Series, choices: List[str]
-) -> List[Optional[str]]:
-    if isinstance(sentences, pd.Series):
-        sentences = sentences.tolist()
+MIN_SIMILARITY = 0.9
+
+logger = logging.getLogger(__name__)
+
+# ? Upper bound on the scratch memory used per block of the similarity search
+SIMILARITY_MEMORY_BUDGET = int(
+    os.environ.get("SIMILARITY_MEMORY_BUDGET", 64 * 1024 * 1024)
+)
+
+
+# ? Trigram (Dice) similarity a choice needs to make the embedding shortlist
+MIN_TRIGRAM_SIMILARITY = 0.3
+SHORTLIST_SIZE = 32
+# ? Best choices kept per name, offered as alternatives to the match
+CANDIDATES = 5
+
+
+class Candidate(NamedTuple):
+    name: str
+    score: float
+
+
+class MatchResult(NamedTuple):
+    name: str
+    match: Optional[str]
+    score: float
+    # ? One of "exact", "normalised", "shortlist", "full_scan", "unmatched"
+    stage: str
+    # ? Best choices by descending score, also when none was close enough to match
+    candidates: tuple[Candidate, ...] = ()
+
+
+def encode(texts: List[str]) -> np.ndarray:
+    """Encode to L2-normalised float32 embeddings, so a dot product is the cosine"""
+    with metrics.span("embed"):
+        return get_embedding_model().encode(
+            list(texts), convert_to_numpy=True, normalize_embeddings=True
+        )
+
+
+def top_k_similarities(
+    queries: np.ndarray,
+    choices: np.ndarray,
+    k: int = 5,
+    rows: Optional[np.ndarray] = None,
+    memory_budget: int = SIMILARITY_MEMORY_BUDGET,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cosine top-k of normalised `queries` (n, d) against normalised `choices`.
+    If `rows` is given, the candidates are `choices[rows]` and `choices` may be a
+    memory-map; blocks of rows are gathered one at a time instead of all at once.
+    Returns `(indices, scores)` of shape (n, k) sorted by descending score, with
+    indices into the candidate list.
+    """
+    num_queries, dim = queries.shape
+    num_choices = len(rows) if rows is not None else len(choices)
+    k = min(k, num_choices)
+
+    best_idx = np.empty((num_queries, 0), dtype=np.int64)
+    best_scores = np.empty((num_queries, 0), dtype=np.float32)
+    if k == 0:
+        return best_idx, best_scores
+
+    # ? Each block needs its gathered choices (b, d) and its scores (n, b)
+    block_size = max(k, memory_budget // (4 * (num_queries + dim)))
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    for start in range(0, num_choices, block_size):
+        stop = min(start + block_size, num_choices)
+        block = choices[rows[start:stop]] if rows is not None else choices[start:stop]
+        scores = queries @ np.asarray(block, dtype=np.float32).T  # (n, b)
+
+        block_idx = np.broadcast_to(np.arange(start, stop), scores.shape)
+        idx = np.concatenate([best_idx, block_idx], axis=1)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, keep, axis=1)
+            idx = np.take_along_axis(idx, keep, axis=1)
+        best_scores, best_idx = scores, idx
+
+    order = np.argsort(-best_scores, axis=1)
+    return (
+        np.take_along_axis(best_idx, order, axis=1),
+        np.take_along_axis(best_scores, order, axis=1),
+    )
+
+
+def find_top_matches(
+    sentences: List[str] | pd.Series,
+    choices: List[str],
+    k: int = 5,
+    choices_store: Optional[EmbeddingStore] = None,
+) -> List[List[Candidate]]:
+    """Best `k` choices for every sentence with their cosine similarity"""
+    sentences = list(sentences)
     if len(sentences) == 0:
         return []
     if len(choices) == 0:
-        return [None] * len(sentences)
+        return [[] for _ in sentences]
+
+    sentences_embeddings = encode(sentences)
+    if choices_store is not None:
+        # ? Only names added since the last request get encoded
+        vectors, rows = choices_store.sync(choices, encode)
+    else:
+        vectors, rows = encode(choices), None
+
+    indices, scores = top_k_similarities(sentences_embeddings, vectors, k, rows)
+
+    return [
+        [Candidate(choices[i], float(score)) for i, score in zip(row_idx, row_scores)]
+        for row_idx, row_scores in zip(indices, scores)
+    ]
+
+
+def normalize_name(name: str) -> str:
+    """Case, punctuation and whitespace insensitive key, e.g. 'PCS.' -> 'pcs'"""
+    return " ".join(re.sub(r"[^\w]+", " ", str(name).lower()).split())
+
+
+def trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
 
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = SentenceTransformer("all-mpnet-base-v2").to(device)
 
-        sentences_embeddings = model.encode(sentences, convert_to_tensor=True)
-        choices_embeddings = model.encode(choices, convert_to_tensor=True)
+class MasterMatcher:
+    """
+    Staged matcher of invoice names against Tally master names:
+    1. exact name, then normalised name (hash lookups)
+    2. character-trigram inverted index to shortlist similar names
+    3. embedding similarity over the shortlist only, or over every choice when
+       no name shares enough trigrams
+    Every result keeps the best `candidates` choices of the stage that decided it.
+    """
 
-        sentences_embeddings = sentences_embeddings.to(device)
-        choices_embeddings = choices_embeddings.to(device)
+    def __init__(
+        self,
+        choices: List[str],
+        choices_store: Optional[EmbeddingStore] = None,
+        shortlist_size: int = SHORTLIST_SIZE,
+        candidates: int = CANDIDATES,
+    ):
+        self.choices = list(choices)
+        self.choices_store = choices_store
+        self.shortlist_size = shortlist_size
+        self.candidates = candidates
 
-        # Calculate similarities between all sentences and choices
-        similarities = torch.cosine_similarity(
-            sentences_embeddings.unsqueeze(1),  # (num_sentences, 1, embedding_dim)
-            choices_embeddings.unsqueeze(0),  # (1, num_choices, embedding_dim)
-            dim=2,
-        )  # (num_sentences, num_choices)
+        self.exact = set(self.choices)
+        self.normalised: Dict[str, str] = {}
+        postings: Dict[str, List[int]] = {}
+        self.trigram_counts = np.zeros(len(self.choices), dtype=np.int32)
 
-        # Move to CPU for numpy operations
-        similarities = similarities.cpu().detach().numpy()
+        for idx, choice in enumerate(self.choices):
+            key = normalize_name(choice)
+            self.normalised.setdefault(key, choice)
+            grams = trigrams(key)
+            self.trigram_counts[idx] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(idx)
 
-        # Find best matches with probability threshold
-        min_similarity = 0.9
-        matches = []
+        self.postings = {
+            gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()
+        }
 
-        for similarity in similarities:
-            max_similarity_idx = similarity.argmax()
-            top_choice = choices[max_similarity_idx]
-            top_choice_prob = similarity[max_similarity_idx]
-            match = top_choice if top_choice_prob >= min_similarity else None
-            matches.append(match)
+    def shortlist(self, name: str) -> np.ndarray:
+        grams = trigrams(normalize_name(name))
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
 
-        return matches
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.choices))
+        dice = 2 * shared / (len(grams) + self.trigram_counts)
+        candidates = np.flatnonzero(dice >= MIN_TRIGRAM_SIMILARITY)
+        if len(candidates) > self.shortlist_size:
+            top = np.argpartition(-dice[candidates], self.shortlist_size - 1)
+            candidates = candidates[top[: self.shortlist_size]]
+
+        return candidates
+
+    def _choice_vectors(self, shortlists: List[np.ndarray]):
+        """Embeddings for every shortlisted choice, as (vectors, row per choice idx)"""
+        if self.choices_store is not None:
+            return self.choices_store.sync(self.choices, encode)
+
+        # ? Without a store, only encode the choices that made a shortlist
+        needed = np.unique(np.concatenate(shortlists))
+        rows = np.zeros(len(self.choices), dtype=np.int64)
+        rows[needed] = np.arange(len(needed))
+        return encode([self.choices[idx] for idx in needed]), rows
+
+    def match(self, names: List[str]) -> List[MatchResult]:
+        names = [str(name) for name in names]
+        results: List[Optional[MatchResult]] = [None] * len(names)
+
+        pending = []
+        for i, name in enumerate(names):
+            if name in self.exact:
+                results[i] = self._thresholded(name, [Candidate(name, 1.0)], "exact")
+            elif (key := normalize_name(name)) in self.normalised:
+                candidate = Candidate(self.normalised[key], 1.0)
+                results[i] = self._thresholded(name, [candidate], "normalised")
+            else:
+                pending.append(i)
+
+        if pending and self.choices:
+            shortlists = {i: self.shortlist(names[i]) for i in pending}
+            shortlisted = [i for i in pending if len(shortlists[i])]
+            unlisted = [i for i in pending if not len(shortlists[i])]
+
+            if shortlisted:
+                queries = encode([names[i] for i in shortlisted])
+                vectors, rows = self._choice_vectors(
+                    [shortlists[i] for i in shortlisted]
+                )
+                for query, i in zip(queries, shortlisted):
+                    ids = shortlists[i]
+                    scores = np.asarray(vectors[rows[ids]], dtype=np.float32) @ query
+                    best = np.argsort(-scores, kind="stable")[: self.candidates]
+                    candidates = [
+                        Candidate(self.choices[ids[j]], float(scores[j])) for j in best
+                    ]
+                    results[i] = self._thresholded(names[i], candidates, "shortlist")
+
+            if unlisted:
+                top_matches = find_top_matches(
+                    [names[i] for i in unlisted],
+                    self.choices,
+                    self.candidates,
+                    self.choices_store,
+                )
+                for i, candidates in zip(unlisted, top_matches):
+                    results[i] = self._thresholded(names[i], candidates, "full_scan")
+
+        return [
+            result or MatchResult(name, None, 0.0, "unmatched")
+            for name, result in zip(names, results)
+        ]
+
+    @staticmethod
+    def _thresholded(name: str, candidates: List[Candidate], stage: str) -> MatchResult:
+        """Result matched to the first (best) candidate if it scores high enough"""
+        best = candidates[0]
+        if best.score >= MIN_SIMILARITY:
+            return MatchResult(name, best.name, best.score, stage, tuple(candidates))
+        return MatchResult(name, None, best.score, "unmatched", tuple(candidates))
+
+
+def report_stages(results: List[MatchResult], label: str = "names"):
+    counts = Counter(result.stage for result in results)
+    for stage, count in counts.items():
+        metrics.inc("master_matches", count, stage=stage)
+    if logger.isEnabledFor(logging.DEBUG):
+        summary = ", ".join(
+            f"{stage}={count} ({count / len(results):.0%})"
+            for stage, count in counts.most_common()
+        )
+        logger.debug("Matched %d %s: %s", len(results), label, summary)
+
+
+def match_names(
+    sentences: List[str] | pd.Series,
+    choices: List[str],
+    choices_store: Optional[EmbeddingStore] = None,
+    label: str = "names",
+) -> List[MatchResult]:
+    sentences = list(sentences)
+    if len(sentences) == 0:
+        return []
+
+    results = MasterMatcher(choices, choices_store).match(sentences)
+    report_stages(results, label)
+
+    return results
+
+
+def find_closest_results(
+    sentences: List[str] | pd.Series,
+    choices: List[str],
+    choices_store: Optional[EmbeddingStore] = None,
+    label: str = "names",
+) -> List[MatchResult]:
+    """match_names, with every name unmatched if matching fails"""
+    sentences = list(sentences)
+
+    try:
+        return match_names(sentences, choices, choices_store, label)
 
     except Exception as e:
         print(f"Error in find_closest_matches: {str(e)}")
-        return [None] * len(sentences)
+        return [MatchResult(str(name), None, 0.0, "unmatched") for name in sentences]
+
+
+def find_closest_matches(
+    sentences: List[str] | pd.Series,
+    choices: List[str],
+    choices_store: Optional[EmbeddingStore] = None,
+    label: str = "names",
+) -> List[Optional[str]]:
+    results = find_closest_results(sentences, choices, choices_store, label)
+    return [result.match for result in results]
+
+
+def candidate_names(results: List[Optional[MatchResult]]) -> List[List[str]]:
+    """Names of each result's candidates, for a `[D] ... Candidates` column"""
+    return [
+        [candidate.name for candidate in result.candidates] if result else []
+        for result in results
+    ]
 
 
-def batch_match_column(df_col: pd.Series, choices: List[str]):
-    # Convert Series to list for batch processing
-    unique_units = df_col.dropna().unique()
+def batch_match_results(
+    df_col: pd.Series,
+    choices: List[str],
+    choices_store: Optional[EmbeddingStore] = None,
+    label: str = "names",
+) -> List[Optional[MatchResult]]:
+    """Match result of every value of the column (None if missing), values that
+    repeat are matched once"""
+    unique_values = df_col.dropna().unique()
+    unique_results = find_closest_results(unique_values, choices, choices_store, label)
+    mapping = dict(zip(map(str, unique_values), unique_results))
 
-    # Get matches for unique values
-    unique_matches = find_closest_matches(unique_units, choices)
-    unit_mapping = dict(zip(unique_units, unique_matches))
+    return [mapping.get(str(x)) if pd.notna(x) else None for x in df_col]
 
-    result = df_col.apply(lambda x: unit_mapping.get(str(x)) if pd.notna(x) else None)
 
-    return result
+def batch_match_column(
+    df_col: pd.Series,
+    choices: List[str],
+    choices_store: Optional[EmbeddingStore] = None,
+    label: str = "names",
+):
+    results = batch_match_results(df_col, choices, choices_store, label)
+    return pd.Series(
+        [result.match if result else None for result in results], index=df_col.index
+    )
@@ -0,0 +1,234 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+JOBS_DIR = os.environ.get("JOBS_DIR", ".cache/jobs")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# ? Queued + running jobs per process before new submissions are rejected
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 16))
+# ? Seconds a finished job's result is kept
+JOB_TTL = float(os.environ.get("JOB_TTL", 3600))
+# ? Seconds between sweeps for expired and orphaned job records
+JOB_PURGE_INTERVAL = float(os.environ.get("JOB_PURGE_INTERVAL", 60))
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+ORPHANED_ERROR = "The worker running this job exited before it finished"
+
+
+def process_start_time(pid: int) -> Optional[int]:
+    """Start time of a process in clock ticks since boot, None if it's gone"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # ? The command name in parentheses may contain spaces, fields follow it
+    return int(stat.rsplit(")", 1)[1].split()[19])
+
+
+def process_alive(pid: int, started_at: Optional[int]) -> bool:
+    """Whether `pid` still runs, and is the same process (pids get reused)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return started_at is None or process_start_time(pid) in (None, started_at)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Bounded pool running jobs in the background of the web process.
+
+    Job records are JSON files under `root`, so with several gunicorn workers any
+    of them can report the status of a job started by another. Records are
+    changed under a lock file shared by all workers, and name the process
+    running the job, so jobs of a worker that exited (e.g. recycled by
+    gunicorn) are reported as failed. Cancelling a job that already started
+    only discards its result, since a running LLM call cannot be interrupted.
+    """
+
+    def __init__(
+        self,
+        root: str | Path = JOBS_DIR,
+        workers: int = JOB_WORKERS,
+        max_pending: int = JOB_QUEUE_SIZE,
+        ttl: float = JOB_TTL,
+        purge_interval: float = JOB_PURGE_INTERVAL,
+    ):
+        # ? The directory is created by the first submit, not on import
+        self.root = Path(root)
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures: Dict[str, Future] = {}
+        # ? Reentrant: cancelling a queued future runs its done callback in place
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._started_at = process_start_time(self._pid)
+
+    @contextmanager
+    def _locked(self):
+        """Lock shared with every worker, held while a job record is rewritten"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.root / ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _record_path(self, job_id: str) -> Path:
+        return self.root / f"{job_id}.json"
+
+    def _read(self, job_id: str) -> Optional[dict]:
+        try:
+            with open(self._record_path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write(self, record: dict):
+        path = self._record_path(record["id"])
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def _update(self, job_id: str, **fields) -> dict:
+        with self._locked():
+            record = self._read(job_id) or {"id": job_id}
+            if record.get("status") == "cancelled":
+                return record
+            record.update(fields)
+            self._write(record)
+            return record
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        cleanup: Optional[Callable[[], None]] = None,
+    ) -> str:
+        """Queue `fn(*args)`, whose return value must be JSON serialisable"""
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull(f"{self.max_pending} jobs already pending")
+
+        if time.monotonic() - self._last_purge > self.purge_interval:
+            self.purge_expired()
+
+        # ? Forked workers inherit the queue, the owner is whoever submits
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._started_at = process_start_time(self._pid)
+
+        job_id = uuid.uuid4().hex
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._write(
+            {
+                "id": job_id,
+                "status": "queued",
+                "created_at": time.time(),
+                "owner_pid": self._pid,
+                "owner_started_at": self._started_at,
+            }
+        )
+
+        def done(_: Future):
+            self._slots.release()
+            with self._lock:
+                self._futures.pop(job_id, None)
+            if cleanup is not None:
+                cleanup()
+
+        with self._lock:
+            future = self._executor.submit(self._run, job_id, fn, args)
+            self._futures[job_id] = future
+        future.add_done_callback(done)
+
+        return job_id
+
+    def _run(self, job_id: str, fn: Callable[..., Any], args: tuple):
+        record = self._update(job_id, status="running", started_at=time.time())
+        if record["status"] == "cancelled":
+            return
+
+        try:
+            result = fn(*args)
+            self._update(job_id, status="done", result=result)
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            self._update(job_id, finished_at=time.time())
+
+    def _orphaned(self, record: dict) -> bool:
+        if record.get("status") in FINISHED_STATUSES or "owner_pid" not in record:
+            return False
+        return not process_alive(record["owner_pid"], record.get("owner_started_at"))
+
+    def _fail_orphan(self, job_id: str) -> Optional[dict]:
+        with self._locked():
+            record = self._read(job_id)
+            if record is not None and self._orphaned(record):
+                record.update(
+                    status="failed", error=ORPHANED_ERROR, finished_at=time.time()
+                )
+                self._write(record)
+            return record
+
+    def get(self, job_id: str) -> Optional[dict]:
+        record = self._read(job_id)
+        if record is not None and self._orphaned(record):
+            record = self._fail_orphan(job_id)
+        if record is not None and self._expired(record):
+            self._record_path(job_id).unlink(missing_ok=True)
+            return None
+        return record
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        with self._locked():
+            record = self._read(job_id)
+            if record is None or record["status"] in FINISHED_STATUSES:
+                return record
+
+            future = self._futures.get(job_id)
+            if future is not None:
+                future.cancel()
+
+            record.update(status="cancelled", finished_at=time.time())
+            self._write(record)
+            return record
+
+    def _expired(self, record: dict) -> bool:
+        finished_at = record.get("finished_at")
+        return finished_at is not None and time.time() - finished_at > self.ttl
+
+    def purge_expired(self):
+        """Fail jobs whose worker exited and delete expired records"""
+        self._last_purge = time.monotonic()
+        for path in self.root.glob("*.json"):
+            record = self._read(path.stem)
+            if record is not None and self._orphaned(record):
+                record = self._fail_orphan(path.stem)
+            if record is not None and self._expired(record):
+                path.unlink(missing_ok=True)
+
+
+# ? Singleton instance of JobQueue
+job_queue = JobQueue()
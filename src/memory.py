@@ -0,0 +1,61 @@
+import os
+from typing import Optional
+
+# ? Set by the gunicorn master before it forks the workers, see gunicorn.conf.py
+MASTER_PID_ENV = "GUNICORN_MASTER_PID"
+
+SMAPS_FIELDS = (
+    "Rss",
+    "Pss",
+    "Shared_Clean",
+    "Shared_Dirty",
+    "Private_Clean",
+    "Private_Dirty",
+)
+
+
+def process_memory(pid: int) -> Optional[dict]:
+    """Resident memory of a process in kB, split into shared and private pages"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    memory = {"pid": pid}
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key in SMAPS_FIELDS:
+            memory[key.lower() + "_kb"] = int(value.split()[0])
+
+    return memory
+
+
+def child_pids(pid: int) -> list[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def gunicorn_master_pid() -> Optional[int]:
+    """Pid of the gunicorn master of this worker, None outside gunicorn"""
+    pid = os.environ.get(MASTER_PID_ENV)
+    return int(pid) if pid else None
+
+
+def worker_memory_report(master_pid: int) -> dict:
+    """
+    Memory of the gunicorn master and each of its workers. Pages shared
+    copy-on-write with the master show up in `shared_*`, so `pss_kb` is each
+    process's fair share and `private_*` is what a worker added on its own.
+    """
+    workers = [process_memory(pid) for pid in child_pids(master_pid)]
+    workers = [worker for worker in workers if worker is not None]
+
+    return {
+        "master": process_memory(master_pid),
+        "workers": workers,
+        "total_pss_kb": sum(worker.get("pss_kb", 0) for worker in workers),
+    }
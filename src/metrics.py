@@ -0,0 +1,258 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+# ? Each process writes its metrics here, /metrics sums the files of every worker
+METRICS_DIR = os.environ.get("METRICS_DIR", ".cache/metrics")
+# ? Seconds between writes of a process's metrics file, by a background thread
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+METRICS_PREFIX = "entryzen"
+
+# ? Upper bounds in seconds, from a master lookup up to a long LLM call
+STAGE_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+
+# ? File the counts of exited workers are folded into, under its lock file
+RETIRED_FILE = "retired.json"
+RETIRED_LOCK_FILE = ".retired.lock"
+
+
+def label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_key(labels: Dict[str, str]) -> str:
+    """Labels in Prometheus form, e.g. `{kind="prompt"}`"""
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{label_value(value)}"' for name, value in sorted(labels.items())
+    )
+    return "{" + pairs + "}"
+
+
+def empty_snapshot() -> dict:
+    return {"histograms": {}, "counters": {}}
+
+
+def empty_histogram() -> dict:
+    # ? One count per bucket and one above the last bound, not cumulative
+    return {"buckets": [0] * (len(STAGE_BUCKETS) + 1), "sum": 0.0, "count": 0}
+
+
+def merge_snapshots(total: dict, snapshot: dict) -> dict:
+    """Add the counts of `snapshot` to `total` in place"""
+    for stage, histogram in snapshot.get("histograms", {}).items():
+        merged = total["histograms"].setdefault(stage, empty_histogram())
+        # ? Files written before the buckets changed are left out
+        if len(histogram["buckets"]) != len(merged["buckets"]):
+            continue
+        merged["buckets"] = [
+            a + b for a, b in zip(merged["buckets"], histogram["buckets"])
+        ]
+        merged["sum"] += histogram["sum"]
+        merged["count"] += histogram["count"]
+
+    for name, series in snapshot.get("counters", {}).items():
+        merged = total["counters"].setdefault(name, {})
+        for key, value in series.items():
+            merged[key] = merged.get(key, 0) + value
+
+    return total
+
+
+class Metrics:
+    """
+    Per-stage latency histograms and counters of one process.
+
+    Every process keeps its own counts and a background thread writes them to
+    `<root>/<pid>.json` every `flush_interval` seconds when they changed (and
+    once more at exit), so with several gunicorn workers `render` can sum all
+    of them into one Prometheus text page. Requests never wait for the write.
+    """
+
+    def __init__(
+        self,
+        root: str | Path = METRICS_DIR,
+        flush_interval: float = METRICS_FLUSH_INTERVAL,
+    ):
+        self.root = Path(root)
+        self.flush_interval = flush_interval
+        self._data = empty_snapshot()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pid = os.getpid()
+        # ? Threads don't survive fork, each process starts its own on first use
+        self._flusher_pid: Optional[int] = None
+
+    def _reset_after_fork(self):
+        # ? A forked worker starts with the master's counts, which aren't its own
+        if self._pid != os.getpid():
+            self._data = empty_snapshot()
+            self._dirty = False
+            self._pid = os.getpid()
+
+    def _changed(self):
+        """Mark the counts for the next flush, call with `_lock` held"""
+        self._dirty = True
+        if self._flusher_pid != self._pid:
+            self._flusher_pid = self._pid
+            threading.Thread(
+                target=self._flush_loop, name="metrics-flush", daemon=True
+            ).start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def observe(self, stage: str, seconds: float):
+        """Record one run of `stage` that took `seconds`"""
+        index = next(
+            (i for i, bound in enumerate(STAGE_BUCKETS) if seconds <= bound),
+            len(STAGE_BUCKETS),
+        )
+        with self._lock:
+            self._reset_after_fork()
+            histogram = self._data["histograms"].setdefault(stage, empty_histogram())
+            histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            self._changed()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        """Add `value` to counter `name`, e.g. inc("llm_tokens", 812, kind="prompt")"""
+        if not value:
+            return
+        key = label_key(labels)
+        with self._lock:
+            self._reset_after_fork()
+            series = self._data["counters"].setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._changed()
+
+    @contextmanager
+    def span(self, stage: str):
+        """
+        Time the block as one run of `stage`. Failures are timed too, and
+        counted in `stage_errors`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.inc("stage_errors", stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._reset_after_fork()
+            return json.loads(json.dumps(self._data))
+
+    def _path(self, pid: int) -> Path:
+        return self.root / f"{pid}.json"
+
+    def flush(self):
+        """Write this process's counts to its file, if they changed since the last"""
+        with self._lock:
+            self._reset_after_fork()
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = json.dumps(self._data)
+
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self._path(os.getpid())
+            tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}")
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write metrics to {self.root}: {e}")
+
+    def _read(self, path: Path) -> Optional[dict]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def collect(self) -> dict:
+        """Counts of every process writing to `root`, this one up to date"""
+        self.flush()
+        total = empty_snapshot()
+        for path in self.root.glob("*.json"):
+            snapshot = self._read(path)
+            if snapshot is not None:
+                merge_snapshots(total, snapshot)
+        return total
+
+    def retire(self, pid: int):
+        """
+        Fold the file of an exited worker into the retired counts, so recycled
+        workers don't leave a file each and their counts are not lost
+        """
+        path = self._path(pid)
+        retired_path = self.root / RETIRED_FILE
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / RETIRED_LOCK_FILE, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            snapshot = self._read(path)
+            if snapshot is None:
+                return
+
+            retired = self._read(retired_path) or empty_snapshot()
+            merge_snapshots(retired, snapshot)
+            tmp_path = retired_path.with_name(f".{RETIRED_FILE}.{os.getpid()}")
+            with open(tmp_path, "w") as f:
+                json.dump(retired, f)
+            os.replace(tmp_path, retired_path)
+            path.unlink(missing_ok=True)
+
+    def clear(self):
+        """Drop the files of a previous run, call before workers start"""
+        for path in self.root.glob("*.json"):
+            path.unlink(missing_ok=True)
+
+    def render(self) -> str:
+        """All processes' counts in the Prometheus text exposition format"""
+        data = self.collect()
+        name = f"{METRICS_PREFIX}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each pipeline stage.",
+            f"# TYPE {name} histogram",
+        ]
+        for stage, histogram in sorted(data["histograms"].items()):
+            labels = label_key({"stage": stage})[1:-1]
+            cumulative = 0
+            bounds = [*map(str, STAGE_BUCKETS), "+Inf"]
+            for bound, count in zip(bounds, histogram["buckets"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram['sum']}")
+            lines.append(f"{name}_count{{{labels}}} {histogram['count']}")
+
+        for counter, series in sorted(data["counters"].items()):
+            name = f"{METRICS_PREFIX}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                value = int(value) if value == int(value) else value
+                lines.append(f"{name}{key} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# ? Singleton instance of Metrics
+metrics = Metrics()
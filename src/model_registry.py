@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+DEFAULT_EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "all-mpnet-base-v2")
+DEFAULT_EMBEDDING_DEVICE = os.environ.get("EMBEDDING_DEVICE")  # ? None = auto
+# ? "<detection arch>,<recognition arch>" of the doctr OCR predictor
+DEFAULT_OCR_MODEL = os.environ.get("OCR_MODEL", "fast_base,crnn_vgg16_bn")
+DEFAULT_OCR_DEVICE = os.environ.get("OCR_DEVICE")
+MODEL_IDLE_TIMEOUT = float(os.environ.get("MODEL_IDLE_TIMEOUT", "0"))  # ? 0 = never
+
+ModelKey = Tuple[str, str, str]
+ModelLoader = Callable[[str, str], Any]
+
+
+def default_device() -> str:
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_sentence_transformer(name: str, device: str):
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name, device=device)
+
+
+def load_ocr_predictor(name: str, device: str):
+    from doctr.models import ocr_predictor
+
+    det_arch, reco_arch = name.split(",")
+    predictor = ocr_predictor(det_arch, reco_arch, pretrained=True)
+    if device.startswith("cuda"):
+        predictor = predictor.cuda()
+
+    return predictor.eval()
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models keyed by (kind, name, device).
+    Each model is loaded once per process; concurrent callers asking for a model
+    that is still loading wait on the same load instead of starting another one.
+    With `max_idle_seconds`, the first `get` in a process starts a daemon thread
+    unloading models unused for that long.
+    """
+
+    def __init__(self, max_idle_seconds: float = 0, reap_interval: float = 60.0):
+        self.max_idle_seconds = max_idle_seconds
+        self.reap_interval = reap_interval
+        self._loaders: Dict[str, ModelLoader] = {}
+        self._models: Dict[ModelKey, Any] = {}
+        self._last_used: Dict[ModelKey, float] = {}
+        self._key_locks: Dict[ModelKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+
+    def register_loader(self, kind: str, loader: ModelLoader):
+        with self._lock:
+            self._loaders[kind] = loader
+
+    def get(self, kind: str, name: str, device: Optional[str] = None):
+        key = (kind, name, device or default_device())
+
+        with self._lock:
+            self._start_reaper()
+            model = self._models.get(key)
+            if model is not None:
+                self._last_used[key] = time.monotonic()
+                return model
+            if kind not in self._loaders:
+                raise KeyError(f"No loader registered for model kind '{kind}'")
+            loader = self._loaders[kind]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # ? Load outside the registry lock so other models stay available
+        with key_lock:
+            with self._lock:
+                model = self._models.get(key)
+            if model is None:
+                start = time.perf_counter()
+                model = loader(key[1], key[2])
+                elapsed = time.perf_counter() - start
+                print(f"Loaded {kind} model '{key[1]}' on {key[2]} in {elapsed:.2f}s")
+
+            with self._lock:
+                self._models[key] = model
+                self._last_used[key] = time.monotonic()
+
+        return model
+
+    def loaded(self) -> list[ModelKey]:
+        with self._lock:
+            return list(self._models)
+
+    def unload(self, kind: str, name: str, device: Optional[str] = None):
+        key = (kind, name, device or default_device())
+        with self._lock:
+            model = self._models.pop(key, None)
+            self._last_used.pop(key, None)
+
+        if model is not None:
+            self._release(key, model)
+
+    def unload_idle(self, max_idle_seconds: float) -> list[ModelKey]:
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                key
+                for key, last_used in self._last_used.items()
+                if now - last_used > max_idle_seconds
+            ]
+            models = [(key, self._models.pop(key)) for key in idle]
+            for key in idle:
+                self._last_used.pop(key, None)
+
+        for key, model in models:
+            self._release(key, model)
+
+        return idle
+
+    def keep_loaded(self):
+        """
+        Never unload idle models, e.g. in a process whose forked workers share the
+        loaded weights copy-on-write. Forked workers inherit this.
+        """
+        with self._lock:
+            self.max_idle_seconds = 0
+
+    def _start_reaper(self):
+        # ? Threads don't survive fork, so each process starts its own reaper
+        if self.max_idle_seconds <= 0:
+            return
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+
+        def reap():
+            while self.max_idle_seconds > 0:
+                time.sleep(self.reap_interval)
+                self.unload_idle(self.max_idle_seconds)
+
+        self._reaper = threading.Thread(target=reap, name="model-reaper", daemon=True)
+        self._reaper.start()
+
+    def _release(self, key: ModelKey, model: Any):
+        del model
+        if key[2].startswith("cuda"):
+            import torch
+
+            torch.cuda.empty_cache()
+        print(f"Unloaded {key[0]} model '{key[1]}' from {key[2]}")
+
+
+# ? Singleton instance of ModelRegistry
+model_registry = ModelRegistry(MODEL_IDLE_TIMEOUT)
+model_registry.register_loader("sentence-transformer", load_sentence_transformer)
+model_registry.register_loader("ocr", load_ocr_predictor)
+
+
+def get_embedding_model(
+    name: str = DEFAULT_EMBEDDING_MODEL, device: Optional[str] = DEFAULT_EMBEDDING_DEVICE
+):
+    return model_registry.get("sentence-transformer", name, device)
+
+
+def get_ocr_predictor(
+    name: str = DEFAULT_OCR_MODEL, device: Optional[str] = DEFAULT_OCR_DEVICE
+):
+    return model_registry.get("ocr", name, device)
+
+
+def uses_cuda() -> bool:
+    devices = (DEFAULT_EMBEDDING_DEVICE, DEFAULT_OCR_DEVICE)
+    return any((device or default_device()).startswith("cuda") for device in devices)
+
+
+def warm_up_models(start_reaper: bool = True):
+    """
+    Load the default models up front, e.g. from a server start hook.
+    Only a process that forks workers (gunicorn master with preload) passes
+    `start_reaper=False`, so neither it nor its workers unload the shared weights.
+    """
+    if not start_reaper:
+        model_registry.keep_loaded()
+
+    get_embedding_model()
+    get_ocr_predictor()
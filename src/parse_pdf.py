@@ -1,13 +1,57 @@
 import pandas as pd
+import numpy as np
 import pymupdf
-from langchain_openai import ChatOpenAI
 import dotenv
+import csv
 import io
-from doctr.io import DocumentFile
-from doctr.models import ocr_predictor
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import cache
+from typing import Any, Iterator, Optional
+
+from .compact_text import compact_pages, count_tokens
+from .document_buffer import DocumentBuffer
+from .metrics import metrics
+from .model_registry import get_ocr_predictor
+from .result_cache import result_cache, result_cache_key
 
 dotenv.load_dotenv()
 
+LLM_MODEL = "gpt-4o"
+# ? Bump whenever create_prompt changes, so cached results are not reused
+PROMPT_VERSION = "3"
+
+# ? Invoices with more pages than this are parsed in page chunks, in parallel
+CHUNK_MIN_PAGES = int(os.environ.get("CHUNK_MIN_PAGES", 4))
+CHUNK_PAGES = int(os.environ.get("CHUNK_PAGES", 2))
+# ? Leading pages given to every chunk as context for the header fields
+CHUNK_CONTEXT_PAGES = 1
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 8))
+
+# ? Pages with less text than this in their text layer are OCRed
+OCR_MIN_TEXT_LENGTH = 5
+# ? Resolution scanned pages are rendered at for OCR
+OCR_DPI = 144
+
+logger = logging.getLogger(__name__)
+
+
+@cache
+def chat_model(stream_usage: bool = False):
+    """
+    The invoice parsing model, one client per process so its connections are
+    reused. langchain_openai is imported on first use, it is slow to import.
+    """
+    from langchain_openai import ChatOpenAI
+
+    # ? Without stream_usage the streamed chunks carry no token counts
+    return ChatOpenAI(
+        model=LLM_MODEL, temperature=0.2, top_p=0.2, stream_usage=stream_usage
+    )
+
 
 def is_journal_voucher(common_df: pd.DataFrame):
     return common_df["Voucher Type"].iloc[0] == "Journal"
@@ -79,12 +123,72 @@ def process_csv_string(csv_string: str):
     return common_df, item_df
 
 
-def extract_text_from_pdf_ocr(pdf_file: io.BytesIO | str) -> list[str]:
-    doc = DocumentFile.from_pdf(
-        pdf_file.read() if isinstance(pdf_file, io.BytesIO) else pdf_file
+class CsvRowParser:
+    """Split CSV text that arrives in chunks into complete rows, as soon as each ends"""
+
+    def __init__(self):
+        self._buffer = ""
+        self._scanned = 0
+        self._in_quotes = False
+
+    def feed(self, text: str) -> list[list[str]]:
+        self._buffer += text
+        rows = []
+
+        line_start = 0
+        for pos in range(self._scanned, len(self._buffer)):
+            char = self._buffer[pos]
+            if char == '"':
+                # ? Escaped quotes ("") toggle twice, so the state stays correct
+                self._in_quotes = not self._in_quotes
+            elif char == "\n" and not self._in_quotes:
+                rows.extend(self._parse_line(self._buffer[line_start:pos]))
+                line_start = pos + 1
+
+        self._buffer = self._buffer[line_start:]
+        self._scanned = len(self._buffer)
+        return rows
+
+    def close(self) -> list[list[str]]:
+        rows = self._parse_line(self._buffer)
+        self._buffer = ""
+        self._scanned = 0
+        return rows
+
+    @staticmethod
+    def _parse_line(line: str) -> list[list[str]]:
+        line = line.strip()
+        # ? Skip blank lines and the ```csv fences around the reply
+        if not line or line.startswith("```"):
+            return []
+        return list(csv.reader([line]))
+
+
+def parse_csv_value(value: str) -> Optional[str]:
+    """
+    A cell of a streamed row, as the invoice shows it ("00123" stays a code).
+    Typed values come with the final result, once the whole table is parsed.
+    """
+    return value if value != "" else None
+
+
+PdfInput = DocumentBuffer | io.BytesIO | str
+
+
+def render_page(page: pymupdf.Page) -> np.ndarray:
+    pixmap = page.get_pixmap(dpi=OCR_DPI, colorspace=pymupdf.csRGB, alpha=False)
+    return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(
+        pixmap.height, pixmap.width, 3
     )
-    predictor = ocr_predictor(pretrained=True)
-    result = predictor(doc)
+
+
+def ocr_images(images: list[np.ndarray]) -> list[str]:
+    """OCR all page images in one predictor call"""
+    if not images:
+        return []
+
+    with metrics.span("ocr"):
+        result = get_ocr_predictor()(images)
 
     # Extract text from OCR results
     pages = []
@@ -99,43 +203,323 @@ def extract_text_from_pdf_ocr(pdf_file: io.BytesIO | str) -> list[str]:
     return pages
 
 
-def extract_text_from_pdf(pdf_file: io.BytesIO | str) -> str:
-    """Extract text from PDF, using OCR if needed"""
+def extract_text_from_pdf_ocr(pdf_file: PdfInput) -> list[str]:
+    with DocumentBuffer.wrapped(pdf_file) as document, document.open_pdf() as doc:
+        images = [render_page(page) for page in doc]
 
-    if isinstance(pdf_file, str):
-        doc = pymupdf.open(pdf_file)
-    else:
-        doc = pymupdf.open(stream=pdf_file.read())
+    return ocr_images(images)
 
-    pages = []
-    needs_ocr = True
 
-    for page in doc:
-        text = page.get_text()
-        # Check if page has meaningful text (more than just whitespace)
-        if len(text.strip()) > 5:  # Adjust threshold as needed
-            needs_ocr = False
-        pages.append(text)
+def extract_pages_from_pdf(pdf_file: PdfInput) -> list[str]:
+    """Extract text per page, OCRing only the pages without a usable text layer"""
+
+    pages = []
+    ocr_page_numbers = []
+    ocr_page_images = []
+
+    with (
+        metrics.span("extract_text"),
+        DocumentBuffer.wrapped(pdf_file) as document,
+        document.open_pdf() as doc,
+    ):
+        for page in doc:
+            text = page.get_text()
+            # Check if page has meaningful text (more than just whitespace)
+            if len(text.strip()) <= OCR_MIN_TEXT_LENGTH:
+                ocr_page_numbers.append(page.number)
+                ocr_page_images.append(render_page(page))
+            pages.append(text)
+
+    # ? Batch every scanned page through the predictor, then restore page order
+    for page_number, text in zip(ocr_page_numbers, ocr_images(ocr_page_images)):
+        pages[page_number] = text
 
-    doc.close()
+    return pages
 
-    # If minimal text was found, use OCR
-    if needs_ocr:
-        pages = extract_text_from_pdf_ocr(pdf_file)
 
+def join_pages(pages: list[str]) -> str:
+    # ? The prompt tells the model pages are separated by 3 new lines
     return "\n\n\n".join(pages)
 
 
-def parse_pdf(company_name: str, pdf_file: io.BytesIO | str):
-    text = extract_text_from_pdf(pdf_file)
+def compact_invoice_pages(pages: list[str]) -> list[str]:
+    """Drop duplicate pages, repeated headers/footers and whitespace runs"""
+    with metrics.span("compact_text"):
+        compacted = compact_pages(pages)
+
+    tokens_before = count_tokens(join_pages(pages))
+    tokens_after = count_tokens(join_pages(compacted))
+    metrics.inc("invoice_text_tokens", tokens_before, stage="extracted")
+    metrics.inc("invoice_text_tokens", tokens_after, stage="compacted")
+    metrics.inc("invoice_pages", len(pages), stage="extracted")
+    metrics.inc("invoice_pages", len(compacted), stage="compacted")
+    logger.debug(
+        "Invoice text: %d -> %d tokens, %d -> %d pages",
+        tokens_before,
+        tokens_after,
+        len(pages),
+        len(compacted),
+    )
+
+    return compacted
+
+
+def extract_invoice_pages(pdf_file: PdfInput) -> list[str]:
+    """Extract the compacted invoice pages, ready for create_prompt"""
+    return compact_invoice_pages(extract_pages_from_pdf(pdf_file))
+
+
+def extract_text_from_pdf(pdf_file: PdfInput) -> str:
+    return join_pages(extract_invoice_pages(pdf_file))
 
-    llm = ChatOpenAI(model="gpt-4o", temperature=0.2, top_p=0.2)
-    prompt = create_prompt(company_name, text)
-    msg = llm.invoke(prompt)
+
+def create_chunk_prompt(
+    company_name: str, context_pages: list[str], pages: list[str], part: int, parts: int
+):
+    prompt = f"""{create_prompt(company_name, join_pages(pages))}
+
+This invoice is processed in {parts} parts and the text above is part {part} of {parts}.
+Still output Lines 1 to 3 as described, but only output the line items that appear in the text of this part.
+"""
+    if part == 1:
+        return prompt
+
+    return f"""{prompt}
+Take the header fields (Line 2) from the first page of the invoice, given below for reference only. Do not output line items from it unless they also appear in this part.
+{join_pages(context_pages)}
+"""
+
+
+def record_llm_usage(usage: Optional[dict]):
+    """Count an LLM call and its tokens, from the reply's `usage_metadata`"""
+    usage = usage or {}
+    metrics.inc("llm_calls", model=LLM_MODEL)
+    metrics.inc("llm_tokens", usage.get("input_tokens", 0), kind="prompt")
+    metrics.inc("llm_tokens", usage.get("output_tokens", 0), kind="completion")
+
+
+def parse_invoice_text(
+    company_name: str, text: str, llm_slots: Optional[threading.Semaphore] = None
+):
+    llm = chat_model()
+    with metrics.span("prompt_build"):
+        prompt = create_prompt(company_name, text)
+    with llm_slots or nullcontext(), metrics.span("llm"):
+        msg = llm.invoke(prompt)
+    record_llm_usage(getattr(msg, "usage_metadata", None))
     msg.pretty_print()
     print("ChatGPT Response Metadata:", msg.response_metadata)
 
-    common_df, items_df = process_csv_string(msg.content)
-    common_df["filename"] = pdf_file if isinstance(pdf_file, str) else pdf_file.name
+    return process_csv_string(msg.content)
+
+
+def row_keys(df: pd.DataFrame) -> list[tuple]:
+    """Rows of `df` as tuples that compare equal when values match, NaN included"""
+    values = df.to_numpy(dtype=object, copy=True)
+    values[pd.isna(values)] = None
+    return [tuple(row) for row in values]
+
+
+def common_prefix(a: list[tuple], b: list[tuple]) -> int:
+    count = 0
+    while count < min(len(a), len(b)) and a[count] == b[count]:
+        count += 1
+    return count
+
+
+def boundary_overlap(previous: list[tuple], rows: list[tuple]) -> int:
+    """Longest run at the start of `rows` that ends `previous`"""
+    for count in range(min(len(previous), len(rows)), 0, -1):
+        if previous[-count:] == rows[:count]:
+            return count
+    return 0
+
+
+def merge_chunk_results(results: list[tuple[pd.DataFrame, pd.DataFrame]]):
+    """
+    Header from the first chunk, items from all chunks in page order. Chunks only
+    overlap where they meet, so only leading rows of a chunk are dropped: those
+    repeating the context page (the first chunk's leading rows) or the end of the
+    previous chunk, e.g. an item on the page boundary read by both. Any other
+    repeat is a real item (the same product bought twice) and is kept.
+    """
+    common_df, items_df = results[0]
+    merged = [items_df]
+    first_rows = previous_rows = row_keys(items_df)
+
+    for _, chunk_items_df in results[1:]:
+        # ? Line items of another voucher type would not fit the first chunk's columns
+        chunk_items_df = chunk_items_df.reindex(columns=items_df.columns)
+        rows = row_keys(chunk_items_df)
+        skip = common_prefix(first_rows, rows)
+        skip += boundary_overlap(previous_rows, rows[skip:])
+        merged.append(chunk_items_df.iloc[skip:])
+        # ? An empty chunk doesn't separate its neighbours' boundary rows
+        previous_rows = rows if rows else previous_rows
+
+    return common_df, pd.concat(merged, ignore_index=True)
+
+
+def invoke_all(llm, prompts: list[str], llm_slots: Optional[threading.Semaphore]):
+    """Replies to `prompts` in order, calls running in parallel"""
+    if llm_slots is None:
+        return llm.batch(prompts, config={"max_concurrency": LLM_CONCURRENCY})
+
+    def invoke(prompt: str):
+        with llm_slots:
+            return llm.invoke(prompt)
+
+    with ThreadPoolExecutor(len(prompts), thread_name_prefix="llm-chunk") as pool:
+        return list(pool.map(invoke, prompts))
+
+
+def parse_invoice_pages(
+    company_name: str,
+    pages: list[str],
+    llm_slots: Optional[threading.Semaphore] = None,
+):
+    """
+    parse_invoice_text, split into parallel LLM calls over page groups for long
+    invoices. Every call holds one of `llm_slots` when given, so a caller parsing
+    many invoices at once caps the calls of all of them together; otherwise the
+    parts of one invoice run up to LLM_CONCURRENCY at a time.
+    """
+    if len(pages) <= CHUNK_MIN_PAGES:
+        return parse_invoice_text(company_name, join_pages(pages), llm_slots)
+
+    context_pages = pages[:CHUNK_CONTEXT_PAGES]
+    chunks = [pages[i : i + CHUNK_PAGES] for i in range(0, len(pages), CHUNK_PAGES)]
+    with metrics.span("prompt_build"):
+        prompts = [
+            create_chunk_prompt(company_name, context_pages, chunk, part, len(chunks))
+            for part, chunk in enumerate(chunks, start=1)
+        ]
+
+    llm = chat_model()
+    # ? One span for the whole batch, the parts run in parallel
+    with metrics.span("llm_batch"):
+        msgs = invoke_all(llm, prompts, llm_slots)
+    for part, msg in enumerate(msgs, start=1):
+        record_llm_usage(getattr(msg, "usage_metadata", None))
+        print(f"ChatGPT Response Metadata (part {part}):", msg.response_metadata)
+
+    return merge_chunk_results([process_csv_string(msg.content) for msg in msgs])
+
+
+def parse_pdf(company_name: str, pdf_file: PdfInput):
+    with DocumentBuffer.wrapped(pdf_file) as document:
+        pages = extract_invoice_pages(document)
+
+    common_df, items_df = parse_invoice_pages(company_name, pages)
+    common_df["filename"] = pdf_file if isinstance(pdf_file, str) else document.name
 
     return common_df, items_df
+
+
+def get_cached_result(company_name: str, document: DocumentBuffer):
+    """Result cache key of a document and its cached (common_df, items_df), if any"""
+    key = result_cache_key(document, company_name, PROMPT_VERSION, LLM_MODEL)
+    return key, result_cache.get(key)
+
+
+def cache_result(key: str, common_df: pd.DataFrame, items_df: pd.DataFrame):
+    result_cache.put(key, common_df.drop(columns="filename", errors="ignore"), items_df)
+
+
+def parse_pdf_cached(company_name: str, pdf_file: PdfInput):
+    """parse_pdf backed by the result cache, also returns whether it was a hit"""
+    with DocumentBuffer.wrapped(pdf_file) as document:
+        key, cached = get_cached_result(company_name, document)
+
+        metrics.inc("result_cache", result="miss" if cached is None else "hit")
+        if cached is not None:
+            common_df, items_df = cached
+            common_df["filename"] = (
+                pdf_file if isinstance(pdf_file, str) else document.name
+            )
+            return common_df, items_df, True
+
+        common_df, items_df = parse_pdf(company_name, document)
+        common_df["filename"] = pdf_file if isinstance(pdf_file, str) else document.name
+    cache_result(key, common_df, items_df)
+
+    return common_df, items_df, False
+
+
+def stream_invoice_text(company_name: str, text: str) -> Iterator[tuple[str, Any]]:
+    """
+    Like parse_invoice_text, but streams the reply and yields events as rows complete:
+    ("common", dict) once the header rows are in, ("item", dict) per line item, and
+    finally ("done", (common_df, items_df)) parsed from the full reply.
+    """
+    llm = chat_model(stream_usage=True)
+    with metrics.span("prompt_build"):
+        prompt = create_prompt(company_name, text)
+
+    parser = CsvRowParser()
+    content = []
+    common_header: Optional[list[str]] = None
+    items_header: Optional[list[str]] = None
+    row_count = 0
+
+    def handle(row: list[str]) -> Optional[tuple[str, Any]]:
+        nonlocal common_header, items_header, row_count
+        row_count += 1
+        if row_count == 1:
+            common_header = row
+        elif row_count == 2:
+            return "common", dict(zip(common_header, map(parse_csv_value, row)))
+        elif row_count == 3:
+            items_header = row
+        else:
+            return "item", dict(zip(items_header, map(parse_csv_value, row)))
+
+    usage: dict = {}
+    # ? Includes the time the consumer takes between chunks, usually negligible
+    with metrics.span("llm_stream"):
+        for chunk in llm.stream(prompt):
+            content.append(chunk.content)
+            for key, value in (getattr(chunk, "usage_metadata", None) or {}).items():
+                if isinstance(value, int):
+                    usage[key] = usage.get(key, 0) + value
+            for row in parser.feed(chunk.content):
+                if (event := handle(row)) is not None:
+                    yield event
+    record_llm_usage(usage)
+
+    for row in parser.close():
+        if (event := handle(row)) is not None:
+            yield event
+
+    yield "done", process_csv_string("".join(content))
+
+
+def stream_parse_pdf(company_name: str, pdf_file: PdfInput) -> Iterator[tuple[str, Any]]:
+    """
+    Streaming parse_pdf_cached: yields the events of stream_invoice_text, ending
+    with ("done", (common_df, items_df, cache_hit)). Cached results are replayed
+    row by row.
+    """
+    with DocumentBuffer.wrapped(pdf_file) as document:
+        filename = pdf_file if isinstance(pdf_file, str) else document.name
+        key, cached = get_cached_result(company_name, document)
+        if cached is None:
+            text = extract_text_from_pdf(document)
+
+    metrics.inc("result_cache", result="miss" if cached is None else "hit")
+    if cached is not None:
+        common_df, items_df = cached
+        for event, df in (("common", common_df), ("item", items_df)):
+            for row in df.astype(object).where(df.notna(), None).to_dict("records"):
+                yield event, row
+        common_df["filename"] = filename
+        yield "done", (common_df, items_df, True)
+        return
+
+    for event, data in stream_invoice_text(company_name, text):
+        if event == "done":
+            common_df, items_df = data
+            common_df["filename"] = filename
+            cache_result(key, common_df, items_df)
+            data = (common_df, items_df, False)
+        yield event, data
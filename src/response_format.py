@@ -0,0 +1,192 @@
+import json
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api import types
+
+from .batch import BatchResult
+
+JSON_MIME = "application/json"
+# ? Arrow IPC stream, for clients that load large batch results into a dataframe
+ARROW_STREAM_MIME = "application/vnd.apache.arrow.stream"
+RESPONSE_MIMES = (JSON_MIME, ARROW_STREAM_MIME)
+
+# ? `columns` is one array per column (the default, smaller), `records` one
+# ? object per row
+ORIENTS = ("columns", "records")
+# ? Prefix of the header (common_df) columns repeated on every Arrow row
+PRIMARY_PREFIX = "primary."
+
+# ? infer_dtype kinds of object columns holding only numbers, e.g. [1, 1.5]
+NUMBER_KINDS = ("integer", "floating", "mixed-integer-float", "decimal")
+# ? infer_dtype kinds of object columns mixing text and numbers
+MIXED_KINDS = ("mixed", "mixed-integer")
+
+
+def column_type(series: pd.Series) -> str:
+    if types.is_bool_dtype(series):
+        return "boolean"
+    if types.is_integer_dtype(series):
+        return "integer"
+    if types.is_float_dtype(series):
+        return "number"
+    if types.is_datetime64_any_dtype(series):
+        return "datetime"
+    # ? Object columns are typed by their values, the LLM's CSV can leave numbers
+    # ? in an object column next to missing values
+    kind = types.infer_dtype(series, skipna=True)
+    if kind in NUMBER_KINDS:
+        return "number"
+    if kind == "boolean":
+        return "boolean"
+    return "string"
+
+
+def column_values(series: pd.Series) -> list:
+    """Plain Python values of a column, with None for missing values"""
+    if types.is_datetime64_any_dtype(series):
+        series = series.dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+    # ? Straight from numpy, pandas' where/astype cost more than the conversion
+    values = series.to_numpy()
+    if values.dtype.kind in "biu":
+        return values.tolist()
+    if values.dtype.kind == "f":
+        return np.where(np.isnan(values), None, values).tolist()
+
+    values = values.astype(object)
+    values[pd.isna(values)] = None
+    return values.tolist()
+
+
+def frame_json(df: pd.DataFrame, orient: str = "columns") -> tuple[list | dict, list]:
+    """The rows of `df` in `orient` form, and its schema (column names and types)"""
+    columns, schema = {}, []
+    for column, series in df.items():
+        columns[str(column)] = column_values(series)
+        schema.append({"name": str(column), "type": column_type(series)})
+
+    if orient == "columns":
+        return columns, schema
+    return [dict(zip(columns, row)) for row in zip(*columns.values())], schema
+
+
+def result_json(
+    common_df: pd.DataFrame,
+    items_df: pd.DataFrame,
+    cache_hit: bool,
+    orient: str = "columns",
+) -> dict:
+    """
+    One parsed invoice as a JSON-ready dict: `primary` holds the header fields
+    of its single row, `secondary` the line items in `orient` form, and
+    `schema` the column types of both. Numbers stay numbers, missing values
+    are null.
+    """
+    primary, primary_schema = frame_json(common_df.head(1), "records")
+    secondary, secondary_schema = frame_json(items_df, orient)
+    return {
+        "primary": primary[0] if primary else {},
+        "secondary": secondary,
+        "schema": {"primary": primary_schema, "secondary": secondary_schema},
+        "orient": orient,
+        "cache_hit": cache_hit,
+    }
+
+
+def dumps(payload) -> str:
+    # ? NaN and Infinity are not JSON, result_json already turned them into null
+    return json.dumps(payload, separators=(",", ":"), allow_nan=False)
+
+
+def single_row(items_df: pd.DataFrame) -> pd.DataFrame:
+    """`items_df`, or one row of nulls when it has no line items"""
+    return items_df if len(items_df) else pd.DataFrame(index=range(1))
+
+
+def results_frame(results: list[BatchResult]) -> pd.DataFrame:
+    """
+    Line items of all results, each with its document and header fields. An
+    invoice without line items gets one row of null items, so it still shows up.
+    """
+    if not results:
+        return pd.DataFrame()
+
+    headers = pd.concat(
+        [result.common_df.head(1) for result in results], ignore_index=True
+    ).drop(columns="filename", errors="ignore")
+    headers = headers.add_prefix(PRIMARY_PREFIX)
+    headers.insert(0, "document", [result.index for result in results])
+    headers.insert(1, "filename", [result.filename for result in results])
+    headers.insert(2, "cache_hit", [result.cache_hit for result in results])
+
+    # ? Concatenated once and repeated per item, building a frame per result
+    # ? costs more than the rest of the conversion
+    items = pd.concat(
+        [single_row(result.items_df) for result in results], ignore_index=True
+    )
+    item_counts = [max(len(result.items_df), 1) for result in results]
+    headers = headers.take(np.repeat(np.arange(len(results)), item_counts))
+    return pd.concat([headers.reset_index(drop=True), items], axis=1)
+
+
+def arrow_ipc(results: Iterable[BatchResult]) -> bytes:
+    """
+    Results as one Arrow IPC stream: a row per line item with `document`,
+    `filename`, `cache_hit` and the header fields prefixed `primary.`.
+    Invoices of different voucher types share the table, columns one type
+    lacks are null, as are the item columns of an invoice without items.
+    Failed documents are listed as JSON in the schema metadata under `errors`.
+    """
+    import pyarrow as pa
+
+    parsed, errors = [], []
+    for result in results:
+        if result.error is not None:
+            errors.append(
+                {
+                    "index": result.index,
+                    "filename": result.filename,
+                    "error": result.error,
+                }
+            )
+        else:
+            parsed.append(result)
+
+    df = results_frame(parsed)
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        kind = types.infer_dtype(df[column], skipna=True)
+        if kind in NUMBER_KINDS:
+            df[column] = pd.to_numeric(df[column])
+        elif kind in MIXED_KINDS:
+            # ? A column numeric in one invoice and text in another is text
+            df[column] = df[column].map(str, na_action="ignore").astype(object)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # ? Header fields and filenames repeat on every item of an invoice
+    repeated = [
+        index
+        for index, name in enumerate(table.column_names)
+        if name == "filename" or name.startswith(PRIMARY_PREFIX)
+    ]
+    for index in repeated:
+        field_type = table.schema.field(index).type
+        if pa.types.is_string(field_type) or pa.types.is_large_string(field_type):
+            column = table.column(index).dictionary_encode()
+            table = table.set_column(index, table.column_names[index], column)
+    table = table.replace_schema_metadata({"errors": json.dumps(errors)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def parse_orient(orient: Optional[str]) -> str:
+    orient = orient or "columns"
+    if orient not in ORIENTS:
+        raise ValueError(f"orient must be one of {', '.join(ORIENTS)}")
+    return orient
@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+
+from .document_buffer import DocumentBuffer
+
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", ".cache/results")
+RESULT_CACHE_MAX_BYTES = int(
+    os.environ.get("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+)
+
+logger = logging.getLogger(__name__)
+
+
+def result_cache_key(
+    document: DocumentBuffer, company_name: str, prompt_version: str, model: str
+) -> str:
+    digest = hashlib.sha256()
+    with document.view() as view:
+        digest.update(view)
+    for part in (company_name, prompt_version, model):
+        digest.update(b"\0" + part.encode())
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Parsed invoices on local disk, keyed by `result_cache_key`.
+    Each entry is a directory with `common.parquet` and `items.parquet`; the
+    directory mtime is bumped on every hit and the least recently used entries
+    are evicted once the cache grows past `max_bytes`. The directory is only
+    created by the first `put`.
+    """
+
+    def __init__(
+        self, root: str | Path = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+        entry = self.root / key
+        try:
+            common_df = pd.read_parquet(entry / "common.parquet")
+            items_df = pd.read_parquet(entry / "items.parquet")
+            os.utime(entry)
+        except pa.ArrowException as e:
+            # ? A truncated or corrupt entry is a miss, drop it so it gets rewritten
+            logger.warning("Dropping unreadable result cache entry %s: %s", key, e)
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        except (FileNotFoundError, OSError):
+            return None
+
+        return common_df, items_df
+
+    def put(self, key: str, common_df: pd.DataFrame, items_df: pd.DataFrame):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_entry = Path(tempfile.mkdtemp(dir=self.root, prefix=".tmp-"))
+        try:
+            common_df.to_parquet(tmp_entry / "common.parquet", compression="zstd")
+            items_df.to_parquet(tmp_entry / "items.parquet", compression="zstd")
+            os.replace(tmp_entry, self.root / key)
+        except pa.ArrowException as e:
+            # ? Columns Arrow cannot type only cost the cache, not the request
+            logger.warning("Not caching result %s: %s", key, e)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        except OSError:
+            # ? Another worker stored the same result first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        with self._evict_lock:
+            entries = []
+            for entry in self.root.iterdir():
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    size = sum(f.stat().st_size for f in entry.iterdir())
+                    entries.append((entry.stat().st_mtime, size, entry))
+                except FileNotFoundError:
+                    # ? Evicted by another worker meanwhile
+                    continue
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+# ? Singleton instance of ResultCache
+result_cache = ResultCache()
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+from src.metrics import metrics
+
+# ? Reads Tally serves at once, its HTTP server handles few requests in parallel
+TALLY_READ_CONCURRENCY = int(os.environ.get("TALLY_READ_CONCURRENCY", 3))
+
+
+def as_future(task, loop: asyncio.AbstractEventLoop) -> asyncio.Future:
+    """Wrap a .NET Task in an asyncio future resolved on `loop`"""
+    # ? The CLR is running by now, `task` came from a TallyConnector call
+    from System import Action  # type: ignore # noqa: E402
+
+    future = loop.create_future()
+
+    def resolve():
+        if future.cancelled():
+            return
+        if task.IsCanceled:
+            future.cancel()
+        elif task.IsFaulted:
+            error = task.Exception
+            future.set_exception(error.InnerException or error)
+        else:
+            # ? Task without a result (plain Task) has no Result attribute
+            future.set_result(getattr(task, "Result", None))
+
+    # ? Runs on a .NET thread pool thread, hand the result over to the loop
+    task.GetAwaiter().OnCompleted(Action(lambda: loop.call_soon_threadsafe(resolve)))
+    return future
+
+
+class ReadWriteLock:
+    """
+    Lets up to `max_readers` reads run together while writes run alone. A
+    waiting write holds back new reads so imports don't starve behind fetches.
+    """
+
+    def __init__(self, max_readers: int):
+        self.max_readers = max_readers
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        self._condition = asyncio.Condition()
+
+    def _can_read(self) -> bool:
+        return (
+            not self._writing
+            and not self._writers_waiting
+            and self._readers < self.max_readers
+        )
+
+    @asynccontextmanager
+    async def reading(self):
+        async with self._condition:
+            await self._condition.wait_for(self._can_read)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def writing(self):
+        async with self._condition:
+            self._writers_waiting += 1
+            try:
+                await self._condition.wait_for(
+                    lambda: not self._writing and not self._readers
+                )
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+def call_name(call: Callable[..., Any]) -> str:
+    """Name of a TallyConnector method for metrics, e.g. GetLedgersAsync"""
+    return getattr(call, "__name__", None) or type(call).__name__
+
+
+class TallyScheduler:
+    """
+    Runs TallyConnector calls on a background event loop.
+
+    Reads (fetching masters, AlterIDs) run concurrently up to
+    `max_readers`; writes (imports) run one at a time with no reads in flight,
+    since Tally locks the company while importing. Synchronous code uses the
+    `read`/`write`/`read_many` helpers, which block the calling thread only.
+    """
+
+    def __init__(self, max_readers: int = TALLY_READ_CONCURRENCY):
+        self.max_readers = max_readers
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[ReadWriteLock] = None
+        self._pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            # ? A loop thread started before a gunicorn fork doesn't exist in the worker
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="tally-loop", daemon=True
+                ).start()
+                self._lock = asyncio.run_coroutine_threadsafe(
+                    self._make_lock(), loop
+                ).result()
+                self._loop, self._pid = loop, os.getpid()
+
+            return self._loop
+
+    async def _make_lock(self) -> ReadWriteLock:
+        return ReadWriteLock(self.max_readers)
+
+    async def read_async(self, call: Callable[..., Any], *args) -> Any:
+        """Await `call(*args)`, a TallyConnector method returning a Task"""
+        queued_at = time.perf_counter()
+        async with self._lock.reading():
+            metrics.observe("tally_read_wait", time.perf_counter() - queued_at)
+            with metrics.span(f"tally_read.{call_name(call)}"):
+                return await as_future(call(*args), asyncio.get_running_loop())
+
+    async def write_async(self, call: Callable[..., Any], *args) -> Any:
+        queued_at = time.perf_counter()
+        async with self._lock.writing():
+            metrics.observe("tally_write_wait", time.perf_counter() - queued_at)
+            with metrics.span(f"tally_write.{call_name(call)}"):
+                return await as_future(call(*args), asyncio.get_running_loop())
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """Run a coroutine on the scheduler's loop and wait for its result"""
+        loop = self._ensure_loop()
+        if threading.current_thread().name == "tally-loop":
+            raise RuntimeError("TallyScheduler.run called from its own event loop")
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def read(self, call: Callable[..., Any], *args) -> Any:
+        return self.run(self.read_async(call, *args))
+
+    def write(self, call: Callable[..., Any], *args) -> Any:
+        return self.run(self.write_async(call, *args))
+
+    def read_many(self, *calls: tuple) -> list:
+        """Run several `(call, *args)` reads concurrently, results in order"""
+
+        async def gather():
+            return await asyncio.gather(
+                *(self.read_async(call, *args) for call, *args in calls)
+            )
+
+        return self.run(gather())
+
+
+# ? Singleton instance of TallyScheduler
+tally_scheduler = TallyScheduler()
@@ -1,9 +1,19 @@
 import pandas as pd
 from datetime import datetime
+from typing import Optional
 
 from src.parse_pdf import is_journal_voucher
+from src.tally_connector import (
+    MasterSnapshot,
+    get_tally_company,
+    gstin_index,
+    master_cache,
+)
 from .helpers import convert_to_tally_date
-from .loadclr import tally
+from .loadclr import load_runtime
+from .master_writer import IMPORTED_STATUSES, MasterResult, MasterWriter
+
+load_runtime()
 
 from System.Collections.Generic import List as CSList  # type: ignore # noqa: E402
 from TallyConnector.Core.Models import (  # type: ignore # noqa: E402
@@ -42,15 +52,23 @@ DEFAULT_LEDGER = {
 TALLY_NA = "\u0004 Not Applicable"
 
 
-def create_party_account(common_df: pd.DataFrame, ledger_names: list[str]):
+def create_party_account(
+    common_df: pd.DataFrame, snapshot: MasterSnapshot, writer: MasterWriter
+):
+    company_name = snapshot.company_name
     is_sales = common_df["Voucher Type"].iloc[0] == "Sales"
     perspective = "Customer" if is_sales else "Supplier"
+    gstin = common_df[f"{perspective} GSTIN"].iloc[0]
 
     party_account = common_df["[D] Party Account"].iloc[0]
+    if pd.isna(party_account):
+        # ? A ledger with this GSTIN may exist under another name
+        party_account = gstin_index.lookup(company_name, gstin)
     if pd.isna(party_account):
         party_account = common_df["Party Account"].iloc[0]
 
-    if party_account in ledger_names:
+    common_df.loc[0, "[D] Party Account"] = party_account
+    if snapshot.has("ledger", party_account):
         return
 
     ledger = Ledger()
@@ -59,7 +77,6 @@ def create_party_account(common_df: pd.DataFrame, ledger_names: list[str]):
     ledger.Group = "Sundry Debtors" if is_sales else "Sundry Creditors - Purchases"
 
     # Create a LedgerGSTRegistrationDetails object
-    gstin = common_df[f"{perspective} GSTIN"].iloc[0]
     if not pd.isna(gstin):
         gst_registration_details = LedgerGSTRegistrationDetails()
         gst_registration_details.GSTIN = common_df[f"{perspective} GSTIN"].iloc[0]
@@ -82,42 +99,36 @@ def create_party_account(common_df: pd.DataFrame, ledger_names: list[str]):
     ledger.LedgerMailingDetails = CSList[LedgerMailingDetails]()
     ledger.LedgerMailingDetails.Add(mailing_details)
 
-    tally.PostLedgerAsync(ledger).Result
-    print(f"Created {perspective} Ledger with {ledger.Name}")
-
-    # ? Update ledger names
-    ledger_names.append(party_account)
-    common_df.loc[0, "[D] Party Account"] = party_account
+    writer.add("ledger", ledger)
 
 
-def create_units(items_df: pd.DataFrame):
-    units = tally.GetUnitsAsync[Unit]().Result
-    unit_names = [unit.Name for unit in units]
+def create_units(
+    items_df: pd.DataFrame, snapshot: MasterSnapshot, writer: MasterWriter
+):
     for idx, unit_name in enumerate(items_df["[D] Units"]):
         if pd.isna(unit_name):
             unit_name = items_df["Quantity Unit"].iloc[idx]
             items_df.loc[idx, "[D] Units"] = unit_name
 
-        if unit_name in unit_names:
+        if snapshot.has("unit", unit_name) or writer.pending("unit", unit_name):
             continue
 
         unit = Unit()
         unit.Name = unit_name
-        tally.PostUnitAsync[Unit](unit).Result
-        unit_names.append(unit_name)
-        print(f"Created Unit: {unit_name}")
-
-        items_df.loc[idx, "[D] Units"] = unit_name
+        writer.add("unit", unit)
 
 
-def create_stock_items(items_df: pd.DataFrame):
-    stock_items = tally.GetStockItemsAsync[StockItem]().Result
-    stock_item_names = [item.Name for item in stock_items]
+def create_stock_items(
+    items_df: pd.DataFrame, snapshot: MasterSnapshot, writer: MasterWriter
+):
     for idx, stock_item_name in enumerate(items_df["[D] Stock Item"]):
         if pd.isna(stock_item_name):
             stock_item_name = items_df["Product Name"].iloc[idx]
+            items_df.loc[idx, "[D] Stock Item"] = stock_item_name
 
-        if stock_item_name in stock_item_names:
+        if snapshot.has("stock_item", stock_item_name) or writer.pending(
+            "stock_item", stock_item_name
+        ):
             continue
 
         stock_item = StockItem()
@@ -160,65 +171,72 @@ def create_stock_items(items_df: pd.DataFrame):
             stock_item.GSTDetails.Add(gst_details)
 
         # Add gst rate and hsn code
-        tally.PostStockItemAsync[StockItem](stock_item).Result
-        stock_item_names.append(stock_item_name)
-        print(f"Created Stock Item: {stock_item_name}")
+        writer.add("stock_item", stock_item)
 
-        items_df.loc[idx, "[D] Stock Item"] = stock_item_name
 
+def post_masters(writer: MasterWriter) -> list[MasterResult]:
+    """Post the collected masters and record the ones Tally accepted in the cache"""
+    results = writer.post()
+    for result in results:
+        if result.status in IMPORTED_STATUSES:
+            master = writer.get(result.master_type, result.name)
+            master_cache.record(writer.company_name, result.master_type, master)
 
-def create_masters_sales_purchase(common_df: pd.DataFrame, items_df: pd.DataFrame):
-    ledgers = tally.GetLedgersAsync[Ledger]().Result
-    ledger_names = [ledger.Name for ledger in ledgers]
+    return results
+
+
+def create_masters_sales_purchase(
+    common_df: pd.DataFrame, items_df: pd.DataFrame, company_name: str
+):
+    snapshot = master_cache.get(company_name)
+    writer = MasterWriter(snapshot.company_name)
 
     # ? Create ledgers
-    create_party_account(common_df, ledger_names)
+    create_party_account(common_df, snapshot, writer)
 
     voucher_type = common_df["Voucher Type"].iloc[0]
     other_ledger = DEFAULT_LEDGER[voucher_type]
     # ? Create default ledgers
-    if other_ledger["Name"] not in ledger_names:
+    if not snapshot.has("ledger", other_ledger["Name"]):
         ledger = Ledger()
         ledger.Name = other_ledger["Name"]
         ledger.Group = other_ledger["Group"]
-        tally.PostLedgerAsync[Ledger](ledger).Result
-
-        # ? Update ledger names
-        ledger_names.append(ledger.Name)
-        print(f"Created {voucher_type} Ledger with {ledger.Name}")
+        writer.add("ledger", ledger)
 
     # ? Create IGST ledger
-    if "IGST" not in ledger_names:
+    if not snapshot.has("ledger", DEFAULT_LEDGER["Tax"]["Name"]):
         ledger = Ledger()
         ledger.Name = DEFAULT_LEDGER["Tax"]["Name"]
         ledger.Group = DEFAULT_LEDGER["Tax"]["Group"]
         ledger.TaxType = TaxType.GST
         ledger.GSTTaxType = "IGST"
-        tally.PostLedgerAsync[Ledger](ledger).Result
-
-        # ? Update ledger names
-        ledger_names.append(ledger.Name)
-        print("Created IGST Ledger")
+        writer.add("ledger", ledger)
 
     # ? Create units
-    create_units(items_df)
+    create_units(items_df, snapshot, writer)
 
     # ? Create stock items
-    create_stock_items(items_df)
+    create_stock_items(items_df, snapshot, writer)
 
+    # ? Units are imported before the stock items that use them
+    return post_masters(writer)
 
-def create_masters_journal(ledgers_df: pd.DataFrame):
-    ledgers = tally.GetLedgersAsync[Ledger]().Result
-    ledger_names = [ledger.Name for ledger in ledgers]
 
-    for _, item in ledgers_df.iterrows():
+def create_masters_journal(ledgers_df: pd.DataFrame, company_name: str):
+    snapshot = master_cache.get(company_name)
+    company_name = snapshot.company_name
+    writer = MasterWriter(company_name)
+
+    for idx, item in ledgers_df.iterrows():
         ledger_name = item["[D] Account Name"]
+        if pd.isna(ledger_name):
+            ledger_name = gstin_index.lookup(company_name, item["Account GSTIN"])
         if pd.isna(ledger_name):
             ledger_name = item["Account Name"]
-            item["[D] Account Name"] = ledger_name
+        ledgers_df.loc[idx, "[D] Account Name"] = ledger_name
 
-        if ledger_name in ledger_names:
-            return
+        if snapshot.has("ledger", ledger_name) or writer.pending("ledger", ledger_name):
+            continue
 
         ledger = Ledger()
         ledger.Name = ledger_name
@@ -246,15 +264,20 @@ def create_masters_journal(ledgers_df: pd.DataFrame):
         ledger.LedgerMailingDetails = CSList[LedgerMailingDetails]()
         ledger.LedgerMailingDetails.Add(mailing_details)
 
-        tally.PostLedgerAsync[Ledger](ledger).Result
+        writer.add("ledger", ledger)
+
+    return post_masters(writer)
 
-        # ? Update ledger names
-        ledger_names.append(ledger_name)
-        print(f"Created Ledger: {ledger_name}")
 
+def create_masters(
+    common_df: pd.DataFrame,
+    items_df: pd.DataFrame,
+    company_name: Optional[str] = None,
+) -> list[MasterResult]:
+    if company_name is None:
+        company_name = get_tally_company()
 
-def create_masters(common_df: pd.DataFrame, items_df: pd.DataFrame):
     if is_journal_voucher(common_df):
-        create_masters_journal(items_df)
+        return create_masters_journal(items_df, company_name)
     else:
-        create_masters_sales_purchase(common_df, items_df)
+        return create_masters_sales_purchase(common_df, items_df, company_name)
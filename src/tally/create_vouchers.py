@@ -1,10 +1,21 @@
+import hashlib
+import json
+import os
+import threading
+import time
 import pandas as pd
 from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
 
 from src.parse_pdf import is_journal_voucher
-from .loadclr import tally
+from .loadclr import load_runtime, tally
+from .async_tally import tally_scheduler
 from .helpers import convert_to_tally_date
 from .create_masters import DEFAULT_LEDGER
+from .master_writer import post_import, tally_xml
+
+load_runtime()
 
 from System import Decimal  # type: ignore # noqa: E402
 from System.Collections.Generic import List as CSList  # type: ignore # noqa: E402
@@ -25,7 +36,7 @@ def parse_amount(amount: str):
     return TallyAmount(Decimal(round(amount, 1)))
 
 
-def create_vouchers_journal(common_df: pd.DataFrame, ledgers_df: pd.DataFrame):
+def build_voucher_journal(common_df: pd.DataFrame, ledgers_df: pd.DataFrame):
     voucher_type = common_df["Voucher Type"].iloc[0]
 
     voucher = Voucher()
@@ -44,10 +55,10 @@ def create_vouchers_journal(common_df: pd.DataFrame, ledgers_df: pd.DataFrame):
 
         voucher.Ledgers.Add(ledger)
 
-    tally.PostVoucherAsync(voucher).Result
+    return voucher
 
 
-def create_vouchers_sales_purchase(common_df: pd.DataFrame, items_df: pd.DataFrame):
+def build_voucher_sales_purchase(common_df: pd.DataFrame, items_df: pd.DataFrame):
     multiplier = 1 if common_df["Voucher Type"].iloc[0] == "Sales" else -1
     voucher_type = common_df["Voucher Type"].iloc[0]
 
@@ -100,11 +111,195 @@ def create_vouchers_sales_purchase(common_df: pd.DataFrame, items_df: pd.DataFra
     # ledger_sgst.LedgerName = "SGST"
     # ledger_sgst.Amount = common_df["SGST"].iloc[0] * multiplier
 
-    tally.PostVoucherAsync(voucher).Result
+    return voucher
+
+
+def build_voucher(common_df: pd.DataFrame, items_df: pd.DataFrame):
+    if is_journal_voucher(common_df):
+        return build_voucher_journal(common_df, items_df)
+    else:
+        return build_voucher_sales_purchase(common_df, items_df)
 
 
 def create_vouchers(common_df: pd.DataFrame, items_df: pd.DataFrame):
+    voucher = build_voucher(common_df, items_df)
+    tally_scheduler.write(tally.PostVoucherAsync, voucher)
+
+
+EXPORT_LOG_DIR = os.environ.get("EXPORT_LOG_DIR", ".cache/exports")
+# ? Vouchers per import message
+VOUCHER_BATCH_SIZE = int(os.environ.get("VOUCHER_BATCH_SIZE", 50))
+
+
+class Invoice(NamedTuple):
+    # ? Where the invoice came from, e.g. the uploaded file name
+    source: str
+    common_df: pd.DataFrame
+    items_df: pd.DataFrame
+
+
+class VoucherResult(NamedTuple):
+    source: str
+    key: str
+    # ? exported, skipped (already exported) or error
+    status: str
+    error: Optional[str] = None
+
+
+def voucher_key(
+    company_name: str, common_df: pd.DataFrame, items_df: pd.DataFrame
+) -> str:
+    """
+    Stable id of the voucher an invoice turns into. It is sent as the voucher's
+    REMOTEID, so importing the same invoice again alters it instead of adding a
+    duplicate.
+    """
+    common = common_df.iloc[0]
     if is_journal_voucher(common_df):
-        create_vouchers_journal(common_df, items_df)
+        entries = items_df[["Account Name", "Debit Amount", "Credit Amount"]]
+        parts = [common["Voucher Date"], common["Narration"], entries.to_csv(index=False)]
     else:
-        create_vouchers_sales_purchase(common_df, items_df)
+        parts = [
+            common["[D] Party Account"],
+            common["Document Number"],
+            common["Document Date"],
+        ]
+
+    digest = hashlib.sha256(company_name.encode())
+    for part in [common["Voucher Type"], *parts]:
+        digest.update(b"\0" + str(part).encode())
+
+    return f"entryzen-{digest.hexdigest()[:32]}"
+
+
+class ExportLog:
+    """Append-only record of the vouchers each company already has, by `voucher_key`"""
+
+    def __init__(self, root: str | Path = EXPORT_LOG_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, company_name: str) -> Path:
+        digest = hashlib.sha256(company_name.encode()).hexdigest()[:16]
+        return self.root / f"{digest}.jsonl"
+
+    def exported(self, company_name: str) -> set[str]:
+        try:
+            with open(self._path(company_name)) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return set()
+
+        keys = set()
+        for line in lines:
+            try:
+                keys.add(json.loads(line)["key"])
+            except (json.JSONDecodeError, KeyError):
+                # ? Torn last line from a crashed writer
+                continue
+        return keys
+
+    def record(self, company_name: str, results: Iterable[VoucherResult]):
+        lines = [
+            json.dumps({"key": r.key, "source": r.source, "exported_at": time.time()})
+            + "\n"
+            for r in results
+            if r.status == "exported"
+        ]
+        if not lines:
+            return
+
+        # ? One append per call, O_APPEND keeps lines from several workers whole
+        with self._lock, open(self._path(company_name), "a") as f:
+            f.write("".join(lines))
+
+
+# ? Singleton instance of ExportLog
+export_log = ExportLog()
+
+
+def post_voucher_chunk(
+    company_name: str, chunk: List[tuple[Invoice, str, object]]
+) -> List[VoucherResult]:
+    elements = [tally_xml(voucher) for _, _, voucher in chunk]
+
+    def post_one(invoice: Invoice, key: str, element: str) -> VoucherResult:
+        try:
+            response = post_import(company_name, [element], "Vouchers")
+        except Exception as e:
+            return VoucherResult(invoice.source, key, "error", str(e))
+        if response.errors:
+            error = "; ".join(response.line_errors) or "Rejected by Tally"
+            return VoucherResult(invoice.source, key, "error", error)
+        return VoucherResult(invoice.source, key, "exported")
+
+    if len(chunk) == 1:
+        invoice, key, _ = chunk[0]
+        return [post_one(invoice, key, elements[0])]
+
+    try:
+        response = post_import(company_name, elements, "Vouchers")
+        imported = response.created + response.altered
+        if not response.errors and imported == len(chunk):
+            return [
+                VoucherResult(invoice.source, key, "exported")
+                for invoice, key, _ in chunk
+            ]
+    except Exception as e:
+        print(f"Importing {len(chunk)} vouchers failed: {e}")
+
+    # ? Tally only reports counts per message, re-send one by one to tell which
+    # ? failed; vouchers the message did import are altered in place by REMOTEID
+    return [
+        post_one(invoice, key, element)
+        for (invoice, key, _), element in zip(chunk, elements)
+    ]
+
+
+def export_vouchers(
+    company_name: str,
+    invoices: Iterable[Invoice],
+    chunk_size: int = VOUCHER_BATCH_SIZE,
+    export_log: ExportLog = export_log,
+) -> List[VoucherResult]:
+    """
+    Post many invoices as vouchers in import messages of `chunk_size`, one result
+    per invoice in input order. Their masters must exist already (see
+    `create_masters`). Invoices `export_log` has seen before are skipped, so a
+    failed export can simply be run again.
+    """
+    exported = export_log.exported(company_name)
+    results: Dict[int, VoucherResult] = {}
+    pending: List[tuple[int, Invoice, str, object]] = []
+
+    invoices = list(invoices)
+    for index, invoice in enumerate(invoices):
+        key = ""
+        try:
+            key = voucher_key(company_name, invoice.common_df, invoice.items_df)
+            if key in exported:
+                results[index] = VoucherResult(invoice.source, key, "skipped")
+                continue
+
+            voucher = build_voucher(invoice.common_df, invoice.items_df)
+            voucher.RemoteId = key
+            pending.append((index, invoice, key, voucher))
+            # ? The same invoice twice in one batch is exported once
+            exported.add(key)
+        except Exception as e:
+            results[index] = VoucherResult(invoice.source, key, "error", str(e))
+
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start : start + chunk_size]
+        chunk_results = post_voucher_chunk(
+            company_name, [(invoice, key, voucher) for _, invoice, key, voucher in chunk]
+        )
+        export_log.record(company_name, chunk_results)
+        for (index, *_), result in zip(chunk, chunk_results):
+            results[index] = result
+
+    exported_count = sum(result.status == "exported" for result in results.values())
+    print(f"Exported {exported_count} of {len(invoices)} vouchers to '{company_name}'")
+
+    return [results[index] for index in range(len(invoices))]
@@ -1,4 +1,9 @@
 from datetime import datetime
+
+from .loadclr import load_runtime
+
+load_runtime()
+
 from System import DateTime  # type: ignore # noqa: E402
 from TallyConnector.Core.Converters.XMLConverterHelpers import TallyDate  # type: ignore # noqa: E402
 
@@ -1,14 +1,54 @@
+import os
 import sys
-from pythonnet import load
+import threading
+from functools import cache
 
-load("coreclr")
+# ? Where Tally (or the simulator in benchmarks/) listens for XML requests
+TALLY_URL = os.environ.get("TALLY_URL", "http://localhost")
+TALLY_PORT = int(os.environ.get("TALLY_PORT", 9000))
 
-import clr  # noqa: E402
 
-sys.path.append("./TallyConnector")
-clr.AddReference("TallyConnector")
+@cache
+def load_runtime():
+    """
+    Start CoreCLR and load the TallyConnector assembly, once per process.
+    Modules that import .NET types (System, TallyConnector) at the top call
+    this first; everything else waits until Tally is actually used.
+    """
+    from pythonnet import load
+
+    load("coreclr")
+
+    import clr
+
+    sys.path.append("./TallyConnector")
+    clr.AddReference("TallyConnector")
+
+
+class LazyTallyService:
+    """
+    TallyService created on first attribute access, so importing a module
+    that talks to Tally doesn't start the CLR until a request needs it.
+    """
+
+    def __init__(self):
+        self._service = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._service is None:
+                load_runtime()
+                from TallyConnector.Services import TallyService  # type: ignore # noqa: E402
+
+                service = TallyService()
+                service.Setup(TALLY_URL, TALLY_PORT)
+                self._service = service
+            return self._service
+
+    def __getattr__(self, name: str):
+        return getattr(self._get(), name)
 
-from TallyConnector.Services import TallyService  # type: ignore # noqa: E402
 
 # ? Singleton instance of TallyService
-tally = TallyService()
+tally = LazyTallyService()
@@ -0,0 +1,232 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, NamedTuple, Optional
+from xml.sax.saxutils import escape
+
+from src.metrics import metrics
+from .loadclr import load_runtime, tally
+from .async_tally import tally_scheduler
+
+load_runtime()
+
+import clr  # noqa: E402
+
+clr.AddReference("System.Xml.XmlSerializer")
+
+from System.IO import StringWriter  # type: ignore # noqa: E402
+from System.Xml import XmlWriter, XmlWriterSettings  # type: ignore # noqa: E402
+from System.Xml.Serialization import XmlSerializer, XmlSerializerNamespaces  # type: ignore # noqa: E402
+
+# ? Masters per import message, Tally slows down sharply on very large imports
+MASTER_BATCH_SIZE = int(os.environ.get("MASTER_BATCH_SIZE", 100))
+
+# ? Import order, a stock item can only be created once its unit exists
+MASTER_ORDER = ("unit", "ledger", "stock_item")
+# ? Statuses of masters that exist in Tally after the import
+IMPORTED_STATUSES = ("created", "altered", "imported")
+
+logger = logging.getLogger(__name__)
+
+
+class MasterResult(NamedTuple):
+    master_type: str
+    name: str
+    # ? created, altered, imported (a message both created and altered masters,
+    # ? Tally doesn't say which), ignored (Tally took neither action) or error
+    status: str
+    error: Optional[str] = None
+
+
+class ImportResponse(NamedTuple):
+    created: int
+    altered: int
+    errors: int
+    line_errors: List[str]
+
+
+_serializers: Dict[str, XmlSerializer] = {}
+
+
+def tally_xml(tally_object) -> str:
+    """Serialise a TallyConnector master or voucher into its import element"""
+    tally_object.PrepareForExport()
+
+    object_class = tally_object.GetType()
+    serializer = _serializers.get(object_class.FullName)
+    if serializer is None:
+        serializer = _serializers[object_class.FullName] = XmlSerializer(object_class)
+
+    settings = XmlWriterSettings()
+    settings.OmitXmlDeclaration = True
+    namespaces = XmlSerializerNamespaces()
+    namespaces.Add("", "")
+
+    output = StringWriter()
+    writer = XmlWriter.Create(output, settings)
+    try:
+        serializer.Serialize(writer, tally_object, namespaces)
+        writer.Flush()
+    finally:
+        writer.Dispose()
+
+    return output.ToString()
+
+
+def import_envelope(
+    company_name: str, elements: List[str], report: str = "All Masters"
+) -> str:
+    messages = "".join(
+        f'<TALLYMESSAGE xmlns:UDF="TallyUDF">{element}</TALLYMESSAGE>'
+        for element in elements
+    )
+    return (
+        "<ENVELOPE><HEADER><VERSION>1</VERSION><TALLYREQUEST>Import</TALLYREQUEST>"
+        f"<TYPE>Data</TYPE><ID>{report}</ID></HEADER><BODY><DESC><STATICVARIABLES>"
+        f"<SVCURRENTCOMPANY>{escape(company_name)}</SVCURRENTCOMPANY>"
+        f"</STATICVARIABLES></DESC><DATA>{messages}</DATA></BODY></ENVELOPE>"
+    )
+
+
+def parse_import_response(response: Optional[str]) -> ImportResponse:
+    if not response:
+        return ImportResponse(0, 0, 1, ["Empty response from Tally"])
+
+    try:
+        root = ET.fromstring(response)
+    except ET.ParseError as e:
+        return ImportResponse(0, 0, 1, [f"Unreadable response from Tally: {e}"])
+
+    def count(tag: str) -> int:
+        element = root.find(f".//{tag}")
+        return int(element.text or 0) if element is not None else 0
+
+    line_errors = [
+        element.text.strip() for element in root.iter("LINEERROR") if element.text
+    ]
+    # ? EXCEPTIONS counts objects Tally could not process, e.g. a missing parent
+    errors = max(count("ERRORS") + count("EXCEPTIONS"), len(line_errors))
+    return ImportResponse(count("CREATED"), count("ALTERED"), errors, line_errors)
+
+
+def post_import(
+    company_name: str, elements: List[str], report: str = "All Masters"
+) -> ImportResponse:
+    envelope = import_envelope(company_name, elements, report)
+    result = tally_scheduler.write(tally.SendRequestAsync, envelope)
+    response = parse_import_response(result.Response)
+
+    metrics.inc("tally_imported", response.created, report=report, result="created")
+    metrics.inc("tally_imported", response.altered, report=report, result="altered")
+    metrics.inc("tally_imported", response.errors, report=report, result="error")
+    return response
+
+
+class MasterWriter:
+    """
+    Collects the masters an invoice needs and posts them to Tally in a few
+    import messages instead of one request per master.
+
+    Messages are sent in `MASTER_ORDER`, at most `batch_size` masters each.
+    Tally only reports counts for a message, so when one comes back with
+    errors its masters are re-sent one by one to tell which of them failed.
+    Whether a master was created or altered also comes from those counts, a
+    master missing from a stale snapshot may already exist in Tally.
+    """
+
+    def __init__(self, company_name: str, batch_size: int = MASTER_BATCH_SIZE):
+        self.company_name = company_name
+        self.batch_size = batch_size
+        self._pending: Dict[str, Dict[str, object]] = {
+            master_type: {} for master_type in MASTER_ORDER
+        }
+
+    def add(self, master_type: str, master):
+        self._pending[master_type][master.Name] = master
+
+    def pending(self, master_type: str, name: str) -> bool:
+        return name in self._pending[master_type]
+
+    def get(self, master_type: str, name: str):
+        return self._pending[master_type].get(name)
+
+    def collected(self) -> Iterator[tuple[str, object]]:
+        """`(master_type, master)` of every collected master, in import order"""
+        for master_type in MASTER_ORDER:
+            for master in self._pending[master_type].values():
+                yield master_type, master
+
+    @staticmethod
+    def _status(response: ImportResponse) -> str:
+        if response.errors:
+            return "error"
+        if response.created and response.altered:
+            return "imported"
+        if response.created:
+            return "created"
+        return "altered" if response.altered else "ignored"
+
+    def _post_one(self, master_type: str, name: str, element: str) -> MasterResult:
+        try:
+            response = post_import(self.company_name, [element])
+        except Exception as e:
+            return MasterResult(master_type, name, "error", str(e))
+
+        if response.errors:
+            error = "; ".join(response.line_errors) or "Rejected by Tally"
+            return MasterResult(master_type, name, "error", error)
+        # ? A master the failed message already imported comes back as altered
+        return MasterResult(master_type, name, self._status(response))
+
+    def _post_chunk(self, master_type: str, chunk: list) -> List[MasterResult]:
+        elements = [tally_xml(master) for master in chunk]
+        if len(chunk) == 1:
+            return [self._post_one(master_type, chunk[0].Name, elements[0])]
+
+        try:
+            response = post_import(self.company_name, elements)
+            imported = response.created + response.altered
+            if not response.errors and imported == len(chunk):
+                status = self._status(response)
+                return [
+                    MasterResult(master_type, master.Name, status) for master in chunk
+                ]
+        except Exception as e:
+            logger.warning(
+                "Importing %d %s masters failed: %s", len(chunk), master_type, e
+            )
+
+        # ? The rest of the message was imported, re-sending those only alters them
+        return [
+            self._post_one(master_type, master.Name, element)
+            for master, element in zip(chunk, elements)
+        ]
+
+    def post(self) -> List[MasterResult]:
+        """Post every collected master, in dependency order"""
+        results: List[MasterResult] = []
+        for master_type in MASTER_ORDER:
+            masters = list(self._pending[master_type].values())
+            for start in range(0, len(masters), self.batch_size):
+                chunk = masters[start : start + self.batch_size]
+                results.extend(self._post_chunk(master_type, chunk))
+
+        for result in results:
+            if result.status == "error":
+                logger.warning(
+                    "Could not create %s '%s': %s",
+                    result.master_type,
+                    result.name,
+                    result.error,
+                )
+            elif result.status == "ignored":
+                logger.warning("Tally ignored %s '%s'", result.master_type, result.name)
+            else:
+                logger.info(
+                    "%s %s: %s",
+                    result.status.capitalize(),
+                    result.master_type,
+                    result.name,
+                )
+
+        return results
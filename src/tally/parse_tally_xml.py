@@ -1,10 +1,97 @@
-import xml.etree.ElementTree as ET
-from lxml.etree import XMLParser
-from typing import List, Dict
+from lxml import etree
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional
 
 type MasterData = Dict[str, List[str]]
 
 
+class MasterRecord(NamedTuple):
+    # ? Tag of the master in the export, e.g. LEDGER, STOCKITEM or UNIT
+    kind: str
+    name: str
+    # ? Group the master belongs to (ledger group, stock group)
+    parent: Optional[str] = None
+    gstin: Optional[str] = None
+    base_unit: Optional[str] = None
+    hsn_code: Optional[str] = None
+
+
+def _text(element, path: str) -> Optional[str]:
+    text = element.findtext(path)
+    if text is None:
+        return None
+    text = text.strip()
+    return text or None
+
+
+def _master_record(element) -> Optional[MasterRecord]:
+    name = element.get("NAME") or _text(element, "NAME.LIST/NAME")
+    if not name:
+        return None
+
+    return MasterRecord(
+        kind=element.tag,
+        name=name,
+        parent=_text(element, "PARENT"),
+        gstin=_text(element, "PARTYGSTIN")
+        or _text(element, "LEDGERGSTREGISTRATIONDETAILS.LIST/GSTIN"),
+        base_unit=_text(element, "BASEUNITS"),
+        hsn_code=_text(element, "HSNDETAILS.LIST/HSNCODE")
+        or _text(element, "GSTDETAILS.LIST/HSNCODE"),
+    )
+
+
+def iter_tally_masters(
+    xml_file: str | BinaryIO, kinds: Optional[Iterable[str]] = None
+) -> Iterator[MasterRecord]:
+    """
+    Stream the masters of a Tally XML export, optionally only those whose tag
+    is in `kinds`. Every TALLYMESSAGE is dropped once read, so memory stays flat
+    however large the export is.
+    """
+    kinds = set(kinds) if kinds is not None else None
+    # ? Tally writes control characters such as &#4; that strict parsers reject
+    context = etree.iterparse(
+        xml_file, events=("end",), tag="TALLYMESSAGE", recover=True, huge_tree=True
+    )
+
+    for _, message in context:
+        for child in message:
+            # ? Skip comments and processing instructions
+            if not isinstance(child.tag, str):
+                continue
+            if kinds is not None and child.tag not in kinds:
+                continue
+
+            record = _master_record(child)
+            if record is not None:
+                yield record
+
+        # ? Free the message and the references the parent keeps to earlier ones
+        message.clear()
+        while message.getprevious() is not None:
+            del message.getparent()[0]
+
+    del context
+
+
+def tally_export_company(xml_file: str | BinaryIO) -> Optional[str]:
+    """Company a Tally XML export was taken from, its SVCURRENTCOMPANY if named"""
+    # ? The request description comes before the first TALLYMESSAGE, stop there
+    context = etree.iterparse(
+        xml_file,
+        events=("end",),
+        tag=("SVCURRENTCOMPANY", "TALLYMESSAGE"),
+        recover=True,
+        huge_tree=True,
+    )
+    for _, element in context:
+        if element.tag == "SVCURRENTCOMPANY":
+            return _text(element, ".")
+        return None
+
+    return None
+
+
 def parse_tally_masters(xml_file: str):
     """
     Master data that can be extracted from Tally XML:
@@ -12,18 +99,8 @@ def parse_tally_masters(xml_file: str):
     INCOMETAXSLAB, LEDGER, STOCKGROUP, STOCKITEM, TAXUNIT, UNIT, VOUCHERTYPE
     """
 
-    parser = XMLParser(recover=True)
-    tree = ET.parse(xml_file, parser=parser)
-    masters = tree.findall(".//TALLYMESSAGE")
     master_data: MasterData = {}
-
-    for master in masters:
-        for child in master:
-            if master_data.get(child.tag) is None:
-                master_data[child.tag] = []
-
-            name = child.attrib.get("NAME")
-            if name is not None:
-                master_data[child.tag].append(name)
+    for record in iter_tally_masters(xml_file):
+        master_data.setdefault(record.kind, []).append(record.name)
 
     return master_data
@@ -1,61 +1,434 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
 import pandas as pd
 
 from .parse_pdf import is_journal_voucher
-from .tally.loadclr import tally
-from .find_match import find_closest_matches, batch_match_column
-
-from TallyConnector.Core.Models.Masters import Ledger  # type: ignore # noqa: E402
-from TallyConnector.Core.Models.Masters.Inventory import StockItem, Unit  # type: ignore # noqa: E402
+from .tally.loadclr import load_runtime, tally
+from .tally.async_tally import tally_scheduler
+from .tally.parse_tally_xml import (
+    MasterRecord,
+    iter_tally_masters,
+    tally_export_company,
+)
+from .find_match import batch_match_results, candidate_names, find_closest_results
+from .embedding_store import EmbeddingStore
+from .metrics import metrics
+from .model_registry import DEFAULT_EMBEDDING_MODEL
 
 
 def get_tally_company() -> str:
     # ? this will throw an exception if Tally is not running
-    tally.CheckAsync().Result
-    active_company = tally.GetActiveCompanyAsync().Result.Name
+    tally_scheduler.read(tally.CheckAsync)
+    active_company = tally_scheduler.read(tally.GetActiveCompanyAsync).Name
 
     return active_company
 
 
-def match_masters_journal(ledgers_df: pd.DataFrame):
+def offline_company() -> Optional[str]:
+    """
+    Company of the TALLY_MASTERS_XML export, named by the export itself or else
+    by its file name; None without an export to fall back on
+    """
+    if not TALLY_MASTERS_XML:
+        return None
+
+    company_name = tally_export_company(TALLY_MASTERS_XML)
+    return company_name or os.path.splitext(os.path.basename(TALLY_MASTERS_XML))[0]
+
+
+def resolve_company() -> str:
+    """The company open in Tally, or that of TALLY_MASTERS_XML when Tally is down"""
+    try:
+        return get_tally_company()
+    except Exception as e:
+        company_name = offline_company()
+        if company_name is None:
+            raise
+        print(f"Tally unreachable ({e}), matching against '{company_name}' offline")
+        return company_name
+
+
+def get_master_store(company_name: str, master_type: str) -> EmbeddingStore:
+    return EmbeddingStore(company_name, DEFAULT_EMBEDDING_MODEL, master_type)
+
+
+def normalize_gstin(gstin) -> Optional[str]:
+    if gstin is None or pd.isna(gstin):
+        return None
+    gstin = "".join(str(gstin).split()).upper()
+    return gstin if len(gstin) == 15 else None
+
+
+def master_name(master) -> str:
+    # ? TallyConnector objects, or records read from an XML export
+    return master.name if isinstance(master, MasterRecord) else master.Name
+
+
+def get_ledger_gstins(ledger) -> list[str]:
+    if isinstance(ledger, MasterRecord):
+        gstins = [ledger.gstin]
+    else:
+        gstins = [getattr(ledger, "PartyGSTIN", None)]
+        for details in getattr(ledger, "LedgerGSTRegistrationDetails", None) or []:
+            gstins.append(details.GSTIN)
+
+    return [gstin for gstin in map(normalize_gstin, gstins) if gstin is not None]
+
+
+class GstinIndex:
+    """GSTIN -> ledger name lookup per company, built from the fetched ledgers"""
+
+    def __init__(self):
+        self._index: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self, company_name: str, ledgers):
+        index: Dict[str, str] = {}
+        for ledger in ledgers:
+            for gstin in get_ledger_gstins(ledger):
+                # ? Keep the first ledger if a GSTIN is registered on several
+                index.setdefault(gstin, master_name(ledger))
+
+        with self._lock:
+            self._index[company_name] = index
+
+    def replace(self, company_name: str, ledgers):
+        """
+        Index ledgers that were created or altered since the last rebuild: their
+        GSTINs now point at them, and GSTINs they no longer carry are dropped.
+        """
+        ledgers = list(ledgers)
+        names = {master_name(ledger) for ledger in ledgers}
+
+        with self._lock:
+            index = self._index.setdefault(company_name, {})
+            for gstin in [gstin for gstin, name in index.items() if name in names]:
+                del index[gstin]
+            for ledger in ledgers:
+                for gstin in get_ledger_gstins(ledger):
+                    index[gstin] = master_name(ledger)
+
+    def lookup(self, company_name: str, gstin) -> Optional[str]:
+        gstin = normalize_gstin(gstin)
+        if gstin is None:
+            return None
+
+        with self._lock:
+            return self._index.get(company_name, {}).get(gstin)
+
+
+# ? Singleton instance of GstinIndex
+gstin_index = GstinIndex()
+
+# ? Seconds before a snapshot is fetched in full again, incremental refreshes
+# ? can't see deleted (or renamed away) masters
+MASTER_CACHE_TTL = float(os.environ.get("MASTER_CACHE_TTL", 900))
+# ? Tally XML export to match against when Tally can't be reached
+TALLY_MASTERS_XML = os.environ.get("TALLY_MASTERS_XML")
+
+
+MASTER_TYPES = ("ledger", "stock_item", "unit")
+
+
+def fetch_masters(min_alter_id: Optional[int] = None) -> Dict[str, list]:
+    """
+    Fetch ledgers, stock items and units concurrently, only those altered after
+    `min_alter_id` if given
+    """
+    # ? Imported here so matching against a cached or offline snapshot never
+    # ? starts the CLR
+    load_runtime()
+    from System.Collections.Generic import List as CSList  # type: ignore # noqa: E402
+    from TallyConnector.Core.Models import Filter, PaginatedRequestOptions  # type: ignore # noqa: E402
+    from TallyConnector.Core.Models.Masters import Ledger  # type: ignore # noqa: E402
+    from TallyConnector.Core.Models.Masters.Inventory import StockItem, Unit  # type: ignore # noqa: E402
+
+    options = None
+    if min_alter_id is not None:
+        options = PaginatedRequestOptions()
+        options.Filters = CSList[Filter]()
+        alter_filter = Filter()
+        alter_filter.FilterName = "AlteredSince"
+        alter_filter.FilterFormulae = f"$AlterID > {min_alter_id}"
+        options.Filters.Add(alter_filter)
+
+    ledgers, stock_items, units = tally_scheduler.read_many(
+        (tally.GetLedgersAsync[Ledger], options),
+        (tally.GetStockItemsAsync[StockItem], options),
+        (tally.GetUnitsAsync[Unit], options),
+    )
+    return {
+        "ledger": list(ledgers),
+        "stock_item": list(stock_items),
+        "unit": list(units),
+    }
+
+
+def get_masters_state() -> tuple[str, int]:
+    """The company open in Tally, which every fetch reads, and its master AlterID"""
+    company, alter_ids = tally_scheduler.read_many(
+        (tally.GetActiveCompanyAsync,), (tally.GetLastAlterIdsAsync,)
+    )
+    return company.Name, int(alter_ids.MastersLastAlterId)
+
+
+class MasterSnapshot:
+    """
+    Ledgers, stock items and units of one company, keyed by name. Offline
+    snapshots are read from an XML export and have no AlterID.
+    """
+
+    def __init__(self, company_name: str, alter_id: Optional[int]):
+        self.company_name = company_name
+        self.alter_id = alter_id
+        self.fetched_at = time.monotonic()
+        self.masters: Dict[str, Dict[str, object]] = {
+            master_type: {} for master_type in MASTER_TYPES
+        }
+        # ? Requests read the snapshot while another one refreshes or records into it
+        self._lock = threading.Lock()
+
+    @property
+    def offline(self) -> bool:
+        return self.alter_id is None
+
+    def put(self, master_type: str, masters):
+        with self._lock:
+            for master in masters:
+                self.masters[master_type][master_name(master)] = master
+
+    def names(self, master_type: str) -> list[str]:
+        with self._lock:
+            return list(self.masters[master_type])
+
+    def get(self, master_type: str, name: str):
+        with self._lock:
+            return self.masters[master_type].get(name)
+
+    def has(self, master_type: str, name: str) -> bool:
+        with self._lock:
+            return name in self.masters[master_type]
+
+
+# ? Export tags of the masters the matcher uses
+EXPORT_MASTER_TYPES = {"LEDGER": "ledger", "STOCKITEM": "stock_item", "UNIT": "unit"}
+
+
+def load_offline_snapshot(company_name: str, xml_file: str) -> MasterSnapshot:
+    """Build a snapshot from a Tally XML export, streaming it record by record"""
+    masters: Dict[str, list] = {master_type: [] for master_type in MASTER_TYPES}
+    for record in iter_tally_masters(xml_file, EXPORT_MASTER_TYPES):
+        masters[EXPORT_MASTER_TYPES[record.kind]].append(record)
+
+    snapshot = MasterSnapshot(company_name, None)
+    for master_type, records in masters.items():
+        snapshot.put(master_type, records)
+
+    return snapshot
+
+
+class MasterCache:
+    """
+    In-process snapshots of each company's masters.
+
+    Tally only serves the company open in it, so snapshots fetched from Tally
+    are keyed by the company Tally reports, whichever name the caller passed;
+    use the returned snapshot's `company_name` from then on. Offline snapshots
+    (from an XML export) are keyed by the caller's company name.
+
+    Tally bumps the company's master AlterID on every change, so a refresh only
+    asks for the masters altered since the snapshot was taken, and nothing at
+    all when the AlterID hasn't moved. Masters we post ourselves are recorded
+    straight into the snapshot. Deletions only show up on the full refresh
+    every `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float = MASTER_CACHE_TTL):
+        self.ttl = ttl
+        self._snapshots: Dict[str, MasterSnapshot] = {}
+        # ? One lock for everything, Tally serves a single company at a time anyway
+        self._lock = threading.RLock()
+
+    def _fresh(self, snapshot: Optional[MasterSnapshot]) -> bool:
+        return (
+            snapshot is not None and time.monotonic() - snapshot.fetched_at <= self.ttl
+        )
+
+    def get(self, company_name: str) -> MasterSnapshot:
+        """Return the snapshot of the company open in Tally, brought up to date"""
+        with self._lock:
+            # ? Tried again once the offline snapshot's TTL runs out
+            offline = self._snapshots.get(company_name)
+            if self._fresh(offline) and offline.offline:
+                return offline
+
+            try:
+                tally_company, alter_id = get_masters_state()
+            except Exception as e:
+                if not TALLY_MASTERS_XML:
+                    raise
+                print(
+                    f"Tally unreachable ({e}), using masters from {TALLY_MASTERS_XML}"
+                )
+                snapshot = load_offline_snapshot(company_name, TALLY_MASTERS_XML)
+                self._index(snapshot)
+                self._snapshots[company_name] = snapshot
+                return snapshot
+
+            if tally_company != company_name:
+                print(f"Tally has '{tally_company}' open, not '{company_name}'")
+
+            snapshot = self._snapshots.get(tally_company)
+            if not self._fresh(snapshot) or snapshot.offline:
+                with metrics.span("master_cache_load"):
+                    snapshot = self._load(tally_company, alter_id)
+            else:
+                with metrics.span("master_cache_refresh"):
+                    self._refresh(snapshot, alter_id)
+
+            self._snapshots[tally_company] = snapshot
+            return snapshot
+
+    def _index(self, snapshot: MasterSnapshot):
+        gstin_index.rebuild(snapshot.company_name, snapshot.masters["ledger"].values())
+        print(
+            f"Loaded masters of '{snapshot.company_name}' "
+            f"at AlterID {snapshot.alter_id}"
+        )
+
+    def _load(self, company_name: str, alter_id: int) -> MasterSnapshot:
+        # ? The AlterID is read first, masters altered while fetching come next time
+        snapshot = MasterSnapshot(company_name, alter_id)
+        for master_type, masters in fetch_masters().items():
+            snapshot.put(master_type, masters)
+
+        self._index(snapshot)
+        return snapshot
+
+    def _refresh(self, snapshot: MasterSnapshot, alter_id: int):
+        if alter_id <= snapshot.alter_id:
+            return
+
+        altered = fetch_masters(snapshot.alter_id)
+        for master_type, masters in altered.items():
+            snapshot.put(master_type, masters)
+        gstin_index.replace(snapshot.company_name, altered["ledger"])
+
+        print(
+            f"Refreshed masters of '{snapshot.company_name}' "
+            f"from AlterID {snapshot.alter_id} to {alter_id}"
+        )
+        snapshot.alter_id = alter_id
+
+    def record(self, company_name: str, master_type: str, master):
+        """Add a master we just posted to Tally to the company's snapshot"""
+        with self._lock:
+            snapshot = self._snapshots.get(company_name)
+            if snapshot is not None:
+                snapshot.put(master_type, [master])
+
+        if master_type == "ledger":
+            gstin_index.replace(company_name, [master])
+
+    def seed(self, snapshot: MasterSnapshot):
+        """Use `snapshot` for its company, e.g. one read from an XML export"""
+        with self._lock:
+            self._snapshots[snapshot.company_name] = snapshot
+            self._index(snapshot)
+
+    def invalidate(self, company_name: Optional[str] = None):
+        with self._lock:
+            if company_name is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(company_name, None)
+
+
+# ? Singleton instance of MasterCache
+master_cache = MasterCache()
+
+
+def match_masters_journal(ledgers_df: pd.DataFrame, company_name: str):
     # ? Match supplier name to ledger name
-    ledgers = tally.GetLedgersAsync[Ledger]().Result
-    ledger_names = [ledger.Name for ledger in ledgers]
+    snapshot = master_cache.get(company_name)
+    company_name = snapshot.company_name
+    ledger_names = snapshot.names("ledger")
+
+    results = find_closest_results(
+        ledgers_df["Account Name"],
+        ledger_names,
+        get_master_store(company_name, "ledger"),
+        "ledgers",
+    )
+    ledgers_df["[D] Account Name"] = [result.match for result in results]
+    ledgers_df["[D] Account Name Candidates"] = candidate_names(results)
 
-    ledgers_df["[D] Account Name"] = find_closest_matches(
-        ledgers_df["Account Name"], ledger_names
+    # ? A GSTIN identifies the ledger more reliably than its name
+    gstin_matches = ledgers_df["Account GSTIN"].map(
+        lambda gstin: gstin_index.lookup(company_name, gstin)
     )
+    ledgers_df["[D] Account Name"] = gstin_matches.fillna(ledgers_df["[D] Account Name"])
 
     return ledgers_df
 
 
-def match_masters_sales_purchase(common_df: pd.DataFrame, items_df: pd.DataFrame):
+def match_masters_sales_purchase(
+    common_df: pd.DataFrame, items_df: pd.DataFrame, company_name: str
+):
     # ? Match supplier name to ledger name
-    ledgers = tally.GetLedgersAsync[Ledger]().Result
-    ledger_names = [ledger.Name for ledger in ledgers]
-    supplier_name = common_df["Supplier Name"].iloc[0]
-    customer_name = common_df["Customer Name"].iloc[0]
+    snapshot = master_cache.get(company_name)
+    company_name = snapshot.company_name
     voucher_type = common_df["Voucher Type"].iloc[0]
-    party_account = supplier_name if voucher_type == "Purchase" else customer_name
-    common_df["Party Account"] = party_account
-    common_df["[D] Party Account"] = find_closest_matches(
-        common_df["Party Account"], ledger_names
-    )
+    perspective = "Supplier" if voucher_type == "Purchase" else "Customer"
+    common_df["Party Account"] = common_df[f"{perspective} Name"].iloc[0]
 
-    stock_items = tally.GetStockItemsAsync[StockItem]().Result
-    stock_item_names = [item.Name for item in stock_items]
-    items_df["[D] Stock Item"] = batch_match_column(
-        items_df["Product Name"], stock_item_names
+    # ? Resolve the party by GSTIN, only fall back to name similarity without one
+    party_ledger = gstin_index.lookup(
+        company_name, common_df[f"{perspective} GSTIN"].iloc[0]
     )
+    if party_ledger is not None:
+        print(f"Matched {perspective} by GSTIN to ledger '{party_ledger}'")
+        common_df["[D] Party Account"] = party_ledger
+        common_df["[D] Party Account Candidates"] = [[party_ledger]] * len(common_df)
+    else:
+        results = find_closest_results(
+            common_df["Party Account"],
+            snapshot.names("ledger"),
+            get_master_store(company_name, "ledger"),
+            "party ledgers",
+        )
+        common_df["[D] Party Account"] = [result.match for result in results]
+        common_df["[D] Party Account Candidates"] = candidate_names(results)
 
-    units = tally.GetUnitsAsync[Unit]().Result
-    unit_names = [unit.Name for unit in units]
-    items_df["[D] Units"] = batch_match_column(items_df["Quantity Unit"], unit_names)
+    # ? Candidates columns keep the next best masters for the reviewer to pick from
+    for column, source, kind, label in (
+        ("[D] Stock Item", "Product Name", "stock_item", "stock items"),
+        ("[D] Units", "Quantity Unit", "unit", "units"),
+    ):
+        results = batch_match_results(
+            items_df[source],
+            snapshot.names(kind),
+            get_master_store(company_name, kind),
+            label,
+        )
+        items_df[column] = [result.match if result else None for result in results]
+        items_df[f"{column} Candidates"] = candidate_names(results)
 
     return common_df, items_df
 
 
-def match_masters(common_df: pd.DataFrame, items_df: pd.DataFrame):
-    if is_journal_voucher(common_df):
-        match_masters_journal(items_df)
-    else:
-        match_masters_sales_purchase(common_df, items_df)
+def match_masters(
+    common_df: pd.DataFrame,
+    items_df: pd.DataFrame,
+    company_name: Optional[str] = None,
+):
+    if company_name is None:
+        company_name = resolve_company()
+
+    with metrics.span("match_masters"):
+        if is_journal_voucher(common_df):
+            match_masters_journal(items_df, company_name)
+        else:
+            match_masters_sales_purchase(common_df, items_df, company_name)
@@ -1,46 +1,202 @@
+from typing import Iterable, Optional
+
+import numpy as np
 import pandas as pd
 
 from .parse_pdf import is_journal_voucher
 
+# ? Column identifying the invoice each row belongs to in stacked frames
+INVOICE_COLUMN = "invoice"
+ERROR_COLUMNS = ["invoice", "row", "field", "expected", "actual"]
+
+TOLERANCE = 0.1
+# ? Allowed difference on a voucher total per line, each printed line amount is
+# ? rounded to the paisa; the total is allowed at least TOLERANCE
+VOUCHER_LINE_TOLERANCE = 0.01
+
+
+def stack_invoices(
+    invoices: Iterable[tuple[pd.DataFrame, pd.DataFrame]],
+    keys: Optional[Iterable] = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Stack many `(common_df, items_df)` pairs into one pair of frames with an
+    `invoice` column (the pair's key, or its position). Row indexes are kept,
+    so errors point at the row of the original invoice.
+    """
+    invoices = list(invoices)
+    keys = list(keys) if keys is not None else list(range(len(invoices)))
+
+    common_df = pd.concat(
+        common.assign(**{INVOICE_COLUMN: key})
+        for key, (common, _) in zip(keys, invoices)
+    )
+    items_df = pd.concat(
+        items.assign(**{INVOICE_COLUMN: key})
+        for key, (_, items) in zip(keys, invoices)
+    )
+    return common_df, items_df
+
+
+def _invoice_ids(df: pd.DataFrame) -> np.ndarray:
+    if INVOICE_COLUMN in df.columns:
+        return df[INVOICE_COLUMN].to_numpy()
+    return np.zeros(len(df), dtype=int)
+
+
+def _column(df: pd.DataFrame, name: str) -> np.ndarray:
+    return pd.to_numeric(df[name], errors="coerce").to_numpy(dtype=float)
+
+
+def _error_table(invoice, row, field: str, expected, actual, mask) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "invoice": invoice[mask],
+            "row": row[mask],
+            "field": field,
+            "expected": expected[mask],
+            "actual": actual[mask],
+        }
+    )
+
+
+def _concat_errors(tables: list[pd.DataFrame]) -> pd.DataFrame:
+    tables = [table for table in tables if len(table)]
+    if not tables:
+        return pd.DataFrame(columns=ERROR_COLUMNS)
+    return pd.concat(tables, ignore_index=True)
+
+
+def check_items(items_df: pd.DataFrame) -> pd.DataFrame:
+    """Line and voucher total checks of sales/purchase items, one or stacked"""
+    invoice = _invoice_ids(items_df)
+    row = items_df.index.to_numpy()
+
+    taxable_amount = _column(items_df, "Taxable Amount").round(1)
+    tax_amount = _column(items_df, "Tax Amount").round(1)
+    total_amount = _column(items_df, "Total Amount").round(1)
+
+    discount = np.nan_to_num(_column(items_df, "Discount"))
+    taxable_amount_calc = (
+        _column(items_df, "Rate") * _column(items_df, "Quantity") - discount
+    ).round(1)
+    tax_amount_calc = (taxable_amount * _column(items_df, "Tax Rate") / 100).round(1)
+    total_amount_calc = (taxable_amount + tax_amount).round(1)
+
+    tables = [
+        _error_table(
+            invoice,
+            row,
+            field,
+            expected,
+            actual,
+            # ? NaN compares False, rows missing a value are not flagged
+            np.abs(actual - expected) > TOLERANCE,
+        )
+        for field, expected, actual in (
+            ("Taxable Amount", taxable_amount_calc, taxable_amount),
+            ("Tax Amount", tax_amount_calc, tax_amount),
+            ("Total Amount", total_amount_calc, total_amount),
+        )
+    ]
+
+    # ? The voucher's taxable amounts and tax have to add up to its total. Summed
+    # ? as printed and rounded once, rounding each line adds up over many lines
+    totals = (
+        pd.DataFrame(
+            {
+                "invoice": invoice,
+                "taxable": _column(items_df, "Taxable Amount"),
+                "tax": _column(items_df, "Tax Amount"),
+                "total": _column(items_df, "Total Amount"),
+                "lines": 1,
+            }
+        )
+        .groupby("invoice", sort=False)
+        .sum(min_count=1)
+    )
+    voucher_total_calc = (totals["taxable"] + totals["tax"]).round(1)
+    voucher_total = totals["total"].round(1)
+    tolerance = np.maximum(TOLERANCE, VOUCHER_LINE_TOLERANCE * totals["lines"])
+    tables.append(
+        _error_table(
+            totals.index.to_numpy(),
+            # ? Voucher-level errors have no row
+            np.full(len(totals), None, dtype=object),
+            "Voucher Total",
+            voucher_total_calc.to_numpy(),
+            voucher_total.to_numpy(),
+            ((voucher_total - voucher_total_calc).abs() > tolerance).to_numpy(),
+        )
+    )
+
+    return _concat_errors(tables)
+
+
+def check_journal(ledgers_df: pd.DataFrame) -> pd.DataFrame:
+    """Debit/credit balance of journal vouchers, one invoice or stacked"""
+    totals = (
+        pd.DataFrame(
+            {
+                "invoice": _invoice_ids(ledgers_df),
+                "debit": _column(ledgers_df, "Debit Amount"),
+                "credit": _column(ledgers_df, "Credit Amount"),
+            }
+        )
+        .groupby("invoice", sort=False)
+        .sum()
+        .round(1)
+    )
+    net_debit = totals["debit"].to_numpy()
+    net_credit = totals["credit"].to_numpy()
+
+    return _error_table(
+        totals.index.to_numpy(),
+        np.full(len(totals), None, dtype=object),
+        "Net Credit",
+        net_debit,
+        net_credit,
+        np.abs(net_debit - net_credit) > TOLERANCE,
+    ).reindex(columns=ERROR_COLUMNS)
+
+
+def verify_invoices(common_df: pd.DataFrame, items_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Check one invoice, or many stacked with `stack_invoices`, and return one
+    error per line (invoice, row, field, expected, actual). Voucher-level
+    errors have no row.
+    """
+    journal_invoices = _invoice_ids(common_df)[
+        (common_df["Voucher Type"] == "Journal").to_numpy()
+    ]
+    is_journal = np.isin(_invoice_ids(items_df), journal_invoices)
+
+    tables = []
+    # ? Stacked frames only have the journal columns if a journal was stacked
+    if (~is_journal).any():
+        tables.append(check_items(items_df[~is_journal]))
+    if is_journal.any():
+        tables.append(check_journal(items_df[is_journal]))
+
+    return _concat_errors(tables)
+
+
+def format_error(error) -> str:
+    if error.field == "Net Credit":
+        return f"Net Debit {error.expected}, Net Credit: {error.actual}"
+    prefix = f"[Row {error.row}] " if error.row is not None else ""
+    return (
+        f"{prefix}{error.field} {error.actual}, "
+        f"Calculated {error.field}: {error.expected}"
+    )
+
 
 def verify_amounts_sales_purchase(items_df: pd.DataFrame):
-    errors: list[str] = []
-    for idx, row in items_df.iterrows():
-        rate = row["Rate"]
-        discount = row["Discount"]
-        quantity = row["Quantity"]
-        taxable_amount = row["Taxable Amount"].round(1)
-        taxable_amount_calc = (rate * quantity - discount).round(1)
-        if abs(taxable_amount - taxable_amount_calc) > 0.1:
-            errors.append(
-                f"[Row {idx}] Taxable Amount {taxable_amount}, Calculated Taxable Amount: {taxable_amount_calc}"
-            )
-
-        tax_amount = row["Tax Amount"].round(1)
-        tax_amount_calc = (taxable_amount * row["Tax Rate"] / 100).round(1)
-        if abs(tax_amount - tax_amount_calc) > 0.1:
-            errors.append(
-                f"[Row {idx}] Tax Amount {tax_amount}, Calculated Tax Amount: {tax_amount_calc}"
-            )
-
-        total_amount = row["Total Amount"].round(1)
-        total_amount_calc = (taxable_amount + tax_amount).round(1)
-        if abs(total_amount - total_amount_calc) > 0.1:
-            errors.append(
-                f"[Row {idx}] Total Amount {total_amount}, Calculated Total Amount: {total_amount_calc}"
-            )
-
-    return errors
+    return [format_error(error) for error in check_items(items_df).itertuples()]
 
 
 def verify_amounts_journal(ledgers_df: pd.DataFrame):
-    errors: list[str] = []
-    net_debit = ledgers_df["Debit Amount"].sum().round(1)
-    net_credit = ledgers_df["Credit Amount"].sum().round(1)
-    if abs(net_debit - net_credit) > 0.1:
-        errors.append(f"Net Debit {net_debit}, Net Credit: {net_credit}")
-
-    return errors
+    return [format_error(error) for error in check_journal(ledgers_df).itertuples()]
 
 
 def verify_amounts(common_df: pd.DataFrame, items_df: pd.DataFrame):
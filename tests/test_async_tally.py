@@ -0,0 +1,67 @@
+import asyncio
+
+from src.tally.async_tally import ReadWriteLock
+
+
+async def task(lock: ReadWriteLock, kind: str, name: str, events: list, hold=0.01):
+    acquire = lock.reading if kind == "read" else lock.writing
+    async with acquire():
+        events.append(f"{name} start")
+        await asyncio.sleep(hold)
+        events.append(f"{name} end")
+
+
+def test_reads_share_the_lock_up_to_max_readers():
+    async def run():
+        lock, events = ReadWriteLock(2), []
+        await asyncio.gather(
+            *(task(lock, "read", name, events) for name in ("r1", "r2", "r3"))
+        )
+        return events
+
+    events = asyncio.run(run())
+    assert events[:2] == ["r1 start", "r2 start"]
+    # ? The third read waits for a free slot
+    assert events.index("r3 start") > events.index("r1 end")
+
+
+def test_write_waits_for_reads_and_runs_alone():
+    async def run():
+        lock, events = ReadWriteLock(3), []
+        await asyncio.gather(
+            task(lock, "read", "r1", events),
+            task(lock, "write", "w", events),
+            task(lock, "write", "w2", events),
+        )
+        return events
+
+    assert asyncio.run(run()) == [
+        "r1 start",
+        "r1 end",
+        "w start",
+        "w end",
+        "w2 start",
+        "w2 end",
+    ]
+
+
+def test_waiting_write_holds_back_later_reads():
+    async def run():
+        lock, events = ReadWriteLock(3), []
+        # ? sleep(0) lets each task reach the lock before the next one is created
+        first = asyncio.create_task(task(lock, "read", "r1", events, hold=0.05))
+        await asyncio.sleep(0)
+        write = asyncio.create_task(task(lock, "write", "w", events))
+        await asyncio.sleep(0)
+        later = asyncio.create_task(task(lock, "read", "r2", events))
+        await asyncio.gather(first, write, later)
+        return events
+
+    assert asyncio.run(run()) == [
+        "r1 start",
+        "r1 end",
+        "w start",
+        "w end",
+        "r2 start",
+        "r2 end",
+    ]
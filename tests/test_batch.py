@@ -0,0 +1,73 @@
+import io
+import threading
+import time
+import zipfile
+
+import pytest
+
+from src import batch
+from src.batch import parse_batch, read_batch_documents
+from src.document_buffer import DocumentBuffer
+
+
+def archive(members: dict[str, bytes]) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+def test_zip_members_are_read_as_documents():
+    upload = archive({"a.pdf": b"%PDF-a", "notes.txt": b"skip", "dir/b.PNG": b"png"})
+    documents = read_batch_documents([("invoices.zip", upload)])
+    assert [document.name for document in documents] == ["a.pdf", "dir/b.PNG"]
+    assert bytes(documents[0].view()) == b"%PDF-a"
+
+
+def test_zip_with_too_many_members_is_refused(monkeypatch):
+    monkeypatch.setattr(batch, "ZIP_MAX_MEMBERS", 2)
+    upload = archive({f"{i}.pdf": b"%PDF" for i in range(3)})
+    with pytest.raises(ValueError, match="members"):
+        read_batch_documents([("invoices.zip", upload)])
+
+
+def test_zip_bomb_is_refused_before_extracting():
+    upload = archive({"bomb.pdf": b"\0" * 1024 * 1024})
+    with pytest.raises(ValueError, match="compressed"):
+        read_batch_documents([("invoices.zip", upload)])
+
+
+def test_zip_over_total_size_is_refused(monkeypatch):
+    monkeypatch.setattr(batch, "ZIP_MAX_UNCOMPRESSED_BYTES", 10)
+    upload = archive({"a.pdf": b"%PDF-123456", "b.pdf": b"%PDF-7"})
+    with pytest.raises(ValueError, match="inflates"):
+        read_batch_documents([("scan.pdf", io.BytesIO(b"%PDF")), ("x.zip", upload)])
+
+
+def test_closing_a_batch_waits_for_extractions_in_flight(monkeypatch):
+    extracting = threading.Event()
+    extracted = []
+
+    def extract(document):
+        extracting.set()
+        time.sleep(0.05)
+        extracted.append(document.name)
+        return ["page"]
+
+    monkeypatch.setattr(batch, "get_cached_result", lambda company, doc: ("k", None))
+    monkeypatch.setattr(batch, "extract_invoice_pages", extract)
+    monkeypatch.setattr(batch, "parse_invoice_pages", lambda *args: 1 / 0)
+
+    documents = [DocumentBuffer(f"{i}.pdf", data=b"%PDF") for i in range(4)]
+    results = parse_batch("Acme Traders", documents, 1)
+    first = next(results)
+    assert first.error is not None
+
+    results.close()
+    # ? Nothing still reads a buffer, so the caller may close them all now
+    snapshot = list(extracted)
+    time.sleep(0.1)
+    assert extracted == snapshot
+    assert extracting.is_set()
@@ -0,0 +1,48 @@
+from src.compact_text import compact_pages, drop_duplicate_pages, strip_boilerplate
+
+HEADER = "Acme Traders Private Limited\nTax Invoice"
+
+
+def page(number: int, body: str, total: int = 3) -> str:
+    return f"{HEADER}\n{body}\nThank you for your business\nPage {number} of {total}"
+
+
+def test_strips_repeated_header_and_footer_after_first_page():
+    pages = [page(1, "Widget 2 10.00"), page(2, "Bolt 5 3.50"), page(3, "Nut 9 1.25")]
+    stripped = strip_boilerplate(pages)
+    assert stripped[0] == pages[0]
+    assert stripped[1:] == ["Bolt 5 3.50", "Nut 9 1.25"]
+
+
+def test_keeps_repeated_subtotal_and_line_items():
+    body = "Freight charges 250.00\nSub Total 1,250.00"
+    pages = [f"{HEADER}\nItem {n} 10.00\n{body}" for n in range(1, 4)]
+    stripped = strip_boilerplate(pages)
+    for text in stripped[1:]:
+        assert "Freight charges 250.00" in text
+        assert "Sub Total 1,250.00" in text
+        assert HEADER not in text
+
+
+def test_keeps_lines_that_only_look_alike():
+    # ? Different numbers are different content, only page numbers are folded
+    pages = [f"{HEADER}\nInvoice No INV-{n}\nItem {n}" for n in range(3)]
+    assert all(f"INV-{n}" in text for n, text in enumerate(strip_boilerplate(pages)))
+
+
+def test_single_page_is_untouched():
+    assert strip_boilerplate([page(1, "Widget 2 10.00", 1)]) == [
+        page(1, "Widget 2 10.00", 1)
+    ]
+
+
+def test_near_duplicate_pages_are_kept_unless_asked():
+    first = " ".join(f"Item{n} 1 100.00" for n in range(40))
+    second = first.replace("Item39 1 100.00", "Item39 2 200.00")
+    assert drop_duplicate_pages([first, second, first]) == [first, second]
+    assert drop_duplicate_pages([first, second], near_duplicates=True) == [first]
+
+
+def test_compact_pages_normalizes_and_drops_exact_duplicates():
+    pages = ["Widget   2\n\n\n10.00", "Widget 2\n10.00", "  "]
+    assert compact_pages(pages) == ["Widget 2\n10.00"]
@@ -0,0 +1,35 @@
+from src.parse_pdf import CsvRowParser, parse_csv_value
+
+
+def feed_all(chunks: list[str]) -> list[list[str]]:
+    parser = CsvRowParser()
+    rows = []
+    for chunk in chunks:
+        rows.extend(parser.feed(chunk))
+    return rows + parser.close()
+
+
+def test_rows_split_across_chunks():
+    text = "```csv\nName,Qty\nWidget,2\nBolt,10\n```"
+    expected = [["Name", "Qty"], ["Widget", "2"], ["Bolt", "10"]]
+    assert feed_all([text]) == expected
+    assert feed_all(list(text)) == expected
+
+
+def test_row_is_returned_as_soon_as_it_ends():
+    parser = CsvRowParser()
+    assert parser.feed("Name,Qty\nWid") == [["Name", "Qty"]]
+    assert parser.feed("get,2") == []
+    assert parser.close() == [["Widget", "2"]]
+
+
+def test_newlines_and_quotes_inside_quoted_fields():
+    rows = feed_all(['Item,Note\n"Bolt, M8","2"" long', '\nline"\n'])
+    assert rows == [["Item", "Note"], ["Bolt, M8", '2" long\nline']]
+
+
+def test_values_keep_their_text():
+    assert parse_csv_value("00123") == "00123"
+    assert parse_csv_value("nan") == "nan"
+    assert parse_csv_value("1,200.50") == "1,200.50"
+    assert parse_csv_value("") is None
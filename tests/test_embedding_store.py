@@ -0,0 +1,78 @@
+import numpy as np
+
+from src.embedding_store import EmbeddingStore
+
+
+class Encoder:
+    """Deterministic 3-d 'embeddings', remembering which names it encoded"""
+
+    def __init__(self):
+        self.calls: list[list[str]] = []
+
+    def __call__(self, names: list[str]) -> np.ndarray:
+        self.calls.append(list(names))
+        return np.array([[len(name), ord(name[0]), 1.0] for name in names])
+
+
+def store(tmp_path) -> EmbeddingStore:
+    return EmbeddingStore("Acme Traders", "model", "ledger", root=tmp_path)
+
+
+def embeddings(vectors: np.ndarray, rows: np.ndarray) -> list[list[float]]:
+    return np.asarray(vectors[rows]).tolist()
+
+
+def test_first_sync_encodes_every_name(tmp_path):
+    encode = Encoder()
+    vectors, rows = store(tmp_path).sync(["Cash", "Bank"], encode)
+    assert encode.calls == [["Cash", "Bank"]]
+    assert embeddings(vectors, rows) == [[4, 67, 1], [4, 66, 1]]
+
+
+def test_later_syncs_only_encode_new_names(tmp_path):
+    store(tmp_path).sync(["Cash", "Bank"], Encoder())
+
+    encode = Encoder()
+    vectors, rows = store(tmp_path).sync(["Bank", "Sales", "Cash"], encode)
+    assert encode.calls == [["Sales"]]
+    assert embeddings(vectors, rows) == [[4, 66, 1], [5, 83, 1], [4, 67, 1]]
+
+    encode = Encoder()
+    store(tmp_path).sync(["Bank", "Sales", "Cash"], encode)
+    assert encode.calls == []
+
+
+def test_duplicate_names_share_a_row(tmp_path):
+    encode = Encoder()
+    _, rows = store(tmp_path).sync(["Cash", "Cash"], encode)
+    assert encode.calls == [["Cash"]]
+    assert rows[0] == rows[1]
+
+
+def test_removed_names_are_compacted_away(tmp_path):
+    names = [f"Ledger {n}" for n in range(8)]
+    store(tmp_path).sync(names, Encoder())
+
+    kept = names[:2]
+    vectors, rows = store(tmp_path).sync(kept, Encoder())
+    assert len(vectors) == len(kept)
+    assert sorted(rows.tolist()) == [0, 1]
+    assert embeddings(vectors, rows) == [[8, 76, 1], [8, 76, 1]]
+    vectors_file = tmp_path / "Acme_Traders" / "model" / "ledger" / "vectors.f32"
+    assert vectors_file.stat().st_size == len(kept) * 3 * 4
+
+
+def test_names_added_by_another_writer_while_encoding_are_not_appended_twice(
+    tmp_path,
+):
+    other = store(tmp_path)
+
+    def encode(names: list[str]) -> np.ndarray:
+        # ? Another process syncs while this one encodes outside the lock
+        if "Sales" in names:
+            other.sync(["Sales"], Encoder())
+        return Encoder()(names)
+
+    vectors, rows = store(tmp_path).sync(["Sales", "Cash"], encode)
+    assert embeddings(vectors, rows) == [[5, 83, 1], [4, 67, 1]]
+    assert len(vectors) == 2
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from src import find_match
+from src.find_match import MasterMatcher, batch_match_results, candidate_names
+
+CHOICES = ["Steel Rod", "Steel Rods 10mm", "Copper Wire", "Nuts"]
+
+# ? Hand-made unit vectors standing in for sentence embeddings
+VECTORS = {
+    "Steel Rod": [1.0, 0.0, 0.0],
+    "Steel Rods 10mm": [0.8, 0.6, 0.0],
+    "Copper Wire": [0.0, 0.0, 1.0],
+    "Nuts": [0.0, 1.0, 0.0],
+    "Steel Rod 12": [0.96, 0.28, 0.0],
+    "Xyz": [0.0, 0.6, 0.8],
+}
+
+
+def fake_encode(texts: list[str]) -> np.ndarray:
+    return np.array([VECTORS[text] for text in texts], dtype=np.float32)
+
+
+def matcher(monkeypatch, candidates: int = 5) -> MasterMatcher:
+    monkeypatch.setattr(find_match, "encode", fake_encode)
+    return MasterMatcher(CHOICES, candidates=candidates)
+
+
+def test_exact_and_normalised_matches_are_their_only_candidate(monkeypatch):
+    exact, normalised = matcher(monkeypatch).match(["Nuts", "copper  wire."])
+    assert exact.stage == "exact"
+    assert exact.candidates == (("Nuts", 1.0),)
+    assert normalised.match == "Copper Wire"
+    assert [c.name for c in normalised.candidates] == ["Copper Wire"]
+
+
+def test_shortlist_keeps_top_candidates_by_score(monkeypatch):
+    (result,) = matcher(monkeypatch).match(["Steel Rod 12"])
+    assert result.stage == "shortlist"
+    assert result.match == "Steel Rod"
+    assert [c.name for c in result.candidates] == ["Steel Rod", "Steel Rods 10mm"]
+    scores = [c.score for c in result.candidates]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_unmatched_names_still_have_candidates(monkeypatch):
+    (result,) = matcher(monkeypatch, candidates=2).match(["Xyz"])
+    assert result.stage == "unmatched"
+    assert result.match is None
+    assert [c.name for c in result.candidates] == ["Copper Wire", "Nuts"]
+
+
+def test_batch_results_follow_the_column(monkeypatch):
+    monkeypatch.setattr(find_match, "encode", fake_encode)
+    column = pd.Series(["Nuts", None, "Steel Rod 12", "Nuts"])
+    results = batch_match_results(column, CHOICES)
+    assert [result.match if result else None for result in results] == [
+        "Nuts",
+        None,
+        "Steel Rod",
+        "Nuts",
+    ]
+    assert candidate_names(results)[1] == []
+    assert candidate_names(results)[0] == ["Nuts"]
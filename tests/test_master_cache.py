@@ -0,0 +1,145 @@
+import pandas as pd
+
+from src import find_match, tally_connector
+from src.tally.parse_tally_xml import MasterRecord
+from src.tally_connector import (
+    GstinIndex,
+    MasterCache,
+    gstin_index,
+    master_cache,
+    match_masters,
+)
+
+ACME_GSTIN = "27AAACA1234A1Z5"
+BOLT_GSTIN = "27AAACB5678B1Z3"
+
+
+def ledger(name: str, gstin=None) -> MasterRecord:
+    return MasterRecord("LEDGER", name, "Sundry Creditors", gstin)
+
+
+def test_gstin_index_keeps_the_first_ledger_on_rebuild():
+    index = GstinIndex()
+    index.rebuild("Co", [ledger("Acme"), ledger("Acme A/c", ACME_GSTIN)])
+    index.rebuild("Co", [ledger("Acme", ACME_GSTIN), ledger("Acme A/c", ACME_GSTIN)])
+    assert index.lookup("Co", ACME_GSTIN.lower()) == "Acme"
+    assert index.lookup("Co", "not a gstin") is None
+
+
+def test_gstin_index_replace_follows_altered_ledgers():
+    index = GstinIndex()
+    index.rebuild("Co", [ledger("Acme", ACME_GSTIN), ledger("Bolt", BOLT_GSTIN)])
+
+    # ? Acme's GSTIN was corrected to Bolt's, and Bolt lost its GSTIN
+    index.replace("Co", [ledger("Acme", BOLT_GSTIN), ledger("Bolt")])
+    assert index.lookup("Co", ACME_GSTIN) is None
+    assert index.lookup("Co", BOLT_GSTIN) == "Acme"
+
+
+class FakeTally:
+    """Company state and master fetches of a Tally that changes between calls"""
+
+    def __init__(self, monkeypatch, alter_id: int, ledgers: list[MasterRecord]):
+        self.alter_id = alter_id
+        self.altered: list[MasterRecord] = []
+        self.ledgers = ledgers
+        self.fetches: list = []
+        monkeypatch.setattr(tally_connector, "get_masters_state", self.state)
+        monkeypatch.setattr(tally_connector, "fetch_masters", self.fetch)
+
+    def state(self) -> tuple[str, int]:
+        return "Co", self.alter_id
+
+    def fetch(self, min_alter_id=None) -> dict:
+        self.fetches.append(min_alter_id)
+        ledgers = self.ledgers if min_alter_id is None else self.altered
+        return {"ledger": ledgers, "stock_item": [], "unit": []}
+
+
+def test_refresh_replaces_the_gstin_of_altered_ledgers(monkeypatch):
+    tally = FakeTally(monkeypatch, 10, [ledger("Acme", ACME_GSTIN)])
+    cache = MasterCache()
+    cache.get("Co")
+    assert gstin_index.lookup("Co", ACME_GSTIN) == "Acme"
+
+    tally.alter_id, tally.altered = 11, [ledger("Acme", BOLT_GSTIN)]
+    cache.get("Co")
+    assert gstin_index.lookup("Co", ACME_GSTIN) is None
+    assert gstin_index.lookup("Co", BOLT_GSTIN) == "Acme"
+
+
+def test_unchanged_alter_id_fetches_nothing(monkeypatch):
+    tally = FakeTally(monkeypatch, 10, [ledger("Acme")])
+    cache = MasterCache()
+    first = cache.get("Co")
+    assert cache.get("Co") is first
+    assert tally.fetches == [None]
+
+
+def test_moved_alter_id_fetches_only_altered_masters(monkeypatch):
+    tally = FakeTally(monkeypatch, 10, [ledger("Acme")])
+    cache = MasterCache()
+    cache.get("Co")
+
+    tally.alter_id, tally.altered = 12, [ledger("Bolt")]
+    snapshot = cache.get("Co")
+    assert tally.fetches == [None, 10]
+    assert snapshot.alter_id == 12
+    assert sorted(snapshot.names("ledger")) == ["Acme", "Bolt"]
+
+
+def test_expired_snapshot_is_fetched_in_full(monkeypatch):
+    tally = FakeTally(monkeypatch, 10, [ledger("Acme"), ledger("Bolt")])
+    cache = MasterCache(ttl=-1)
+    cache.get("Co")
+
+    # ? Deletions only show up on a full fetch
+    tally.ledgers = [ledger("Acme")]
+    assert cache.get("Co").names("ledger") == ["Acme"]
+    assert tally.fetches == [None, None]
+
+
+def test_recorded_master_is_in_the_snapshot_without_a_fetch(monkeypatch):
+    tally = FakeTally(monkeypatch, 10, [ledger("Acme")])
+    cache = MasterCache()
+    cache.get("Co")
+
+    cache.record("Co", "ledger", ledger("Bolt", BOLT_GSTIN))
+    assert cache.get("Co").has("ledger", "Bolt")
+    assert gstin_index.lookup("Co", BOLT_GSTIN) == "Bolt"
+    assert tally.fetches == [None]
+
+
+def tally_down():
+    raise ConnectionError("Tally is not running")
+
+
+def test_match_masters_uses_the_xml_export_while_tally_is_down(monkeypatch, tmp_path):
+    export = tmp_path / "masters.xml"
+    export.write_text(f"""<ENVELOPE><BODY><IMPORTDATA>
+<REQUESTDESC><STATICVARIABLES><SVCURRENTCOMPANY>Offline Co</SVCURRENTCOMPANY>
+</STATICVARIABLES></REQUESTDESC><REQUESTDATA><TALLYMESSAGE>
+<LEDGER NAME="Acme Industries"><PARTYGSTIN>{ACME_GSTIN}</PARTYGSTIN></LEDGER>
+<STOCKITEM NAME="Steel Rod"/><UNIT NAME="Nos"/>
+</TALLYMESSAGE></REQUESTDATA></IMPORTDATA></BODY></ENVELOPE>""")
+    monkeypatch.setattr(tally_connector, "TALLY_MASTERS_XML", str(export))
+    monkeypatch.setattr(tally_connector, "get_tally_company", tally_down)
+    monkeypatch.setattr(tally_connector, "get_masters_state", tally_down)
+    monkeypatch.setattr(tally_connector, "get_master_store", lambda *args: None)
+    monkeypatch.setattr(find_match, "encode", lambda texts: 1 / 0)
+    master_cache.invalidate()
+
+    common_df = pd.DataFrame(
+        {
+            "Voucher Type": ["Purchase"],
+            "Supplier Name": ["ACME IND."],
+            "Supplier GSTIN": [ACME_GSTIN],
+        }
+    )
+    items_df = pd.DataFrame({"Product Name": ["steel rod"], "Quantity Unit": ["NOS"]})
+    match_masters(common_df, items_df)
+
+    assert common_df["[D] Party Account"].tolist() == ["Acme Industries"]
+    assert items_df["[D] Stock Item"].tolist() == ["Steel Rod"]
+    assert items_df["[D] Units"].tolist() == ["Nos"]
+    assert master_cache.get("Offline Co").offline
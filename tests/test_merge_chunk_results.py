@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from src.parse_pdf import merge_chunk_results
+
+COLUMNS = ["Product Name", "Quantity", "Taxable Amount"]
+
+
+def chunk(*rows) -> tuple[pd.DataFrame, pd.DataFrame]:
+    common_df = pd.DataFrame({"Voucher Type": ["Sales"], "Document Number": ["7"]})
+    return common_df, pd.DataFrame(list(rows), columns=COLUMNS)
+
+
+def product_names(items_df: pd.DataFrame) -> list[str]:
+    return items_df["Product Name"].tolist()
+
+
+def test_keeps_the_same_item_bought_in_different_chunks():
+    widget = ("Widget", 1, 10.0)
+    _, items_df = merge_chunk_results(
+        [
+            chunk(widget, ("Bolt", 2, 4.0)),
+            chunk(("Nut", 3, 1.5), widget),
+            chunk(("Washer", 4, 0.5), widget),
+        ]
+    )
+    assert product_names(items_df) == [
+        "Widget", "Bolt", "Nut", "Widget", "Washer", "Widget"
+    ]
+
+
+def test_keeps_repeats_within_a_chunk():
+    row = ("Widget", 1, 10.0)
+    _, items_df = merge_chunk_results([chunk(row, row), chunk(("Bolt", 2, 4.0))])
+    assert product_names(items_df) == ["Widget", "Widget", "Bolt"]
+
+
+def test_drops_the_item_read_by_both_chunks_at_a_page_boundary():
+    boundary = ("Bolt", 2, np.nan)
+    _, items_df = merge_chunk_results(
+        [
+            chunk(("Widget", 1, 10.0), boundary),
+            chunk(boundary, ("Nut", 3, 1.5)),
+        ]
+    )
+    assert product_names(items_df) == ["Widget", "Bolt", "Nut"]
+
+
+def test_drops_items_repeated_from_the_context_page():
+    first = ("Widget", 1, 10.0)
+    _, items_df = merge_chunk_results(
+        [
+            chunk(first, ("Bolt", 2, 4.0)),
+            chunk(("Nut", 3, 1.5)),
+            chunk(first, ("Washer", 4, 0.5)),
+        ]
+    )
+    assert product_names(items_df) == ["Widget", "Bolt", "Nut", "Washer"]
+
+
+def test_header_comes_from_the_first_chunk():
+    common_df, _ = merge_chunk_results([chunk(), chunk(("Nut", 3, 1.5))])
+    assert common_df["Document Number"].tolist() == ["7"]
@@ -0,0 +1,33 @@
+import time
+
+from src.model_registry import ModelRegistry
+
+
+def registry(max_idle_seconds: float) -> ModelRegistry:
+    registry = ModelRegistry(max_idle_seconds, reap_interval=0.01)
+    registry.register_loader("fake", lambda name, device: object())
+    return registry
+
+
+def wait_until(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_first_get_starts_the_idle_reaper():
+    models = registry(0.05)
+    models.get("fake", "model", "cpu")
+    assert models.loaded() == [("fake", "model", "cpu")]
+    assert wait_until(lambda: models.loaded() == [])
+
+
+def test_keep_loaded_never_unloads():
+    models = registry(0.05)
+    models.keep_loaded()
+    models.get("fake", "model", "cpu")
+    time.sleep(0.2)
+    assert models.loaded() == [("fake", "model", "cpu")]
@@ -0,0 +1,72 @@
+import io
+
+from src.tally.parse_tally_xml import (
+    MasterRecord,
+    iter_tally_masters,
+    parse_tally_masters,
+    tally_export_company,
+)
+
+EXPORT = b"""<ENVELOPE>
+<HEADER><TALLYREQUEST>Import Data</TALLYREQUEST></HEADER>
+<BODY><IMPORTDATA>
+<REQUESTDESC><STATICVARIABLES>
+<SVCURRENTCOMPANY> Acme Traders </SVCURRENTCOMPANY>
+</STATICVARIABLES></REQUESTDESC>
+<REQUESTDATA>
+<TALLYMESSAGE>
+<LEDGER NAME="Bolt Supplies &#4;">
+<PARENT>Sundry Creditors</PARENT>
+<LEDGERGSTREGISTRATIONDETAILS.LIST><GSTIN>27AAACB5678B1Z3</GSTIN>
+</LEDGERGSTREGISTRATIONDETAILS.LIST>
+</LEDGER>
+</TALLYMESSAGE>
+<TALLYMESSAGE>
+<!-- exported by Tally -->
+<LEDGER><NAME.LIST><NAME>Cash</NAME></NAME.LIST><PARTYGSTIN> </PARTYGSTIN></LEDGER>
+<STOCKITEM NAME="Steel Rod"><BASEUNITS>Nos</BASEUNITS>
+<GSTDETAILS.LIST><HSNCODE>7214</HSNCODE></GSTDETAILS.LIST></STOCKITEM>
+<UNIT NAME="Nos"/>
+<VOUCHERTYPE NAME="Sales"/>
+<GROUP/>
+</TALLYMESSAGE>
+</REQUESTDATA>
+</IMPORTDATA></BODY>
+</ENVELOPE>"""
+
+
+def test_masters_are_read_with_their_fields():
+    records = list(iter_tally_masters(io.BytesIO(EXPORT)))
+    assert records[0] == MasterRecord(
+        "LEDGER", "Bolt Supplies \x04", "Sundry Creditors", "27AAACB5678B1Z3"
+    )
+    assert records[1] == MasterRecord("LEDGER", "Cash")
+    assert records[2] == MasterRecord(
+        "STOCKITEM", "Steel Rod", base_unit="Nos", hsn_code="7214"
+    )
+    # ? The nameless GROUP is skipped
+    assert [record.kind for record in records[3:]] == ["UNIT", "VOUCHERTYPE"]
+
+
+def test_masters_can_be_filtered_by_kind():
+    records = iter_tally_masters(io.BytesIO(EXPORT), ["UNIT", "STOCKITEM"])
+    assert [record.name for record in records] == ["Steel Rod", "Nos"]
+
+
+def test_names_are_grouped_by_kind(tmp_path):
+    path = tmp_path / "masters.xml"
+    path.write_bytes(EXPORT)
+    assert parse_tally_masters(str(path)) == {
+        "LEDGER": ["Bolt Supplies \x04", "Cash"],
+        "STOCKITEM": ["Steel Rod"],
+        "UNIT": ["Nos"],
+        "VOUCHERTYPE": ["Sales"],
+    }
+
+
+def test_export_company_is_read_from_the_request_description():
+    assert tally_export_company(io.BytesIO(EXPORT)) == "Acme Traders"
+
+    company = b"<SVCURRENTCOMPANY> Acme Traders </SVCURRENTCOMPANY>"
+    unnamed = EXPORT.replace(company, b"")
+    assert tally_export_company(io.BytesIO(unnamed)) is None
@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from src.batch import BatchResult
+from src.response_format import arrow_ipc, column_type, parse_orient, result_json
+
+
+def invoice(number: str, *items) -> tuple[pd.DataFrame, pd.DataFrame]:
+    common_df = pd.DataFrame(
+        {"Voucher Type": ["Sales"], "Document Number": [number], "filename": ["a"]}
+    )
+    items_df = pd.DataFrame(
+        list(items), columns=["Product Name", "Quantity", "Taxable Amount"]
+    )
+    return common_df, items_df
+
+
+def read_arrow(payload: bytes) -> pa.Table:
+    return pa.ipc.open_stream(payload).read_all()
+
+
+def test_result_json_columns_keep_types_and_nulls():
+    common_df, items_df = invoice("7", ("Widget", 2, 10.5), ("Bolt", 1, np.nan))
+    result = result_json(common_df, items_df, cache_hit=True)
+
+    assert result["primary"]["Document Number"] == "7"
+    assert result["secondary"] == {
+        "Product Name": ["Widget", "Bolt"],
+        "Quantity": [2, 1],
+        "Taxable Amount": [10.5, None],
+    }
+    assert [column["type"] for column in result["schema"]["secondary"]] == [
+        "string",
+        "integer",
+        "number",
+    ]
+    assert result["cache_hit"] is True
+    # ? Valid JSON, NaN would not be
+    json.dumps(result, allow_nan=False)
+
+
+def test_result_json_records():
+    common_df, items_df = invoice("7", ("Widget", 2, 10.5))
+    result = result_json(common_df, items_df, False, orient="records")
+    assert result["secondary"] == [
+        {"Product Name": "Widget", "Quantity": 2, "Taxable Amount": 10.5}
+    ]
+
+
+def test_object_columns_of_numbers_are_numbers():
+    assert column_type(pd.Series([1, 1.5, None], dtype=object)) == "number"
+    assert column_type(pd.Series([1, 2], dtype=object)) == "number"
+    assert column_type(pd.Series(["1", 2], dtype=object)) == "string"
+
+
+def test_arrow_stream_has_a_row_per_item_with_header_fields():
+    first = BatchResult(0, "a.pdf", *invoice("1", ("Widget", 2, 10.5), ("Bolt", 1, 3)))
+    second = BatchResult(1, "b.pdf", *invoice("2", ("Nut", 5, 1.25)))
+    table = read_arrow(arrow_ipc([first, second]))
+
+    assert table.column("document").to_pylist() == [0, 0, 1]
+    assert table.column("filename").to_pylist() == ["a.pdf", "a.pdf", "b.pdf"]
+    assert table.column("primary.Document Number").to_pylist() == ["1", "1", "2"]
+    assert pa.types.is_dictionary(table.schema.field("filename").type)
+    assert table.column("Product Name").to_pylist() == ["Widget", "Bolt", "Nut"]
+
+
+def test_arrow_keeps_numbers_numeric_and_only_mixed_columns_as_text():
+    common_df, items_df = invoice("1", ("Widget", 2, 10.5))
+    numbers = items_df.astype({"Taxable Amount": object, "Quantity": object})
+    numbers.loc[0, "Taxable Amount"] = 10
+    other = invoice("2", ("Nut", "two", 1.5))[1].astype({"Taxable Amount": object})
+    table = read_arrow(
+        arrow_ipc(
+            [
+                BatchResult(0, "a.pdf", common_df, numbers),
+                BatchResult(1, "b.pdf", common_df, other),
+            ]
+        )
+    )
+
+    assert table.column("Taxable Amount").to_pylist() == [10, 1.5]
+    assert pa.types.is_floating(table.schema.field("Taxable Amount").type)
+    assert table.column("Quantity").to_pylist() == ["2", "two"]
+
+
+def test_arrow_keeps_invoices_without_items_and_lists_errors():
+    empty = BatchResult(0, "empty.pdf", *invoice("1"))
+    failed = BatchResult(1, "bad.pdf", error="Unreadable PDF")
+    parsed = BatchResult(2, "c.pdf", *invoice("3", ("Nut", 5, 1.25)))
+    table = read_arrow(arrow_ipc([empty, failed, parsed]))
+
+    assert table.column("filename").to_pylist() == ["empty.pdf", "c.pdf"]
+    assert table.column("Product Name").to_pylist() == [None, "Nut"]
+    assert json.loads(table.schema.metadata[b"errors"]) == [
+        {"index": 1, "filename": "bad.pdf", "error": "Unreadable PDF"}
+    ]
+
+
+def test_parse_orient():
+    assert parse_orient(None) == "columns"
+    assert parse_orient("records") == "records"
+    with pytest.raises(ValueError):
+        parse_orient("index")
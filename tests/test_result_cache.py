@@ -0,0 +1,39 @@
+import pandas as pd
+
+from src.result_cache import ResultCache
+
+
+def frames() -> tuple[pd.DataFrame, pd.DataFrame]:
+    common_df = pd.DataFrame({"Invoice No": ["INV-1"]})
+    items_df = pd.DataFrame({"Product Name": ["Steel Rod"], "Quantity": [2.0]})
+    return common_df, items_df
+
+
+def test_directory_is_created_by_the_first_put(tmp_path):
+    cache = ResultCache(tmp_path / "results")
+    assert cache.get("missing") is None
+    assert not (tmp_path / "results").exists()
+
+    cache.put("key", *frames())
+    common_df, items_df = cache.get("key")
+    assert common_df.equals(frames()[0])
+    assert items_df.equals(frames()[1])
+
+
+def test_corrupt_entry_is_a_miss_and_dropped(tmp_path):
+    cache = ResultCache(tmp_path)
+    cache.put("key", *frames())
+    (tmp_path / "key" / "items.parquet").write_bytes(b"not parquet")
+
+    assert cache.get("key") is None
+    assert not (tmp_path / "key").exists()
+
+
+def test_unwritable_frame_is_not_cached(tmp_path):
+    cache = ResultCache(tmp_path)
+    common_df, items_df = frames()
+    items_df["Quantity"] = pd.Series([object()], dtype=object)
+
+    cache.put("key", common_df, items_df)
+    assert cache.get("key") is None
+    assert [path.name for path in tmp_path.iterdir()] == []
@@ -0,0 +1,68 @@
+import pandas as pd
+
+from src.verify_df import check_items, check_journal, stack_invoices, verify_invoices
+
+
+def items(*lines, **columns) -> pd.DataFrame:
+    """Line items of (quantity, rate, taxable, tax rate, tax, total)"""
+    df = pd.DataFrame(
+        list(lines),
+        columns=[
+            "Quantity",
+            "Rate",
+            "Taxable Amount",
+            "Tax Rate",
+            "Tax Amount",
+            "Total Amount",
+        ],
+    )
+    df["Discount"] = 0
+    return df.assign(**columns)
+
+
+def test_balanced_invoice_has_no_errors():
+    errors = check_items(items((2, 50, 100, 18, 18, 118), (1, 10, 10, 5, 0.5, 10.5)))
+    assert errors.empty
+
+
+def test_many_lines_rounding_below_a_tenth_balance():
+    # ? Each line rounds up to the next tenth, five of them did add up to 0.2
+    line = (1, 10.04, 10.04, 18, 1.81, 11.85)
+    assert check_items(items(*[line] * 5)).empty
+    assert check_items(items(*[line] * 200)).empty
+
+
+def test_wrong_line_amounts_are_reported_per_row():
+    errors = check_items(items((2, 50, 100, 18, 18, 118), (1, 10, 12, 5, 0.6, 12.6)))
+    assert errors[["row", "field"]].values.tolist() == [[1, "Taxable Amount"]]
+
+
+def test_unbalanced_voucher_total():
+    # ? Every line is consistent on its own except the total of the last one
+    errors = check_items(items((1, 100, 100, 18, 18, 118), (1, 100, 100, 18, 18, 119)))
+    assert errors["field"].tolist() == ["Total Amount", "Voucher Total"]
+    voucher = errors.iloc[-1]
+    assert voucher["row"] is None
+    assert (voucher["expected"], voucher["actual"]) == (236.0, 237.0)
+
+
+def test_missing_values_are_not_flagged():
+    assert check_items(items((1, None, 100, 18, 18, 118))).empty
+
+
+def test_journal_must_balance():
+    ledgers = pd.DataFrame({"Debit Amount": [100, 0], "Credit Amount": [0, 90]})
+    errors = check_journal(ledgers)
+    assert errors[["field", "expected", "actual"]].values.tolist() == [
+        ["Net Credit", 100, 90]
+    ]
+
+
+def test_stacked_invoices_point_at_their_own_rows():
+    common = pd.DataFrame({"Voucher Type": ["Sales"]})
+    good = items((1, 100, 100, 18, 18, 118))
+    bad = items((1, 100, 100, 18, 18, 118), (1, 10, 10, 18, 9, 19))
+    errors = verify_invoices(*stack_invoices([(common, good), (common, bad)], "ab"))
+    assert errors[["invoice", "row", "field"]].values.tolist() == [
+        ["b", 1, "Tax Amount"]
+    ]